@@ -0,0 +1,264 @@
+# 単純な結果に対する定型文の回答（Phase 3 の LLM 呼び出しの省略）
+# Phase 3 では、SQLの結果が件数やCPAのような1つの値でも、毎回 gpt-4o に回答文を作らせていた。
+# 結果の形（1つの値・1行・短い一覧・小さな集計表）を判定し、これらは定型文と表で回答してLLMを呼ばない。
+# 結果が大きい・形が複雑・質問が理由や傾向の説明を求めている場合は、従来どおりLLMで回答を作る。
+#
+# 使い方:
+#   python answer_templates.py bench                  # 質問例で、省略できた回答生成の件数と時間を計測（擬似LLM）
+#   python answer_templates.py bench --latency 0.5
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+TEMPLATES_ENABLED = os.environ.get("ANSWER_TEMPLATES", "1") != "0"
+# 短い一覧（1列）・小さな集計表の最大行数
+MAX_LIST_ROWS = int(os.environ.get("ANSWER_TEMPLATE_MAX_ROWS", "10"))
+# 1行の結果・集計表の最大列数
+MAX_ROW_COLUMNS = 8
+MAX_TABLE_COLUMNS = 4
+
+# 理由・傾向・提案などの説明を求める質問は、結果が単純でもLLMで回答する
+NEEDS_NARRATIVE = re.compile(
+    r"なぜ|理由|原因|傾向|推移|分析|考察|提案|改善|説明|解説|どう思|どうすれば|評価"
+    r"|\b(?:why|explain|trend|insight|analy[sz]e|recommend|suggest)\b",
+    re.I,
+)
+
+# 年・月・ID などの列は数値でも桁区切りを付けず、集計表ではラベルとして扱う
+_CODE_COLUMN = re.compile(r"(?:^|_)(?:year|month|day|date|id)$|Id$|年$|月$|日$", re.I)
+
+# よく使われる列名・別名の表示名
+COLUMN_LABELS = {
+    "cpa": "CPA",
+    "cost": "コスト",
+    "conversions": "獲得件数",
+    "clicks": "クリック数",
+    "impressions": "表示回数",
+    "ctr": "CTR",
+    "cvr": "CVR",
+    "reservations": "予約数",
+    "y_yoyaku": "予約数",
+    "media_type": "媒体",
+    "account_type": "アカウント種別",
+    "utm_source": "流入元",
+    "utm_campaign": "キャンペーン",
+    "sales": "売上",
+    "total": "売上合計",
+    "invoices": "請求書数",
+    "customers": "顧客数",
+    "tracks": "曲数",
+    "minutes": "合計時間（分）",
+    "count(*)": "件数",
+    "count": "件数",
+    "billingcountry": "国",
+    "country": "国",
+    "name": "名前",
+    "firstname": "名",
+    "lastname": "姓",
+    "title": "タイトル",
+    "year": "年",
+    "month": "月",
+}
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_code_column(name):
+    return bool(_CODE_COLUMN.search(name or ""))
+
+
+def column_label(name):
+    return COLUMN_LABELS.get((name or "").lower(), name)
+
+
+def format_value(value, column=None):
+    """画面・回答文に出す値の表記（数値は桁区切り、小数は2桁まで。CTR などの1未満の小数は有効数字4桁）。"""
+    if value is None:
+        return "（なし）"
+    if isinstance(value, bytes):
+        return f"<{len(value)} バイト>"
+    if _is_number(value):
+        if _is_code_column(column):
+            return str(int(value)) if isinstance(value, float) and value.is_integer() else str(value)
+        if isinstance(value, float) and not value.is_integer():
+            return f"{value:.4g}" if abs(value) < 1 else f"{value:,.2f}"
+        return f"{int(value):,}"
+    return str(value)
+
+
+def _cell(value, column):
+    return format_value(value, column).replace("|", "\\|").replace("\n", " ")
+
+
+def markdown_table(columns, rows):
+    lines = [
+        "| " + " | ".join(column_label(c).replace("|", "\\|") for c in columns) + " |",
+        "| " + " | ".join("---:" if all(_is_number(r[i]) or r[i] is None for r in rows) else "---"
+                         for i in range(len(columns))) + " |",
+    ]
+    lines.extend("| " + " | ".join(_cell(v, c) for v, c in zip(row, columns)) + " |" for row in rows)
+    return "\n".join(lines)
+
+
+def _split_table(columns, rows):
+    """集計表なら (ラベル列の位置, 数値列の位置) を返す（左にラベル列、右に数値列が並ぶ形のみ）。"""
+    numeric = [
+        i for i, column in enumerate(columns)
+        if not _is_code_column(column)
+        and all(_is_number(row[i]) or row[i] is None for row in rows)
+        and any(_is_number(row[i]) for row in rows)
+    ]
+    labels = [i for i in range(len(columns)) if i not in numeric]
+    if not labels or not numeric or max(labels) > min(numeric):
+        return None
+    return labels, numeric
+
+
+def classify(question, summary):
+    """
+    定型文で回答できる結果の形を返す（"empty" / "scalar" / "single_row" / "short_list" / "grouped"）。
+    LLMで回答すべき場合は None。
+    """
+    if summary is None or summary.truncated or not summary.columns:
+        return None
+    if NEEDS_NARRATIVE.search(question or ""):
+        return None
+    columns, rows = summary.columns, summary.rows
+    if not rows:
+        return "empty"
+    if len(rows) == 1 and len(columns) == 1:
+        return "scalar"
+    if len(rows) == 1 and len(columns) <= MAX_ROW_COLUMNS:
+        return "single_row"
+    if len(columns) == 1 and len(rows) <= MAX_LIST_ROWS:
+        return "short_list"
+    if len(rows) <= MAX_LIST_ROWS and len(columns) <= MAX_TABLE_COLUMNS and _split_table(columns, rows):
+        return "grouped"
+    return None
+
+
+def _extremes(columns, rows, labels, measure):
+    """数値列 measure が最大・最小の行の説明文（値が2つ未満なら空文字）。"""
+    valued = [row for row in rows if row[measure] is not None]
+    if len(valued) < 2:
+        return ""
+    name = column_label(columns[measure])
+
+    def describe(row):
+        label = "・".join(format_value(row[i], columns[i]) for i in labels)
+        return f"{label}（{format_value(row[measure], columns[measure])}）"
+
+    top = max(valued, key=lambda row: row[measure])
+    bottom = min(valued, key=lambda row: row[measure])
+    return f"{name}が最も大きいのは {describe(top)}、最も小さいのは {describe(bottom)}です。"
+
+
+def render(shape, summary, current_date=None, **_):
+    """classify() が返した形に合わせた回答文（Markdown。表を含む）を返す。"""
+    columns, rows = summary.columns, summary.rows
+    prefix = f"現在の日付（{current_date}）時点でのデータによると、" if current_date else ""
+    if shape == "empty":
+        return f"{prefix}条件に該当するデータはありませんでした。"
+    if shape == "scalar":
+        label, value = column_label(columns[0]), rows[0][0]
+        if value is None:
+            return f"{prefix}該当するデータが無いため、{label}は算出できませんでした。"
+        return f"{prefix}{label}は **{format_value(value, columns[0])}** です。"
+    if shape == "single_row":
+        lines = [f"- **{column_label(c)}**: {format_value(v, c)}" for c, v in zip(columns, rows[0])]
+        return f"{prefix}該当するデータは次のとおりです。\n\n" + "\n".join(lines)
+    if shape == "short_list":
+        lines = [f"- {format_value(row[0], columns[0])}" for row in rows]
+        return f"{prefix}該当する{column_label(columns[0])}は {len(rows)} 件です。\n\n" + "\n".join(lines)
+    if shape == "grouped":
+        labels, numeric = _split_table(columns, rows)
+        by = "・".join(column_label(columns[i]) for i in labels)
+        measures = "・".join(column_label(columns[i]) for i in numeric)
+        text = f"{prefix}{by}ごとの{measures}は次のとおりです（{len(rows)} 件）。\n\n" + markdown_table(columns, rows)
+        extremes = _extremes(columns, rows, labels, numeric[0])
+        return text + (f"\n\n{extremes}" if extremes else "")
+    raise ValueError(f"未対応の結果の形です: {shape}")
+
+
+def template_answer(question, summary, **template_vars):
+    """定型文で回答できれば (形, 回答文) を、できなければ (None, None) を返す。"""
+    shape = classify(question, summary)
+    if shape is None:
+        return None, None
+    return shape, render(shape, summary, **template_vars)
+
+
+# ==========================================
+# 計測（benchmark.py の質問例で、定型文あり・なしを比較）
+# ==========================================
+
+def bench(pipelines=("txt2sql", "mark_db"), latency=0.3, repeat=3):
+    """
+    質問例を定型文あり・なしで repeat 回ずつ処理し（キャッシュなし）、
+    LLMを呼ばずに回答した件数と、回答生成・全体の所要時間の合計を比較する。
+    """
+    from benchmark import BENCH_DATE, CORPUS, fake_client
+    from pipeline import PIPELINES, marketing_context
+
+    client = fake_client(latency)
+    report = {"latency_sec": latency, "repeat": repeat, "pipelines": {}}
+    for name in pipelines:
+        pipeline = PIPELINES[name]
+        context = marketing_context(BENCH_DATE) if name == "mark_db" else {}
+        shapes = {}
+        totals = {mode: {"answer_sec": 0.0, "total_sec": 0.0, "answer_calls": 0} for mode in ("llm", "template")}
+        for mode in ("llm", "template"):
+            for _ in range(repeat):
+                for question in CORPUS[name]:
+                    calls = client.calls
+                    turn = pipeline.run(client, question, use_cache=False, templates=mode == "template", **context)
+                    item = totals[mode]
+                    item["answer_sec"] += turn.timings.get("answer", 0.0)
+                    item["total_sec"] += turn.timings["total"]
+                    # SQL生成の1回を除いた呼び出しが回答生成
+                    item["answer_calls"] += client.calls - calls - 1
+                    if mode == "template":
+                        shapes[question] = turn.answer_template
+        turns = repeat * len(CORPUS[name])
+        report["pipelines"][name] = {
+            "turns": turns,
+            "skipped": turns - totals["template"]["answer_calls"],
+            "shapes": shapes,
+            **{f"{mode}_{key}": round(value, 3) if isinstance(value, float) else value
+               for mode, item in totals.items() for key, value in item.items()},
+        }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="定型文による回答（Phase 3 の LLM 呼び出しの省略）の計測")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--pipelines", nargs="+", choices=["txt2sql", "mark_db"], default=["txt2sql", "mark_db"])
+    parser.add_argument("--latency", type=float, default=0.3, help="擬似LLMの1回あたりの遅延（秒）")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    report = bench(args.pipelines, args.latency, args.repeat)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return 0
+    for name, item in report["pipelines"].items():
+        print(f"== {name}（{item['turns']} 件）")
+        for question, shape in item["shapes"].items():
+            print(f"  {shape or 'LLM':<10} {question}")
+        print(f"  回答生成のLLM呼び出し: {item['turns']} 件中 {item['skipped']} 件を省略")
+        print(f"  回答生成の合計: {item['llm_answer_sec']}秒 → {item['template_answer_sec']}秒"
+              f" / 全体の合計: {item['llm_total_sec']}秒 → {item['template_total_sec']}秒")
+    print(f"（擬似LLMの遅延 {args.latency}秒/回、計測 {time.perf_counter() - started:.1f}秒）")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
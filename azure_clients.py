@@ -0,0 +1,288 @@
+# main.py で使う Azure クライアント（AI Search / Azure OpenAI）のプロセス内共有
+# これまでは search() のたびに SearchClient と AzureOpenAI を2つ作り直していたため、
+# 毎ターン HTTP の接続プールが捨てられ、3つのエンドポイントへの TLS ハンドシェイクをやり直していた。
+# クライアントを一度だけ作り、keep-alive の接続プールをセッション・再実行をまたいで使い回す。
+# st.secrets["azure"] の内容が変わった場合は作り直す。
+#
+# 使い方:
+#   python azure_clients.py bench --turns 20   # ローカルのスタブサーバーで1ターンあたりのオーバーヘッドを比較
+import argparse
+import hashlib
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+# 接続プールの大きさ（同時に張る接続数・keep-alive で保持する接続数）
+POOL_MAXSIZE = int(os.environ.get("AZURE_POOL_MAXSIZE", "20"))
+KEEPALIVE_CONNECTIONS = int(os.environ.get("AZURE_KEEPALIVE_CONNECTIONS", "10"))
+KEEPALIVE_EXPIRY = float(os.environ.get("AZURE_KEEPALIVE_EXPIRY", "60"))
+
+# リトライ（指数バックオフ）とタイムアウト
+MAX_RETRIES = int(os.environ.get("AZURE_MAX_RETRIES", "3"))
+RETRY_BACKOFF = float(os.environ.get("AZURE_RETRY_BACKOFF", "0.8"))
+RETRY_BACKOFF_MAX = float(os.environ.get("AZURE_RETRY_BACKOFF_MAX", "30"))
+REQUEST_TIMEOUT = float(os.environ.get("AZURE_REQUEST_TIMEOUT", "60"))
+# 作り直した後、古いクライアントを閉じるまでの猶予（秒）。
+# 他のセッションが古いクライアントで実行中のリクエスト（ストリーミングを含む）を途中で切らないようにする。
+CLOSE_GRACE = float(os.environ.get("AZURE_CLOSE_GRACE", "120"))
+
+# クライアントの作成に使う st.secrets["azure"] のキー
+SECRET_KEYS = [
+    "SEARCH_SERVICE_ENDPOINT", "SEARCH_SERVICE_INDEX_NAME", "SEARCH_SERVICE_API_KEY",
+    "AOAI_ENDPOINT", "AOAI_API_KEY", "AOAI_API_VERSION",
+    "AOAI_GPT4O_ENDPOINT", "AOAI_GPT4O_API_KEY", "AOAI_GPT4O_API_VERSION",
+]
+
+
+def secrets_fingerprint(secrets):
+    """接続情報のハッシュ（値そのものは保持しない）。"""
+    payload = json.dumps([str(secrets.get(key, "")) for key in SECRET_KEYS])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _openai_client(endpoint, api_key, api_version):
+    import httpx
+    from openai import AzureOpenAI
+
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=POOL_MAXSIZE,
+            max_keepalive_connections=KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+        timeout=REQUEST_TIMEOUT,
+    )
+    # openai SDK は接続エラー・429・5xx を指数バックオフでリトライする
+    client = AzureOpenAI(
+        azure_endpoint=endpoint,
+        api_key=api_key,
+        api_version=api_version,
+        max_retries=MAX_RETRIES,
+        http_client=http_client,
+    )
+    return client, http_client
+
+
+def _search_client(endpoint, index_name, api_key):
+    import requests
+    from azure.core.credentials import AzureKeyCredential
+    from azure.core.pipeline.transport import RequestsTransport
+    from azure.search.documents import SearchClient
+
+    session = requests.Session()
+    # リトライは azure-core の RetryPolicy に任せるため、アダプター側ではリトライしない
+    adapter = requests.adapters.HTTPAdapter(pool_connections=KEEPALIVE_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    client = SearchClient(
+        endpoint=endpoint,
+        index_name=index_name,
+        credential=AzureKeyCredential(api_key),
+        transport=RequestsTransport(session=session, session_owner=False, connection_timeout=REQUEST_TIMEOUT),
+        retry_total=MAX_RETRIES,
+        retry_backoff_factor=RETRY_BACKOFF,
+        retry_backoff_max=RETRY_BACKOFF_MAX,
+    )
+    return client, session
+
+
+class AzureClients:
+    """1組の接続情報に対応する SearchClient と AzureOpenAI クライアント（埋め込み用・回答生成用）。"""
+
+    def __init__(self, secrets):
+        self.fingerprint = secrets_fingerprint(secrets)
+        self.created_at = time.time()
+        self.search_client, search_session = _search_client(
+            secrets["SEARCH_SERVICE_ENDPOINT"],
+            secrets["SEARCH_SERVICE_INDEX_NAME"],
+            secrets["SEARCH_SERVICE_API_KEY"],
+        )
+        self.openai_client, openai_http = _openai_client(
+            secrets["AOAI_ENDPOINT"], secrets["AOAI_API_KEY"], secrets["AOAI_API_VERSION"]
+        )
+        self.openai_client_gpt4o, gpt4o_http = _openai_client(
+            secrets["AOAI_GPT4O_ENDPOINT"], secrets["AOAI_GPT4O_API_KEY"], secrets["AOAI_GPT4O_API_VERSION"]
+        )
+        self._closeables = [self.search_client, search_session, openai_http, gpt4o_http]
+
+    def close(self):
+        for resource in self._closeables:
+            try:
+                resource.close()
+            except Exception:
+                pass
+
+
+_clients = None
+_clients_lock = threading.Lock()
+
+
+def _close_later(clients):
+    """古いクライアントを CLOSE_GRACE 秒後に閉じる（まだ使っているセッションがあるため、すぐには閉じない）。"""
+    timer = threading.Timer(CLOSE_GRACE, clients.close)
+    timer.daemon = True
+    timer.start()
+
+
+def get_azure_clients(secrets):
+    """
+    プロセス内で共有する AzureClients を返す。
+    secrets（st.secrets["azure"]）の内容が前回と異なる場合は作り直す（古いクライアントは猶予の後に閉じる）。
+    接続情報が不足している場合は KeyError。
+    """
+    global _clients
+    fingerprint = secrets_fingerprint(secrets)
+    with _clients_lock:
+        if _clients is None or _clients.fingerprint != fingerprint:
+            old, _clients = _clients, AzureClients(secrets)
+            if old is not None:
+                _close_later(old)
+        return _clients
+
+
+def connection_errors():
+    """
+    リトライしても接続できなかったことを表す例外の組（except 節で使う）。
+    except 節の式は例外が発生したときに評価されるため、azure / openai の import は必要になるまで行われない。
+    """
+    from azure.core.exceptions import ServiceRequestError
+    from openai import APIConnectionError
+
+    return (APIConnectionError, ServiceRequestError)
+
+
+def reset_azure_clients():
+    """
+    共有しているクライアントを手放す（次の get_azure_clients で作り直される）。
+    他のセッションが実行中のリクエストを切らないよう、閉じるのは猶予の後。
+    """
+    global _clients
+    with _clients_lock:
+        old, _clients = _clients, None
+    if old is not None:
+        _close_later(old)
+
+
+# ==========================================
+# スタブサーバーでの計測
+# ==========================================
+
+def _stub_handler(connect_delay):
+    """Azure OpenAI（埋め込み・チャット）と AI Search の応答を返すだけのサーバーのハンドラー。"""
+    # http.server はベンチマークでしか使わないため、画面の起動時には import しない
+    from http.server import BaseHTTPRequestHandler
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive を有効にする
+        connections = 0
+        lock = threading.Lock()
+
+        def setup(self):
+            # 新しい接続ごとに、TLS ハンドシェイク相当の遅延を入れる
+            with StubHandler.lock:
+                StubHandler.connections += 1
+            time.sleep(connect_delay)
+            super().setup()
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if "/embeddings" in self.path:
+                body = {
+                    "object": "list", "model": "stub",
+                    "data": [{"object": "embedding", "index": 0, "embedding": [0.0] * 8}],
+                    "usage": {"prompt_tokens": 1, "total_tokens": 1},
+                }
+            elif "/chat/completions" in self.path:
+                body = {
+                    "id": "stub", "object": "chat.completion", "created": 0, "model": "stub",
+                    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "ok"}}],
+                    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+                }
+            else:
+                body = {"value": [{"@search.score": 1.0, "id": "1", "content": "stub"}]}
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return StubHandler
+
+
+def _stub_secrets(port):
+    endpoint = f"http://127.0.0.1:{port}"
+    return {
+        "SEARCH_SERVICE_ENDPOINT": endpoint, "SEARCH_SERVICE_INDEX_NAME": "stub", "SEARCH_SERVICE_API_KEY": "stub",
+        "AOAI_ENDPOINT": endpoint, "AOAI_API_KEY": "stub", "AOAI_API_VERSION": "2024-02-01",
+        "AOAI_GPT4O_ENDPOINT": endpoint, "AOAI_GPT4O_API_KEY": "stub", "AOAI_GPT4O_API_VERSION": "2024-02-01",
+    }
+
+
+def _turn(clients):
+    """search() の1ターン分の呼び出し（埋め込み → ベクトル検索 → 回答生成）。"""
+    from azure.search.documents.models import VectorizedQuery
+
+    embedding = clients.openai_client.embeddings.create(input="質問", model="stub").data[0].embedding
+    vector_query = VectorizedQuery(vector=embedding, k_nearest_neighbor=3, fields="contentVector")
+    list(clients.search_client.search(vector_queries=[vector_query], select=["id", "content"]))
+    clients.openai_client_gpt4o.chat.completions.create(
+        model="stub", messages=[{"role": "user", "content": "質問"}]
+    )
+
+
+def bench(turns=20, connect_delay=0.05):
+    """毎ターン作り直す場合と共有する場合で、1ターンの時間（ミリ秒）と張った接続数を比較する。"""
+    from http.server import ThreadingHTTPServer
+
+    handler = _stub_handler(connect_delay)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    secrets = _stub_secrets(server.server_address[1])
+    report = {}
+    try:
+        for mode in ("per_turn", "shared"):
+            handler.connections = 0
+            timings = []
+            for _ in range(turns):
+                started = time.perf_counter()
+                if mode == "per_turn":
+                    clients = AzureClients(secrets)
+                    _turn(clients)
+                    clients.close()
+                else:
+                    _turn(get_azure_clients(secrets))
+                timings.append((time.perf_counter() - started) * 1000)
+            report[mode] = {
+                "median_ms": round(statistics.median(timings), 2),
+                "max_ms": round(max(timings), 2),
+                "connections": handler.connections,
+            }
+    finally:
+        reset_azure_clients()
+        server.shutdown()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Azure クライアント共有の効果をスタブサーバーで計測する")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--connect-delay", type=float, default=0.05, help="新しい接続ごとの遅延（秒）")
+    args = parser.parse_args(argv)
+
+    report = bench(args.turns, args.connect_delay)
+    for mode, label in (("per_turn", "毎ターン作成"), ("shared", "共有")):
+        item = report[mode]
+        print(f"{label}: 中央値 {item['median_ms']}ms / 最大 {item['max_ms']}ms / 接続数 {item['connections']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
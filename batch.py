@@ -0,0 +1,485 @@
+# 質問の一括実行（画面を使わない text-to-SQL）
+# 画面（pages/txt2sql.py, pages/mark_db.py）では質問を1つずつしか処理できないため、
+# JSONL / CSV の質問一覧を、画面と同じ処理（pipeline.py の SQL生成 → SQL実行 → 回答生成）で並列に処理する。
+# - 同時に処理する質問数はワーカー数で上限を設ける
+# - OpenAI API の呼び出しはトークンバケットで毎分のリクエスト数・トークン数を制限し、429 が返ったら全ワーカーで待つ
+# - 一時的なエラー（429・5xx・接続エラー・DBのロック）は指数バックオフで質問ごとにやり直す
+# - 結果は1問ごとに JSONL に追記し、同じ出力先で再実行すると成功済みの質問は飛ばす（中断しても続きから再開できる）
+#
+# 入力: JSONL は1行1問（{"id": ..., "question": ..., "pipeline": "mark_db", "date": "2025-11-15"}。question 以外は省略可）、
+#       CSV は同じ名前の列を持つヘッダー付きのファイル。id を省略した場合は行番号を使う。
+#
+# 使い方:
+#   python batch.py run questions.jsonl --out results.jsonl
+#   python batch.py run questions.csv --pipeline mark_db --workers 8 --rpm 300 --tpm 150000
+#   python batch.py bench                                  # 擬似LLMで同時実行数ごとのスループットを計測
+#   python batch.py bench --workers 1 4 8 16 --rpm 600 --latency 0.5
+import argparse
+import csv
+import json
+import math
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from result_compact import approx_tokens
+
+DEFAULT_WORKERS = int(os.environ.get("BATCH_WORKERS", "4"))
+# OpenAI API の上限（0 は制限なし）。組織・モデルごとの上限より少し低めに設定する
+DEFAULT_RPM = float(os.environ.get("BATCH_RPM", "0"))
+DEFAULT_TPM = float(os.environ.get("BATCH_TPM", "0"))
+# 一時的なエラーでやり直す回数と、待ち時間（指数バックオフ）
+MAX_RETRIES = int(os.environ.get("BATCH_MAX_RETRIES", "4"))
+RETRY_BACKOFF = float(os.environ.get("BATCH_RETRY_BACKOFF", "1.0"))
+RETRY_BACKOFF_MAX = float(os.environ.get("BATCH_RETRY_BACKOFF_MAX", "60"))
+# 出力に含める結果の最大行数（全件は result_export.py で取り出す）
+RESULT_ROWS = int(os.environ.get("BATCH_RESULT_ROWS", "50"))
+
+_TRANSIENT_STATUS = {408, 409, 429, 500, 502, 503, 504}
+_TRANSIENT_ERRORS = {"APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError"}
+
+
+# ==========================================
+# レート制限
+# ==========================================
+
+class TokenBucket:
+    """毎秒 rate ずつ補充され、最大 capacity まで貯まるトークンのバケット。"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.waited = 0.0
+
+    def acquire(self, amount=1.0):
+        """amount 個のトークンが貯まるまで待って取り出す（1回で capacity を超える分は capacity として扱う）。"""
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self._tokens >= amount:
+                        self._tokens -= amount
+                        return
+                    wait = (amount - self._tokens) / self.rate
+                self.waited += wait
+            time.sleep(wait)
+
+    def debit(self, amount):
+        """見積もりより多く使った分を差し引く（残りが負になれば、その分だけ次の取り出しが待つ）。"""
+        with self._lock:
+            self._tokens -= amount
+
+    def pause(self, seconds):
+        """429 が返った場合など、seconds 秒間は取り出しを止める。"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def _status_code(error):
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def _retry_after(error):
+    """エラーのレスポンスの Retry-After ヘッダー（秒）。無ければ None。"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_transient(error):
+    """やり直せば成功しうるエラーなら True（SQLの誤りや上限超過などはやり直さない）。"""
+    if isinstance(error, sqlite3.OperationalError):
+        message = str(error).lower()
+        return "locked" in message or "busy" in message
+    return _status_code(error) in _TRANSIENT_STATUS or type(error).__name__ in _TRANSIENT_ERRORS
+
+
+class RateLimitedClient:
+    """
+    chat.completions.create の前にバケットからリクエスト数とトークン数（プロンプトの概算）を取り出す OpenAI クライアント。
+    429 が返ったら Retry-After（無ければ1秒）の間、すべてのワーカーの呼び出しを止める。
+    """
+
+    def __init__(self, client, rpm=0, tpm=0):
+        self._client = client
+        self.requests = TokenBucket(rpm / 60) if rpm else None
+        self.tokens = TokenBucket(tpm / 60, capacity=tpm / 60 * 10) if tpm else None
+        self.calls = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        estimate = sum(approx_tokens(m.get("content") or "") for m in kwargs.get("messages") or [])
+        if self.requests is not None:
+            self.requests.acquire()
+        if self.tokens is not None:
+            self.tokens.acquire(estimate)
+        with self._lock:
+            self.calls += 1
+        try:
+            response = self._client.chat.completions.create(**kwargs)
+        except Exception as e:
+            if _status_code(e) == 429:
+                with self._lock:
+                    self.rate_limited += 1
+                for bucket in (self.requests, self.tokens):
+                    if bucket is not None:
+                        bucket.pause(_retry_after(e) or 1.0)
+            raise
+        usage = getattr(response, "usage", None)
+        if self.tokens is not None and usage is not None:
+            self.tokens.debit((getattr(usage, "total_tokens", 0) or 0) - estimate)
+        return response
+
+    @property
+    def waited(self):
+        return sum(bucket.waited for bucket in (self.requests, self.tokens) if bucket is not None)
+
+
+# ==========================================
+# 入出力・チェックポイント
+# ==========================================
+
+def read_questions(path, pipeline=None, date=None):
+    """JSONL / CSV の質問一覧を {"id", "question", "pipeline", "date"} のリストにする。"""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith(".csv"):
+            items = list(csv.DictReader(f))
+        else:
+            items = [json.loads(line) for line in f if line.strip()]
+    questions = []
+    for i, item in enumerate(items, start=1):
+        question = (item.get("question") or "").strip()
+        if not question:
+            continue
+        questions.append({
+            "id": str(item.get("id") or i),
+            "question": question,
+            "pipeline": item.get("pipeline") or pipeline or "txt2sql",
+            "date": item.get("date") or date,
+        })
+    return questions
+
+
+def completed_ids(out_path):
+    """出力済みの JSONL から、成功した質問の id を返す（書きかけの最終行などの壊れた行は無視する）。"""
+    done = set()
+    if not os.path.exists(out_path):
+        return done
+    with open(out_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("status") == "ok":
+                done.add(str(record.get("id")))
+    return done
+
+
+class ResultWriter:
+    """結果を1件ずつ JSONL に追記する（書き込みのたびに flush し、中断しても書き終えた行は残す）。"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # 前回が書きかけの行で終わっていれば改行を補う
+        needs_newline = False
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        self._file = open(path, "a", encoding="utf-8")
+        if needs_newline:
+            self._file.write("\n")
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def turn_record(item, turn, attempts):
+    summary = turn.summary
+    prompt_tokens, completion_tokens = turn.trace.tokens
+    return {
+        "id": item["id"],
+        "pipeline": item["pipeline"],
+        "question": item["question"],
+        "status": "ok",
+        "sql": turn.sql,
+        "executed_sql": turn.executed_sql if turn.executed_sql != turn.sql else None,
+        "columns": summary.columns,
+        "rows": summary.rows[:RESULT_ROWS],
+        "row_count": summary.row_count,
+        "truncated": summary.truncated,
+        "answer": turn.answer,
+        "answer_template": turn.answer_template,
+        "cache": dict(turn.trace.cache),
+        "timings": {phase: round(seconds, 4) for phase, seconds in turn.timings.items()},
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "attempts": attempts,
+        "trace_id": turn.trace.trace_id,
+        "finished_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def error_record(item, error, attempts, elapsed):
+    return {
+        "id": item["id"],
+        "pipeline": item["pipeline"],
+        "question": item["question"],
+        "status": "error",
+        "error_type": type(error).__name__,
+        "error": str(error),
+        "transient": is_transient(error),
+        "attempts": attempts,
+        "timings": {"total": round(elapsed, 4)},
+        "finished_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+# ==========================================
+# 実行
+# ==========================================
+
+def run_one(client, item, use_cache=True, max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF, stop=None):
+    """1問を処理して出力する1行分の辞書を返す。一時的なエラーは指数バックオフ（ジッター付き）でやり直す。"""
+    from pipeline import PIPELINES, marketing_context
+
+    pipeline = PIPELINES[item["pipeline"]]
+    context = {}
+    if item["pipeline"] == "mark_db":
+        context = marketing_context(item["date"] or datetime.now().strftime("%Y-%m-%d"))
+    started = time.perf_counter()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            turn = pipeline.run(client, item["question"], use_cache=use_cache, **context)
+            return turn_record(item, turn, attempt)
+        except Exception as e:
+            if attempt > max_retries or not is_transient(e) or (stop is not None and stop.is_set()):
+                return error_record(item, e, attempt, time.perf_counter() - started)
+            wait = _retry_after(e) or min(RETRY_BACKOFF_MAX, backoff * 2 ** (attempt - 1))
+            time.sleep(wait * random.uniform(0.5, 1.0))
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def run_batch(client, questions, out_path, workers=DEFAULT_WORKERS, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM,
+              use_cache=True, max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF, progress=None):
+    """
+    questions を workers 個のスレッドで処理し、結果を out_path に追記する。
+    out_path に成功済みの結果がある質問は処理しない。処理の集計（スループットなど）を返す。
+    """
+    done = completed_ids(out_path)
+    pending = [item for item in questions if item["id"] not in done]
+    limited = RateLimitedClient(client, rpm, tpm)
+    writer = ResultWriter(out_path)
+    stop = threading.Event()
+    lock = threading.Lock()
+    queue = iter(pending)
+    stats = {"ok": 0, "error": 0, "retried": 0, "latencies": []}
+
+    def worker():
+        while not stop.is_set():
+            with lock:
+                item = next(queue, None)
+            if item is None:
+                return
+            record = run_one(limited, item, use_cache, max_retries, backoff, stop)
+            writer.write(record)
+            with lock:
+                stats[record["status"]] += 1
+                stats["retried"] += record["attempts"] > 1
+                stats["latencies"].append(record["timings"]["total"])
+                finished = stats["ok"] + stats["error"]
+            if progress is not None:
+                progress(finished, len(pending), record)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, name=f"batch-worker-{i}", daemon=True)
+               for i in range(max(1, min(workers, len(pending) or 1)))]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        # 処理中の質問は最後まで実行して書き出し、残りは次回の再実行に回す
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        writer.close()
+    wall = time.perf_counter() - started
+    latencies = stats["latencies"]
+    finished = stats["ok"] + stats["error"]
+    return {
+        "questions": len(questions),
+        "skipped": len(questions) - len(pending),
+        "processed": finished,
+        "ok": stats["ok"],
+        "errors": stats["error"],
+        "retried": stats["retried"],
+        "interrupted": stop.is_set(),
+        "workers": workers,
+        "wall_sec": round(wall, 3),
+        "throughput_per_sec": round(finished / wall, 3) if wall and finished else None,
+        "p50_ms": round(_percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+        "p95_ms": round(_percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+        "llm_calls": limited.calls,
+        "rate_limited": limited.rate_limited,
+        "rate_limit_wait_sec": round(limited.waited, 3),
+    }
+
+
+# ==========================================
+# 計測（擬似LLMで同時実行数ごとのスループット）
+# ==========================================
+
+class _RateLimitError(Exception):
+    """擬似LLMが返す 429（openai.RateLimitError の代わり）。"""
+
+    status_code = 429
+
+
+def _flaky_client(client, fail_rate, seed=0):
+    """fail_rate の割合で 429 を返す擬似LLM（リトライの動作確認用）。"""
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+    create = client.chat.completions.create
+
+    def flaky_create(**kwargs):
+        with rng_lock:
+            fail = rng.random() < fail_rate
+        if fail:
+            raise _RateLimitError("Rate limit reached (擬似)")
+        return create(**kwargs)
+
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=flaky_create)))
+
+
+def bench(workers=(1, 4, 8, 16), count=64, latency=0.3, rpm=0, tpm=0, fail_rate=0.0):
+    """
+    benchmark.py の質問例（txt2sql と mark_db）を count 問になるまで繰り返し、同時実行数ごとに処理する。
+    キャッシュは使わない（毎回すべてのフェーズを実行する）。
+    """
+    from benchmark import BENCH_DATE, CORPUS, fake_client
+
+    corpus = [(name, question) for name in ("txt2sql", "mark_db") for question in CORPUS[name]]
+    questions = [{"id": str(i + 1), "question": corpus[i % len(corpus)][1], "pipeline": corpus[i % len(corpus)][0],
+                  "date": BENCH_DATE} for i in range(count)]
+    client = fake_client(latency)
+    if fail_rate:
+        client = _flaky_client(client, fail_rate)
+    report = {"count": count, "latency_sec": latency, "rpm": rpm, "tpm": tpm, "fail_rate": fail_rate, "levels": {}}
+    with tempfile.TemporaryDirectory(prefix="batch-bench-") as directory:
+        for level in workers:
+            out_path = os.path.join(directory, f"workers-{level}.jsonl")
+            report["levels"][str(level)] = run_batch(client, questions, out_path, workers=level, rpm=rpm, tpm=tpm,
+                                                     use_cache=False, backoff=0.05)
+    return report
+
+
+def print_summary(summary):
+    print(f"  {summary['workers']} ワーカー: {summary['processed']} 件（成功 {summary['ok']} / エラー {summary['errors']}"
+          f" / やり直し {summary['retried']} / 再開で省略 {summary['skipped']}）"
+          f" {summary['wall_sec']}秒 / {summary['throughput_per_sec']} 件/秒"
+          f" / p50 {summary['p50_ms']}ms p95 {summary['p95_ms']}ms")
+    print(f"    LLM呼び出し {summary['llm_calls']} 回 / 429 {summary['rate_limited']} 回"
+          f" / レート制限の待ち（全ワーカーの合計） {summary['rate_limit_wait_sec']}秒")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="質問の一括実行（text-to-SQL）")
+    parser.add_argument("command", choices=["run", "bench"])
+    parser.add_argument("input", nargs="?", help="質問一覧（.jsonl / .csv）。run で指定する")
+    parser.add_argument("--out", help="結果の JSONL（既定は <入力ファイル名>.results.jsonl）。再実行すると続きから処理する")
+    parser.add_argument("--pipeline", choices=["txt2sql", "mark_db"], help="pipeline 列が無い質問の処理先（既定は txt2sql）")
+    parser.add_argument("--date", help="mark_db の基準日（YYYY-MM-DD。既定は今日）")
+    parser.add_argument("--workers", nargs="+", type=int,
+                        help=f"同時に処理する質問数（既定は {DEFAULT_WORKERS}。bench では複数指定可、既定は 1 4 8 16）")
+    parser.add_argument("--rpm", type=float, default=DEFAULT_RPM, help="毎分のリクエスト数の上限（0 は制限なし）")
+    parser.add_argument("--tpm", type=float, default=DEFAULT_TPM, help="毎分のトークン数の上限（0 は制限なし）")
+    parser.add_argument("--retries", type=int, default=MAX_RETRIES, help="一時的なエラーでやり直す回数")
+    parser.add_argument("--no-cache", action="store_true", help="SQL・実行結果・回答のキャッシュを使わない")
+    parser.add_argument("--count", type=int, default=64, help="bench: 処理する質問数")
+    parser.add_argument("--latency", type=float, default=0.3, help="bench: 擬似LLMの1回あたりの遅延（秒）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="bench: 擬似LLMが 429 を返す割合")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.command == "bench":
+        report = bench(args.workers or [1, 4, 8, 16], args.count, args.latency, args.rpm, args.tpm, args.fail_rate)
+        if args.json:
+            print(json.dumps(report, ensure_ascii=False, indent=2))
+            return 0
+        print(f"== {report['count']} 問 / 擬似LLMの遅延 {args.latency}秒/回"
+              f" / rpm {args.rpm or '制限なし'} / tpm {args.tpm or '制限なし'} / 429 の割合 {args.fail_rate}")
+        for summary in report["levels"].values():
+            print_summary(summary)
+        return 0
+
+    if not args.input:
+        parser.error("run では質問一覧のファイルを指定してください。")
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        print("環境変数 OPENAI_API_KEY が設定されていません。", file=sys.stderr)
+        return 1
+    from openai_client import get_openai_client
+
+    client = get_openai_client(api_key)
+    # やり直しはここで行うため、SDK 側のリトライは止める（429 の待ちを全ワーカーで共有するため）
+    if hasattr(client, "with_options"):
+        client = client.with_options(max_retries=0)
+    questions = read_questions(args.input, args.pipeline, args.date)
+    out_path = args.out or os.path.splitext(args.input)[0] + ".results.jsonl"
+
+    def progress(finished, total, record):
+        mark = "ok" if record["status"] == "ok" else f"エラー: {record['error_type']}"
+        print(f"[{finished}/{total}] {record['id']} {record['question'][:40]} ... {mark}", file=sys.stderr)
+
+    summary = run_batch(client, questions, out_path, workers=(args.workers or [DEFAULT_WORKERS])[0], rpm=args.rpm, tpm=args.tpm,
+                        use_cache=not args.no_cache, max_retries=args.retries, progress=progress)
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    else:
+        print(f"== {args.input} → {out_path}{'（中断しました。再実行すると続きから処理します）' if summary['interrupted'] else ''}")
+        print_summary(summary)
+    return 0 if summary["errors"] == 0 and not summary["interrupted"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,319 @@
+# オフラインのエンドツーエンド・ベンチマーク
+# txt2sql / mark_db / main の処理を画面なしで実行し、OpenAI / Azure の代わりに擬似LLM（fake_llm.py）を使う。
+# 擬似LLMは質問ごとに用意したSQLを返し、1回の呼び出しで指定した秒数だけ待つ。DBは本物の Chinook.db / marketing.db。
+# フェーズごとの所要時間（p50/p95/p99）、同時セッション数ごとのスループット、ピークメモリを計測して JSON に保存する。
+#
+# 使い方:
+#   python benchmark.py                                   # 全パイプラインを計測し .cache/benchmark/ に保存
+#   python benchmark.py --pipelines txt2sql --sessions 1 4 16 --latency 0.2
+#   python benchmark.py --warm                            # キャッシュを使う（同じ質問の2回目以降）
+#   python benchmark.py --compare .cache/benchmark/20250101-120000.json   # 前回より遅くなったフェーズを表示
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.join(".cache", "benchmark")
+
+# キャッシュとワークロードの記録はベンチマーク専用のファイルに書く（画面で使うキャッシュを汚さない）
+os.environ.setdefault("SQL_CACHE_PATH", os.path.join(BENCH_DIR, "llm_cache.db"))
+os.environ.setdefault("EMBEDDING_CACHE_PATH", os.path.join(BENCH_DIR, "embedding_cache.db"))
+os.environ.setdefault("WORKLOAD_LOG_PATH", os.path.join(BENCH_DIR, "workload.db"))
+os.environ.setdefault("TRACE_LOG_PATH", os.path.join(BENCH_DIR, "traces.jsonl"))
+os.environ.setdefault("METRICS_PATH", os.path.join(BENCH_DIR, "metrics.prom"))
+
+import rag  # noqa: E402
+from fake_llm import FakeLLM, fake_embedding  # noqa: E402
+from parquet_backend import PARITY_QUERIES  # noqa: E402
+from pipeline import PIPELINES, marketing_context  # noqa: E402
+from schema_prompt import introspect, render_table  # noqa: E402
+
+# mark_db の「先月」などの基準日（marketing.db のデータは 2023-12 〜 2025-11）
+BENCH_DATE = "2025-11-15"
+
+# 画面の質問例（txt2sql は parquet の一致確認用の質問も含める）と、擬似LLMが返すSQL
+CORPUS = {
+    "txt2sql": dict(PARITY_QUERIES),
+    "mark_db": {
+        "先月のGoogle広告のCPAはいくら？":
+            "SELECT SUM(cost) / NULLIF(SUM(conversions), 0) AS cpa FROM AdPerformance "
+            "WHERE media_type = 'Google' AND date BETWEEN '2025-10-01' AND '2025-10-31'",
+        "媒体ごとの獲得件数を比較して":
+            "SELECT media_type, SUM(conversions) AS conversions FROM AdPerformance "
+            "GROUP BY media_type ORDER BY conversions DESC",
+        "キャンペーンAからの予約数は？":
+            "SELECT SUM(y_yoyaku) AS reservations FROM CustomerAcquisition WHERE utm_campaign = 'campaignA'",
+        "先月の媒体別CPAを教えて":
+            "SELECT media_type, SUM(cost) / NULLIF(SUM(conversions), 0) AS cpa FROM AdPerformance "
+            "WHERE date BETWEEN '2025-10-01' AND '2025-10-31' GROUP BY media_type",
+    },
+}
+# main.py の画面には質問例が無いため、同じ広告データを扱う mark_db の質問例を使う
+CORPUS["main"] = {question: None for question in CORPUS["mark_db"]}
+
+# 擬似LLMが返す回答（長さはストリーミングしない回答のトークン数の目安）
+FAKE_ANSWER = "データによると、" + "該当する結果は上の表のとおりです。" * 8
+
+EMBEDDING_MODEL = "bench-embedding"
+EMBEDDING_DIMENSIONS = 1536
+
+PHASES = {
+    "txt2sql": ["schema", "generate_sql", "execute_sql", "answer", "total"],
+    "mark_db": ["schema", "generate_sql", "execute_sql", "answer", "total"],
+    "main": ["embed", "retrieve", "answer", "total"],
+}
+
+
+def fake_client(latency=0.3):
+    """ユーザーの質問そのものが来たら用意したSQLを、それ以外（回答生成）には FAKE_ANSWER を返す擬似LLM。"""
+    sql_by_question = {q: sql for corpus in CORPUS.values() for q, sql in corpus.items() if sql}
+
+    def respond(messages):
+        user = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+        return sql_by_question.get(user.strip(), FAKE_ANSWER)
+
+    return FakeLLM(default=respond, latency=latency, dimensions=EMBEDDING_DIMENSIONS)
+
+
+class _ListIndex:
+    """numpy が無い環境用の総当たりのベクトル検索（LocalVectorIndex.search と同じ戻り値）。"""
+
+    def __init__(self, ids, contents, vectors):
+        self.ids = ids
+        self.contents = contents
+        self.vectors = [self._normalize(v) for v in vectors]
+
+    @staticmethod
+    def _normalize(vector):
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def search(self, vector, k=3):
+        query = self._normalize(vector)
+        scores = [sum(a * b for a, b in zip(query, row)) for row in self.vectors]
+        order = sorted(range(len(scores)), key=lambda i: -scores[i])[:k]
+        return [{"id": self.ids[i], "content": self.contents[i], "@search.score": scores[i]} for i in order]
+
+
+def rag_index():
+    """main.py の検索対象の代わりに、両DBのテーブル定義を1テーブル1文書として索引にする。"""
+    import sqlite3
+
+    ids, contents = [], []
+    for db_path in ("Chinook.db", "marketing.db"):
+        with sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True) as conn:
+            for name, info in introspect(conn).items():
+                ids.append(f"{os.path.basename(db_path)}:{name}")
+                contents.append(render_table(name, info))
+    vectors = [fake_embedding(content, EMBEDDING_DIMENSIONS) for content in contents]
+    try:
+        from vector_index import LocalVectorIndex
+
+        return LocalVectorIndex.from_vectors(ids, contents, vectors)
+    except RuntimeError:
+        return _ListIndex(ids, contents, vectors)
+
+
+def percentile(values, q):
+    """最近傍順位法の百分位数。"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def summarize(values):
+    values_ms = [v * 1000 for v in values]
+    return {
+        "count": len(values_ms),
+        "p50_ms": round(percentile(values_ms, 0.50), 3),
+        "p95_ms": round(percentile(values_ms, 0.95), 3),
+        "p99_ms": round(percentile(values_ms, 0.99), 3),
+        "mean_ms": round(sum(values_ms) / len(values_ms), 3),
+        "max_ms": round(max(values_ms), 3),
+    }
+
+
+def turn_runner(name, client, use_cache=True, parallel=False, index=None):
+    """質問1つを処理してフェーズごとの所要時間（秒）を返す関数。"""
+    if name == "main":
+        index = index or rag_index()
+
+        def run(question):
+            _, trace = rag.run(question, client, client, EMBEDDING_MODEL, local_index=index, use_cache=use_cache)
+            return trace.timings
+
+        return run
+
+    pipeline = PIPELINES[name]
+    context = marketing_context(BENCH_DATE) if name == "mark_db" else {}
+
+    def run(question):
+        return pipeline.run(client, question, parallel=parallel, use_cache=use_cache, **context).timings
+
+    return run
+
+
+def run_sessions(run, questions, sessions, iterations):
+    """
+    sessions 個のセッション（スレッド）がそれぞれ質問を iterations 周処理する。
+    フェーズごとの所要時間・エラー・経過時間を返す。
+    """
+    samples = {}
+    errors = []
+    lock = threading.Lock()
+
+    def session(_):
+        for _ in range(iterations):
+            for question in questions:
+                try:
+                    timings = run(question)
+                except Exception as e:
+                    with lock:
+                        errors.append(f"{question}: {e}")
+                    continue
+                with lock:
+                    for phase, seconds in timings.items():
+                        samples.setdefault(phase, []).append(seconds)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions, thread_name_prefix="bench-session") as executor:
+        list(executor.map(session, range(sessions)))
+    return samples, errors, time.perf_counter() - started
+
+
+def peak_memory(run, questions, sessions):
+    """tracemalloc で計測した、sessions 個のセッションで1周したときの Python のメモリ確保量のピーク。"""
+    tracemalloc.start()
+    try:
+        run_sessions(run, questions, sessions, 1)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def bench(pipelines=("txt2sql", "mark_db", "main"), sessions=(1, 4, 8), iterations=3, latency=0.3,
+          use_cache=False, parallel=False, client=None):
+    client = client or fake_client(latency)
+    report = {
+        "meta": {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "latency_sec": latency,
+            "iterations": iterations,
+            "sessions": list(sessions),
+            "use_cache": use_cache,
+            "parallel": parallel,
+        },
+        "pipelines": {},
+    }
+    index = rag_index() if "main" in pipelines else None
+    for name in pipelines:
+        questions = list(CORPUS[name])
+        run = turn_runner(name, client, use_cache, parallel, index)
+        # 1周目はスキーマの読み込みやDBのページキャッシュの影響が大きいため、計測から外す
+        run_sessions(run, questions, 1, 1)
+        result = {"questions": len(questions), "sessions": {}}
+        for count in sessions:
+            samples, errors, wall = run_sessions(run, questions, count, iterations)
+            turns = len(samples.get("total", []))
+            result["sessions"][str(count)] = {
+                "turns": turns,
+                "errors": errors,
+                "wall_sec": round(wall, 3),
+                "throughput_per_sec": round(turns / wall, 3) if wall else None,
+                "phases": {phase: summarize(samples[phase]) for phase in PHASES[name] if samples.get(phase)},
+            }
+        result["peak_traced_bytes"] = peak_memory(run, questions, max(sessions))
+        report["pipelines"][name] = result
+    # プロセス全体の最大常駐メモリ（Linux では KiB 単位）
+    report["meta"]["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return report
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline, threshold=0.2):
+    """baseline より p95 が threshold（割合）以上遅くなったフェーズと、スループットの低下を返す。"""
+    regressions = []
+    for name, result in report["pipelines"].items():
+        for count, current in result["sessions"].items():
+            previous = baseline.get("pipelines", {}).get(name, {}).get("sessions", {}).get(count)
+            if previous is None:
+                continue
+            for phase, stats in current["phases"].items():
+                before = previous["phases"].get(phase)
+                if before and before["p95_ms"] > 0 and stats["p95_ms"] > before["p95_ms"] * (1 + threshold):
+                    regressions.append(
+                        f"{name} / {count}セッション / {phase}: p95 {before['p95_ms']}ms → {stats['p95_ms']}ms"
+                    )
+            before, after = previous.get("throughput_per_sec"), current.get("throughput_per_sec")
+            if before and after and after < before * (1 - threshold):
+                regressions.append(f"{name} / {count}セッション: スループット {before}/秒 → {after}/秒")
+    return regressions
+
+
+def print_report(report):
+    for name, result in report["pipelines"].items():
+        print(f"== {name}（質問 {result['questions']}件 / ピークメモリ {result['peak_traced_bytes'] / 1024 / 1024:.1f}MiB）")
+        for count, item in result["sessions"].items():
+            print(f"  {count}セッション: {item['turns']}件 / {item['throughput_per_sec']}件/秒 / エラー {len(item['errors'])}件")
+            for phase, stats in item["phases"].items():
+                print(f"    {phase:<12} p50 {stats['p50_ms']:>9.2f}ms  p95 {stats['p95_ms']:>9.2f}ms  p99 {stats['p99_ms']:>9.2f}ms")
+    print(f"最大常駐メモリ {report['meta']['max_rss_kb'] / 1024:.1f}MiB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="擬似LLMによるオフラインのエンドツーエンド・ベンチマーク")
+    parser.add_argument("--pipelines", nargs="+", choices=list(CORPUS), default=list(CORPUS))
+    parser.add_argument("--sessions", nargs="+", type=int, default=[1, 4, 8], help="同時セッション数（複数指定可）")
+    parser.add_argument("--iterations", type=int, default=3, help="1セッションが質問を処理する周回数")
+    parser.add_argument("--latency", type=float, default=0.3, help="擬似LLMの1回あたりの遅延（秒）")
+    parser.add_argument("--warm", action="store_true", help="SQL・実行結果・回答・埋め込みのキャッシュを使う")
+    parser.add_argument("--parallel", action="store_true", help="SQL候補の並列生成（sql_candidates.py）を使う")
+    parser.add_argument("--out", help="結果の JSON の保存先（既定は .cache/benchmark/<日時>.json）")
+    parser.add_argument("--compare", help="比較する過去の結果の JSON")
+    parser.add_argument("--threshold", type=float, default=0.2, help="--compare で遅くなったとみなす割合")
+    args = parser.parse_args(argv)
+
+    report = bench(args.pipelines, args.sessions, args.iterations, args.latency,
+                   use_cache=args.warm, parallel=args.parallel)
+    print_report(report)
+
+    out = args.out or os.path.join(BENCH_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    if os.path.dirname(out):
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果を {out} に保存しました")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print("遅くなった項目:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("遅くなった項目はありません")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
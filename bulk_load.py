@@ -0,0 +1,509 @@
+# オフラインの一括ロード
+# create_db.py は Chinook_Sqlite.sql を HTTP で取得し、executescript で INSERT 文を1つずつ実行していた
+# （ネットワークが必要で、1行ごとに文を解釈し、インデックスも作成済みの状態で行を入れていた）。
+# ここでは parquet/（または CSV）のファイルから SQLite のDBを作り直す。
+#   - スキーマ（schemas/<DB名>.sql）の CREATE TABLE だけを先に実行し、インデックスはデータを入れた後に作る
+#   - 1つのトランザクション内でバッチごとに executemany を実行する（ロード中は journal_mode=OFF などに設定）
+#   - 一時ファイルに作ってから置き換えるため、途中で失敗しても元のDBは壊れない
+#   - ロード後に元データと行数・チェックサムを照合し、テーブルごとの rows/sec を表示する
+# ソースは1テーブル1ファイル（<テーブル名>.parquet または <テーブル名>.csv）。parquet は DuckDB で読む。
+#
+# 使い方:
+#   python bulk_load.py load Chinook.db                               # parquet/ から Chinook.db を作り直す
+#   python bulk_load.py load marketing.db --source data/marketing --migrate
+#   python bulk_load.py load Chinook.db --wal                         # 作り直したDBを WAL モードにする（本番用）
+#   python bulk_load.py load /tmp/Chinook.db --schema schemas/Chinook.sql --naive   # 比較用の1行ずつの INSERT
+#   python bulk_load.py schema marketing.db                           # schemas/marketing.sql を書き出す
+#   python bulk_load.py export marketing.db data/marketing            # テーブルを CSV に書き出す（ソースの作成用）
+import argparse
+import csv
+import glob
+import hashlib
+import itertools
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import time
+from datetime import date, datetime
+from decimal import Decimal
+
+from db_pool import enable_wal
+from index_advisor import apply_migrations
+from parquet_backend import PARQUET_DIR
+from rollups import ROLLUPS
+from schema_prompt import INTERNAL_TABLES
+
+SCHEMAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schemas")
+
+# DB名（拡張子を除いたファイル名）ごとの既定のソース
+SOURCE_DIRS = {
+    "Chinook": PARQUET_DIR,
+    "marketing": os.environ.get("MARKETING_SOURCE_DIR", os.path.join("data", "marketing")),
+}
+
+# executemany に渡す1回あたりの行数
+BATCH_SIZE = int(os.environ.get("BULK_LOAD_BATCH_SIZE", "5000"))
+
+# ロード中だけ使う設定（一時ファイルに作るため、ジャーナルと fsync を省いても元のDBには影響しない）
+LOAD_PRAGMAS = [
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA locking_mode = EXCLUSIVE",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -262144",  # 256MB（インデックス作成時のソートに使う）
+    "PRAGMA foreign_keys = OFF",
+]
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _stem(db_path):
+    return os.path.splitext(os.path.basename(db_path))[0]
+
+
+# ==========================================
+# 1. ソースの読み込み
+# ==========================================
+
+def source_files(directory):
+    """ディレクトリ内の <テーブル名>.parquet / <テーブル名>.csv（テーブル名 → パス）。"""
+    files = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.parquet")) + glob.glob(os.path.join(directory, "*.csv"))):
+        table = os.path.splitext(os.path.basename(path))[0]
+        if table in files:
+            raise ValueError(f"テーブル {table} のソースが複数あります: {files[table]}, {path}")
+        files[table] = path
+    return files
+
+
+def _to_sqlite(value):
+    """DuckDB が返す値を SQLite に入れられる型にする（日時は Chinook_Sqlite.sql と同じ書式の文字列）。"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.isoformat(" ")
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def read_source(path, batch_size=BATCH_SIZE):
+    """(列名のリスト, 行のリストを順に返すイテレーター)。parquet は DuckDB、CSV は csv モジュールで読む。"""
+    if path.endswith(".parquet"):
+        import duckdb
+
+        conn = duckdb.connect()
+        cursor = conn.execute("SELECT * FROM read_parquet(?)", [path])
+        columns = [d[0] for d in cursor.description]
+
+        def parquet_batches():
+            try:
+                while rows := cursor.fetchmany(batch_size):
+                    yield [tuple(_to_sqlite(v) for v in row) for row in rows]
+            finally:
+                conn.close()
+
+        return columns, parquet_batches()
+
+    f = open(path, newline="", encoding="utf-8")
+    reader = csv.reader(f)
+    columns = next(reader, None)
+    if not columns:
+        f.close()
+        raise ValueError(f"{path} にヘッダー行がありません")
+
+    def csv_batches():
+        with f:
+            # 空欄は NULL として扱う（export と対になる）
+            while rows := [tuple(v if v != "" else None for v in row) for row in itertools.islice(reader, batch_size)]:
+                yield rows
+
+    return columns, csv_batches()
+
+
+# ==========================================
+# 2. チェックサム
+# ==========================================
+
+def _canonical(value):
+    """元データとDBで表現が変わっても同じになるように値を文字列にする（数値は 15 桁に丸める）。"""
+    if value is None:
+        return "\x00"
+    if isinstance(value, bytes):
+        return value.hex()
+    if isinstance(value, (int, float)):
+        return f"{float(value):.15g}"
+    try:
+        # CSV の数値や、型の親和性で数値になる文字列も数値として比較する
+        return f"{float(value):.15g}"
+    except ValueError:
+        return value
+
+
+def row_hash(row):
+    digest = hashlib.sha256("\x1f".join(map(_canonical, row)).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+class Checksum:
+    """行の並び順に依存しないチェックサム（行ごとのハッシュの和）。重複行も区別する。"""
+
+    def __init__(self):
+        self.rows = 0
+        self.value = 0
+
+    def update(self, rows):
+        for row in rows:
+            self.value = (self.value + row_hash(row)) & 0xFFFFFFFFFFFFFFFF
+        self.rows += len(rows)
+
+    def hexdigest(self):
+        return f"{self.value:016x}"
+
+
+def table_checksum(conn, table, columns):
+    checksum = Checksum()
+    cursor = conn.execute(f"SELECT {', '.join(map(_quote, columns))} FROM {_quote(table)}")
+    while rows := cursor.fetchmany(BATCH_SIZE):
+        checksum.update(rows)
+    return checksum
+
+
+# ==========================================
+# 3. スキーマ
+# ==========================================
+
+def schema_path(db_path):
+    return os.path.join(SCHEMAS_DIR, _stem(db_path) + ".sql")
+
+
+def split_statements(script):
+    """SQLスクリプトを文ごとに分ける（コメント行は除く）。"""
+    statements, buffer = [], ""
+    for line in script.splitlines(keepends=True):
+        if not buffer and line.strip().startswith("--"):
+            continue
+        buffer += line
+        if sqlite3.complete_statement(buffer):
+            statements.append(buffer.strip().rstrip(";").strip())
+            buffer = ""
+    if buffer.strip():
+        statements.append(buffer.strip())
+    return statements
+
+
+def load_schema(path):
+    """(CREATE TABLE 文のリスト, データを入れた後に実行する文（インデックスなど）のリスト)"""
+    with open(path, encoding="utf-8") as f:
+        statements = split_statements(f.read())
+    tables = [s for s in statements if s.upper().startswith("CREATE TABLE")]
+    rest = [s for s in statements if not s.upper().startswith("CREATE TABLE")]
+    return tables, rest
+
+
+def infer_table(table, columns, rows):
+    """スキーマが無い場合に、先頭のバッチの値から列の型を決めて CREATE TABLE 文を作る。"""
+    def column_type(index):
+        kinds = set()
+        for row in rows:
+            value = row[index]
+            if value is None:
+                continue
+            if isinstance(value, str):
+                try:
+                    value = int(value)
+                except ValueError:
+                    try:
+                        value = float(value)
+                    except ValueError:
+                        pass
+            kinds.add("INTEGER" if isinstance(value, int) else "REAL" if isinstance(value, float) else
+                      "BLOB" if isinstance(value, bytes) else "TEXT")
+        if kinds == {"INTEGER"}:
+            return "INTEGER"
+        if kinds and kinds <= {"INTEGER", "REAL"}:
+            return "REAL"
+        return "TEXT" if kinds == {"TEXT"} or not kinds else ""
+
+    definitions = ",\n  ".join(f"{_quote(c)} {column_type(i)}".rstrip() for i, c in enumerate(columns))
+    return f"CREATE TABLE {_quote(table)} (\n  {definitions}\n)"
+
+
+# マイグレーションで作られるテーブル・インデックスの名前
+_CREATED_NAME = re.compile(r'CREATE\s+(?:UNIQUE\s+)?(?:TABLE|INDEX)\s+(?:IF\s+NOT\s+EXISTS\s+)?"?(\w+)"?', re.I)
+
+
+def dump_schema(db_path):
+    """既存のDBから、ロードに使うスキーマ（テーブルとインデックス）を取り出す。
+    マイグレーションで作るもの（ロールアップ、schema_migrations）は含めない。"""
+    skip = INTERNAL_TABLES | {r.name for r in ROLLUPS}
+    for migration in glob.glob(os.path.join(os.path.dirname(SCHEMAS_DIR), "migrations", _stem(db_path), "*.sql")):
+        with open(migration, encoding="utf-8") as f:
+            skip.update(_CREATED_NAME.findall(f.read()))
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+        rows = conn.execute(
+            "SELECT name, tbl_name, sql FROM sqlite_master "
+            "WHERE type IN ('table', 'index') AND sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+            "ORDER BY type = 'index', rowid"
+        ).fetchall()
+    lines = [f"-- generated by bulk_load.py from {os.path.basename(db_path)} ({datetime.now():%Y-%m-%d})"]
+    for name, table, sql in rows:
+        if name in skip or table in skip:
+            continue
+        lines.append(sql.strip() + ";")
+    return "\n".join(lines) + "\n"
+
+
+# ==========================================
+# 4. ロード
+# ==========================================
+
+def _build_path(target):
+    """一時的に作るDBのパス。migrations/<DB名>/ を適用できるよう、ファイル名は変えずに隠しディレクトリに置く。"""
+    directory = os.path.join(os.path.dirname(os.path.abspath(target)), f".{os.path.basename(target)}.loading")
+    return directory, os.path.join(directory, os.path.basename(target))
+
+
+def _insert_batches(conn, table, columns, batches, checksum, naive):
+    statement = (
+        f"INSERT INTO {_quote(table)} ({', '.join(map(_quote, columns))}) "
+        f"VALUES ({', '.join('?' for _ in columns)})"
+    )
+    rows = 0
+    for batch in batches:
+        if checksum is not None:
+            checksum.update(batch)
+        if naive:
+            # 比較用: executescript と同じく1行ずつ実行して確定する
+            for row in batch:
+                conn.execute(statement, row)
+                conn.commit()
+        else:
+            conn.executemany(statement, batch)
+        rows += len(batch)
+    return rows
+
+
+def load(target, source_dir, schema=None, migrate=False, verify=True, naive=False, batch_size=BATCH_SIZE):
+    """
+    source_dir のファイルから target を作り直し、テーブルごとの件数・時間・照合結果を返す。
+    schema（CREATE TABLE / CREATE INDEX のSQLファイル）が無い場合は、列の型を値から決める。
+    naive=True はインデックスを先に作り、既定の設定のまま1行ずつ INSERT する（比較用）。
+    """
+    sources = source_files(source_dir)
+    if not sources:
+        raise ValueError(f"{source_dir} に parquet / CSV のファイルがありません")
+    table_statements, after_statements = load_schema(schema) if schema else ([], [])
+
+    build_dir, build_path = _build_path(target)
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+    report = {"target": target, "source": source_dir, "schema": schema, "mode": "naive" if naive else "bulk",
+              "batch_size": batch_size, "tables": {}}
+    checksums = {}
+    started = time.perf_counter()
+    try:
+        conn = sqlite3.connect(build_path, isolation_level=None)
+        try:
+            if not naive:
+                for pragma in LOAD_PRAGMAS:
+                    conn.execute(pragma)
+            for statement in table_statements + (after_statements if naive else []):
+                conn.execute(statement)
+            known = {
+                name.lower(): name
+                for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            }
+            if table_statements:
+                missing = sorted(name for name in sources if name.lower() not in known)
+                if missing:
+                    raise ValueError(f"スキーマに無いテーブルのソースがあります: {', '.join(missing)}")
+
+            if not naive:
+                conn.execute("BEGIN")
+            for source_table, path in sources.items():
+                table_started = time.perf_counter()
+                columns, batches = read_source(path, batch_size)
+                table = known.get(source_table.lower())
+                if table is None:
+                    first = next(batches, [])
+                    table = source_table
+                    conn.execute(infer_table(table, columns, first))
+                    batches = itertools.chain([first] if first else [], batches)
+                checksum = Checksum() if verify else None
+                rows = _insert_batches(conn, table, columns, batches, checksum, naive)
+                seconds = time.perf_counter() - table_started
+                report["tables"][table] = {
+                    "rows": rows,
+                    "seconds": round(seconds, 4),
+                    "rows_per_sec": round(rows / seconds) if seconds > 0 else None,
+                }
+                if checksum is not None:
+                    checksums[table] = (columns, checksum)
+            if not naive:
+                conn.execute("COMMIT")
+            load_seconds = time.perf_counter() - started
+
+            # インデックスはデータを入れ終わってから作る（1件ずつ木に追加するより、まとめてソートする方が速い）
+            index_started = time.perf_counter()
+            if not naive:
+                conn.execute("BEGIN")
+                for statement in after_statements:
+                    conn.execute(statement)
+                conn.execute("COMMIT")
+            conn.execute("ANALYZE")
+            report["index_seconds"] = round(time.perf_counter() - index_started, 4)
+            report["foreign_key_violations"] = len(conn.execute("PRAGMA foreign_key_check").fetchall())
+        finally:
+            conn.close()
+
+        if migrate:
+            report["migrations"] = apply_migrations(build_path)
+
+        if verify:
+            report["verified"] = verify_load(build_path, checksums, report["tables"])
+        if verify and not report["verified"]:
+            raise RuntimeError("ロードしたDBが元データと一致しません: " + json.dumps(report["tables"], ensure_ascii=False))
+
+        _replace(build_path, target)
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    rows = sum(item["rows"] for item in report["tables"].values())
+    report["rows"] = rows
+    report["load_seconds"] = round(load_seconds, 4)
+    report["total_seconds"] = round(time.perf_counter() - started, 4)
+    report["rows_per_sec"] = round(rows / load_seconds) if load_seconds > 0 else None
+    return report
+
+
+def verify_load(db_path, checksums, tables):
+    """ロードしたDBの行数・チェックサムを元データと照合し、tables に結果を書き込む。"""
+    ok = True
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+        for table, (columns, source) in checksums.items():
+            loaded = table_checksum(conn, table, columns)
+            item = tables[table]
+            item["checksum"] = source.hexdigest()
+            item["verified"] = loaded.rows == source.rows and loaded.value == source.value
+            if not item["verified"]:
+                item["loaded_rows"] = loaded.rows
+                item["loaded_checksum"] = loaded.hexdigest()
+                ok = False
+    return ok
+
+
+def _replace(build_path, target):
+    """作成したDBで target を置き換える（WAL が残っていると古い内容が重ねられるため、先に反映して空にする）。"""
+    if os.path.exists(target + "-wal"):
+        with sqlite3.connect(target) as conn:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    os.replace(build_path, target)
+
+
+# ==========================================
+# 5. 書き出し（CSV のソース作成用）
+# ==========================================
+
+def export(db_path, out_dir, tables=None):
+    """DBのテーブルを <テーブル名>.csv に書き出す（NULL は空欄）。書き出した行数を返す。"""
+    os.makedirs(out_dir, exist_ok=True)
+    skip = INTERNAL_TABLES | {r.name for r in ROLLUPS}
+    counts = {}
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+        names = [name for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        ) if name not in skip and (not tables or name in tables)]
+        for name in names:
+            cursor = conn.execute(f"SELECT * FROM {_quote(name)}")
+            with open(os.path.join(out_dir, name + ".csv"), "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerow([d[0] for d in cursor.description])
+                count = 0
+                while rows := cursor.fetchmany(BATCH_SIZE):
+                    writer.writerows(rows)
+                    count += len(rows)
+            counts[name] = count
+    return counts
+
+
+# ==========================================
+# 6. コマンドライン
+# ==========================================
+
+def print_report(report):
+    print(f"{report['target']} を {report['source']} から作成しました（{report['mode']}）")
+    for table, item in report["tables"].items():
+        status = {True: "一致", False: "不一致"}.get(item.get("verified"), "未照合")
+        rate = f"{item['rows_per_sec']:,} rows/s" if item["rows_per_sec"] else "-"
+        print(f"  {table:<28} {item['rows']:>9,} 行  {item['seconds']:>8.3f}秒  {rate:>16}  [{status}]")
+    print(f"  合計 {report['rows']:,} 行: ロード {report['load_seconds']:.3f}秒（{report['rows_per_sec'] or 0:,} rows/s）"
+          f" / インデックス作成 {report['index_seconds']:.3f}秒 / 全体 {report['total_seconds']:.3f}秒")
+    if report["foreign_key_violations"]:
+        print(f"  外部キー制約に違反する行: {report['foreign_key_violations']}")
+    if report.get("migrations"):
+        print("  適用したマイグレーション: " + ", ".join(report["migrations"]))
+    if "wal" in report:
+        print("  WAL モード: " + ("有効" if report["wal"] else "切り替えられませんでした"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="parquet / CSV から SQLite のDBを一括で作成する")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("load")
+    p.add_argument("target", help="作成するDB（既にあれば置き換える）")
+    p.add_argument("--source", help="ソースのディレクトリ（既定: Chinook → parquet/, marketing → MARKETING_SOURCE_DIR）")
+    p.add_argument("--schema", help="スキーマのSQLファイル（既定: schemas/<DB名>.sql があれば使う）")
+    p.add_argument("--migrate", action="store_true", help="ロード後に migrations/<DB名>/ を適用する")
+    p.add_argument("--no-verify", action="store_true", help="行数・チェックサムの照合を省く")
+    p.add_argument("--naive", action="store_true", help="比較用: インデックスを先に作り1行ずつ INSERT する")
+    p.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    p.add_argument("--wal", action="store_true",
+                   help="ロード後にDBを WAL モードにする（書き込み中も読み取りを待たせない。設定はDBファイルに保存される）")
+    p.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    p = sub.add_parser("schema")
+    p.add_argument("db_path")
+    p.add_argument("--out", help="出力先（既定: schemas/<DB名>.sql）")
+    p = sub.add_parser("export")
+    p.add_argument("db_path")
+    p.add_argument("out_dir")
+    p.add_argument("--tables", nargs="+")
+    args = parser.parse_args(argv)
+
+    if args.command == "schema":
+        out = args.out or schema_path(args.db_path)
+        os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+        with open(out, "w", encoding="utf-8") as f:
+            f.write(dump_schema(args.db_path))
+        print(f"保存しました: {out}")
+        return 0
+
+    if args.command == "export":
+        for table, count in export(args.db_path, args.out_dir, args.tables).items():
+            print(f"{table}: {count:,} 行")
+        return 0
+
+    source = args.source or SOURCE_DIRS.get(_stem(args.target))
+    if not source:
+        parser.error("--source を指定してください")
+    schema = args.schema
+    if schema is None and os.path.exists(schema_path(args.target)):
+        schema = schema_path(args.target)
+    report = load(args.target, source, schema, migrate=args.migrate, verify=not args.no_verify,
+                  naive=args.naive, batch_size=args.batch_size)
+    if args.wal:
+        report["wal"] = enable_wal(args.target)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,6 @@
 # databaseを作成
 # https://kioku-space.com/langchain-text-to-sql/
+# ネットワークを使わずに parquet/ から作り直す場合は bulk_load.py を使う（python bulk_load.py load Chinook.db）
 import requests
 import sqlite3
 import pandas as pd
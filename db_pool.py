@@ -0,0 +1,247 @@
+# SQLite接続プール
+# Streamlitの全セッション（＝全スレッド）で共有するプロセス単位の接続プール。
+# 再実行（rerun）やボタン押下のたびに sqlite3.connect / close を繰り返さないようにする。
+import os
+import sqlite3
+import threading
+import time
+
+# 他の接続が書き込み中のときに待つミリ秒数（待たずに "database is locked" にしない）
+BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# ページ間で共有するDBファイルを、最初の読み取り時に WAL モードにする（SQLITE_WAL=1 で有効）
+# WAL への切り替えはDBファイルのヘッダーを書き換え、-wal / -shm ファイルも作るため、既定では行わない
+# （リポジトリのDBファイルを変更せず、読み取り専用のマウントでも mode=ro で開けるようにする）。
+# 本番のDBは `python bulk_load.py load <DB> --wal` で作り直すときに一度だけ WAL にする。
+WAL_ENABLED = os.environ.get("SQLITE_WAL", "0") == "1"
+
+# 接続作成時に実行するPRAGMA（ページ側で上書き可能）
+# foreign_keys は変更前と同じく SQLite の既定（OFF）のままにする。
+# ON にすると SQL Runner の DELETE/UPDATE が外部キー違反で失敗するようになるため。
+DEFAULT_PRAGMAS = {
+    "cache_size": -8000,   # 約8MB
+    "temp_store": "MEMORY",
+    "busy_timeout": BUSY_TIMEOUT_MS,
+}
+
+# ヘルスチェックを行うまでのアイドル秒数
+HEALTH_CHECK_INTERVAL = 30.0
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    """プールの上限に達し、待機時間内に接続を取得できなかった場合の例外"""
+
+
+class ConnectionPool:
+    """
+    スレッドごとに接続を貸し出すSQLite接続プール。
+    - 同じスレッドには前回使った接続を優先して貸し出す
+    - 同時に開く接続数は max_size まで（超えた場合は空きを待つ）
+    - 一定時間アイドルだった接続は貸し出し前に SELECT 1 で生存確認する
+    """
+
+    def __init__(self, db_path, max_size=8, timeout=10.0, pragmas=None, uri=False):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.pragmas = dict(DEFAULT_PRAGMAS if pragmas is None else pragmas)
+        self.uri = uri
+        self._cond = threading.Condition()
+        self._idle = []          # [(conn, 最終使用時刻)]
+        self._size = 0           # 開いている接続の総数
+        self._local = threading.local()
+        self._closed = False
+
+    # --- 接続の作成・確認 ---
+
+    def _connect(self):
+        # 接続はスレッド間で受け渡すため check_same_thread=False とし、
+        # 同時に2スレッドが使わないことはプール側で保証する。
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout,
+                               check_same_thread=False, uri=self.uri)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    def _is_healthy(self, conn, last_used):
+        if time.monotonic() - last_used < HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        self._size -= 1
+
+    # --- 貸し出し・返却 ---
+
+    def acquire(self):
+        """接続を1つ借りる。使い終わったら必ず release() で返却すること。"""
+        deadline = time.monotonic() + self.timeout
+        preferred = getattr(self._local, "conn", None)
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise sqlite3.ProgrammingError("接続プールは既に閉じられています。")
+                if self._idle:
+                    # 同じスレッドが前回使った接続があればそれを優先する
+                    index = len(self._idle) - 1
+                    for i, (conn, _) in enumerate(self._idle):
+                        if conn is preferred:
+                            index = i
+                            break
+                    conn, last_used = self._idle.pop(index)
+                    if self._is_healthy(conn, last_used):
+                        break
+                    self._discard(conn)
+                    continue
+                if self._size < self.max_size:
+                    # 接続作成中はロックを持たないよう、先に枠だけ確保する
+                    self._size += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(
+                        f"接続プールの上限（{self.max_size}）に達しています: {self.db_path}")
+                self._cond.wait(remaining)
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        self._local.conn = conn
+        return conn
+
+    def release(self, conn):
+        """借りた接続を返却する。未確定のトランザクションはロールバックする。"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            healthy = True
+        except sqlite3.Error:
+            healthy = False
+        with self._cond:
+            if self._closed or not healthy:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def connection(self):
+        """with 構文で使うためのコンテキストマネージャを返す。"""
+        return _PooledConnection(self)
+
+    def close(self):
+        """アイドル中の接続をすべて閉じる（貸し出し中の接続は返却時に閉じる）。"""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"open": self._size, "idle": len(self._idle), "max_size": self.max_size}
+
+
+class _PooledConnection:
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+
+    def __enter__(self):
+        self.conn = self.pool.acquire()
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        # sqlite3.connect の with 構文と同様、正常終了ならコミットする
+        try:
+            if exc_type is None and self.conn.in_transaction:
+                self.conn.commit()
+        finally:
+            self.pool.release(self.conn)
+        return False
+
+
+# --- プロセス全体で共有するプールの管理 ---
+
+_pools = {}
+_pools_lock = threading.Lock()
+_setup_done = set()
+_setup_lock = threading.Lock()
+
+
+def get_pool(db_path, **kwargs):
+    """
+    db_path ごとに1つのプールを返す（初回呼び出し時に作成）。
+    2回目以降の呼び出しで渡された kwargs は無視される。
+    """
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = ConnectionPool(db_path, **kwargs)
+            _pools[db_path] = pool
+        return pool
+
+
+def run_once(key, func, *args, **kwargs):
+    """
+    key ごとに func をプロセス内で一度だけ実行する（スキーマ初期化用）。
+    func が例外を投げた場合は未実行扱いとし、次回に再実行する。
+    """
+    if key in _setup_done:
+        return False
+    with _setup_lock:
+        if key in _setup_done:
+            return False
+        func(*args, **kwargs)
+        _setup_done.add(key)
+        return True
+
+
+def close_all():
+    """全プールを閉じる（テストやスクリプト終了時用）。"""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+# --- 共有するDBファイル（WAL・読み取り専用の接続） ---
+
+def enable_wal(db_path):
+    """
+    db_path を WAL モードにする（設定はDBファイルに保存される）。
+    WAL では書き込み中も読み取りが待たされず、読み取り中も書き込みを確定できる。
+    ファイルが無い・書き込めない場合は何もしない（False を返す）。
+    """
+    try:
+        with sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=rw", uri=True,
+                             timeout=BUSY_TIMEOUT_MS / 1000) as conn:
+            return conn.execute("PRAGMA journal_mode = WAL").fetchone()[0] == "wal"
+    except sqlite3.Error:
+        return False
+
+
+def get_readonly_pool(db_path):
+    """
+    読み取り専用（mode=ro）で開く接続プール（LLM が生成したSQLの実行用）。
+    SQLITE_WAL=1 の場合は初回に DB を WAL モードにしておき、sql_runner.py の書き込み中も待たずに読めるようにする。
+    """
+    path = os.path.abspath(db_path)
+    if WAL_ENABLED:
+        run_once(("wal", path), enable_wal, path)
+    return get_pool(f"file:{path}?mode=ro", uri=True)
+
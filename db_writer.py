@@ -0,0 +1,335 @@
+# 共有するDBファイルへの書き込みの直列化
+# sql_runner.py の INSERT / UPDATE / DELETE / CREATE / DROP は、txt2sql.py が質問のたびに読む Chinook.db に
+# 対して、各セッションがそれぞれの接続で実行していた。書き込みが重なると "database is locked" になったり、
+# 既定のジャーナル（rollback journal）では書き込みの確定を待つ間、他のセッションの読み取りが止まっていた。
+# DBファイルごとに1本の書き込み用の接続と1つのスレッドを持ち、書き込みを到着順に1つずつ実行する。
+# 読み取りは db_pool.get_readonly_pool（mode=ro。SQLITE_WAL=1 または bulk_load.py --wal で WAL にしたDBは書き込みを待たない）で行う。
+#
+# 使い方:
+#   python db_writer.py bench                              # 従来方式と比較（Chinook.db のコピーで実行）
+#   python db_writer.py bench --readers 8 --writers 4 --seconds 5
+import argparse
+import json
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+from db_pool import BUSY_TIMEOUT_MS, WAL_ENABLED, get_pool, get_readonly_pool
+from result_cache import get_result_cache
+
+# 書き込みの完了を待つ秒数の既定値（キューで待つ時間を含む）
+WRITE_TIMEOUT = float(os.environ.get("SQLITE_WRITE_TIMEOUT", "30"))
+
+# トランザクションの中では実行できない文
+_NO_TRANSACTION = re.compile(r"^\s*(?:VACUUM|BEGIN|COMMIT|END|ROLLBACK)\b", re.I)
+
+
+class WriteTimeout(TimeoutError):
+    """
+    書き込みが待機時間内に終わらなかった場合の例外。
+    started が False ならキューで待っている間に取り消したため、書き込みは行われない。
+    True なら実行中で取り消せなかったため、このあと確定する場合がある。
+    """
+
+    def __init__(self, timeout, started):
+        self.timeout = timeout
+        self.started = started
+        if started:
+            message = f"書き込みが {timeout}秒以内に終わりませんでした。実行中のため、このあと反映される場合があります。"
+        else:
+            message = f"書き込みが {timeout}秒以内に始まらなかったため取り消しました（変更は反映されません）。"
+        super().__init__(message)
+
+
+class SerializedWriter:
+    """
+    1つのDBファイルへの書き込みを、1本の接続と1つのスレッドで到着順に実行する。
+    各書き込みは BEGIN IMMEDIATE 〜 COMMIT の中で実行し、失敗した場合はロールバックする。
+    書き込みが確定したら、そのDBの実行結果キャッシュを破棄する。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {"executed": 0, "failed": 0, "queue_wait_ms": [], "run_ms": []}
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT_MS / 1000,
+                               isolation_level=None, check_same_thread=False)
+        if WAL_ENABLED:
+            conn.execute("PRAGMA journal_mode = WAL")
+            # WAL ではコミットごとの fsync を省いても DB は壊れない（電源断で直前のコミットが失われうるのみ）
+            conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    def _run(self):
+        conn = None
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            func, transaction, future, queued_at = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.perf_counter()
+            try:
+                if conn is None:
+                    conn = self._connect()
+                if transaction:
+                    conn.execute("BEGIN IMMEDIATE")
+                try:
+                    result = func(conn)
+                    if conn.in_transaction:
+                        conn.execute("COMMIT")
+                except BaseException:
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+                    raise
+                get_result_cache().invalidate(self.db_path)
+            except BaseException as e:
+                self._record(False, queued_at, started)
+                future.set_exception(e)
+            else:
+                self._record(True, queued_at, started)
+                future.set_result(result)
+        if conn is not None:
+            conn.close()
+
+    def _record(self, ok, queued_at, started):
+        now = time.perf_counter()
+        with self._lock:
+            self._stats["executed" if ok else "failed"] += 1
+            # 直近の 1000 件だけ残す
+            for key, value in (("queue_wait_ms", started - queued_at), ("run_ms", now - started)):
+                values = self._stats[key]
+                values.append(value * 1000)
+                del values[:-1000]
+
+    def submit(self, func, transaction=True):
+        """
+        func(conn) を書き込み用のスレッドで実行する Future を返す。
+        func の中で commit / rollback する必要はない（transaction=False の場合は自動コミットで実行する）。
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"db-writer:{self.db_path}", daemon=True)
+                self._thread.start()
+        future = Future()
+        self._queue.put((func, transaction, future, time.perf_counter()))
+        return future
+
+    def execute(self, sql, params=(), timeout=WRITE_TIMEOUT):
+        """
+        SQL文を1つ実行し、影響を受けた行数（不明な場合は -1）を返す（完了するまで待つ）。
+        timeout 秒以内に終わらなければ WriteTimeout（キューで待っている書き込みは取り消す）。
+        """
+        transaction = not _NO_TRANSACTION.match(sql)
+        future = self.submit(lambda conn: conn.execute(sql, params).rowcount, transaction)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            if future.cancel():
+                raise WriteTimeout(timeout, started=False) from None
+            if future.done():
+                # 待つのをやめた直後に終わっていた
+                return future.result()
+            raise WriteTimeout(timeout, started=True) from None
+
+    def close(self):
+        """キューに入っている書き込みを実行し終えてから、接続とスレッドを終了する。"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def stats(self):
+        with self._lock:
+            stats = {"executed": self._stats["executed"], "failed": self._stats["failed"],
+                     "queued": self._queue.qsize()}
+            for key in ("queue_wait_ms", "run_ms"):
+                if self._stats[key]:
+                    stats[key] = round(statistics.median(self._stats[key]), 2)
+        return stats
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(db_path):
+    """DBファイルごとに1つの SerializedWriter を返す（初回呼び出し時に作成）。"""
+    key = os.path.abspath(db_path)
+    with _writers_lock:
+        writer = _writers.get(key)
+        if writer is None:
+            writer = _writers[key] = SerializedWriter(db_path)
+        return writer
+
+
+# ==========================================
+# 負荷試験（複数セッションの読み取り・書き込み）
+# ==========================================
+
+# 書き込みの内容（sql_runner.py での操作に相当。1回あたり数百行を変更する）
+BENCH_SETUP = "CREATE TABLE IF NOT EXISTS bench_writes (id INTEGER PRIMARY KEY, name TEXT, price REAL)"
+BENCH_WRITES = [
+    "INSERT INTO bench_writes (name, price) SELECT Name, UnitPrice FROM Track LIMIT 300",
+    "UPDATE bench_writes SET price = price + 0.01 WHERE id % 3 = 0",
+    "DELETE FROM bench_writes WHERE id IN (SELECT id FROM bench_writes ORDER BY id LIMIT 300)",
+]
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def _summary(latencies, errors, seconds):
+    item = {"count": len(latencies), "errors": errors,
+            "per_sec": round(len(latencies) / seconds, 1) if seconds > 0 else None}
+    if latencies:
+        item.update(p50_ms=round(_percentile(latencies, 0.5), 2), p99_ms=round(_percentile(latencies, 0.99), 2),
+                    max_ms=round(max(latencies), 2))
+    return item
+
+
+def bench_mode(db_path, mode, readers=8, writers=4, seconds=5.0, write_interval=0.02, queries=None):
+    """
+    readers 個のセッションが質問例のSQLを、writers 個のセッションが BENCH_WRITES を繰り返し実行し、
+    読み取り・書き込みの件数と待ち時間を返す。
+    mode="legacy" は従来どおり（rollback journal・読み書き共通の接続・各セッションが直接書き込む）、
+    mode="wal" は WAL・mode=ro の読み取り・SerializedWriter による書き込み。
+    """
+    from parquet_backend import PARITY_QUERIES
+
+    queries = list((queries or PARITY_QUERIES).values())
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(BENCH_SETUP)
+    if mode == "legacy":
+        # 変更前と同じく、接続時の timeout（プールの待ち時間と共通の 10 秒）以外は待たない
+        read_pool = write_pool = get_pool(db_path, pragmas={})
+    else:
+        read_pool, write_pool = get_readonly_pool(db_path), None
+        writer = get_writer(db_path)
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    results = {"reads": [], "reads_errors": 0, "writes": [], "writes_errors": 0}
+
+    def collect(kind, latencies, errors):
+        with lock:
+            results[kind].extend(latencies)
+            results[kind + "_errors"] += errors
+
+    def reader(index):
+        latencies, errors = [], 0
+        i = index
+        while not stop.is_set():
+            sql = queries[i % len(queries)]
+            i += 1
+            started = time.perf_counter()
+            try:
+                with read_pool.connection() as conn:
+                    conn.execute(sql).fetchall()
+                latencies.append((time.perf_counter() - started) * 1000)
+            except sqlite3.OperationalError:
+                errors += 1
+        collect("reads", latencies, errors)
+
+    def write_session(index):
+        latencies, errors = [], 0
+        i = index
+        while not stop.is_set():
+            sql = BENCH_WRITES[i % len(BENCH_WRITES)]
+            i += 1
+            started = time.perf_counter()
+            try:
+                if write_pool is not None:
+                    with write_pool.connection() as conn:
+                        conn.execute(sql)
+                        conn.commit()
+                else:
+                    writer.execute(sql)
+                latencies.append((time.perf_counter() - started) * 1000)
+            except sqlite3.OperationalError:
+                errors += 1
+            stop.wait(write_interval)
+        collect("writes", latencies, errors)
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    threads += [threading.Thread(target=write_session, args=(i,)) for i in range(writers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    if write_pool is None:
+        writer.close()
+    with sqlite3.connect(db_path) as conn:
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    return {
+        "mode": mode,
+        "journal_mode": journal_mode,
+        "reads": _summary(results["reads"], results["reads_errors"], elapsed),
+        "writes": _summary(results["writes"], results["writes_errors"], elapsed),
+    }
+
+
+def bench(db_path="Chinook.db", **kwargs):
+    """db_path のコピーを2つ作り、従来方式と WAL＋直列化した書き込みで負荷試験を行う。"""
+    report = {}
+    with tempfile.TemporaryDirectory(prefix="db-writer-bench-") as directory:
+        for mode in ("legacy", "wal"):
+            copy = os.path.join(directory, f"{mode}.db")
+            shutil.copyfile(db_path, copy)
+            with sqlite3.connect(copy) as conn:
+                conn.execute("PRAGMA journal_mode = DELETE")
+            report[mode] = bench_mode(copy, mode, **kwargs)
+            get_pool(copy).close()
+            get_pool(f"file:{os.path.abspath(copy)}?mode=ro").close()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="共有DBへの書き込みの直列化と負荷試験")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--db", default="Chinook.db")
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--write-interval", type=float, default=0.02, help="書き込みセッションの操作の間隔（秒）")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+
+    report = bench(args.db, readers=args.readers, writers=args.writers, seconds=args.seconds,
+                   write_interval=args.write_interval)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return 0
+    for mode, item in report.items():
+        print(f"== {mode}（journal_mode={item['journal_mode']}）")
+        for kind, label in (("reads", "読み取り"), ("writes", "書き込み")):
+            s = item[kind]
+            line = f"  {label}: {s['count']} 件（{s['per_sec']}/秒） エラー {s['errors']}"
+            if s["count"]:
+                line += f" / p50 {s['p50_ms']}ms / p99 {s['p99_ms']}ms / 最大 {s['max_ms']}ms"
+            print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
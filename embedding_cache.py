@@ -0,0 +1,210 @@
+# 質問の埋め込みベクトルのキャッシュ
+# main.py は毎ターン質問を embeddings.create でベクトル化していたため、同じ質問や表記ゆれ程度の質問でも
+# 毎回 API を呼んでいた。モデル名と正規化した質問をキーに、ベクトルを float32 の BLOB として SQLite に保存する。
+#
+# 使い方:
+#   python embedding_cache.py prewarm questions.txt   # 1行1質問のファイルをまとめてベクトル化して保存
+#   python embedding_cache.py stats
+import argparse
+import hashlib
+import os
+import sys
+import threading
+import time
+from array import array
+
+from db_pool import get_pool
+from sql_cache import normalize_question
+
+CACHE_DB_PATH = os.environ.get("EMBEDDING_CACHE_PATH", os.path.join(".cache", "embedding_cache.db"))
+MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", "50000"))
+
+# 1回の embeddings.create に渡す件数の上限
+BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "64"))
+
+
+def pack_vector(vector):
+    """ベクトルを float32 の連続したバイト列にする（1次元あたり4バイト）。"""
+    return array("f", vector).tobytes()
+
+
+def unpack_vector(blob):
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+class EmbeddingCache:
+    """
+    (モデル名, 正規化した質問) をキーに埋め込みベクトルを保存するキャッシュ。
+    件数が max_entries を超えたら最終利用日時の古いものから削除する（LRU）。
+    """
+
+    def __init__(self, path=CACHE_DB_PATH, max_entries=MAX_ENTRIES):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_entries = max_entries
+        self._pool = get_pool(path, pragmas={"journal_mode": "WAL", "synchronous": "NORMAL"})
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self._pool.connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS embedding_cache (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    dimensions INTEGER NOT NULL,
+                    vector BLOB NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_embedding_cache_last_used ON embedding_cache (last_used)")
+
+    @staticmethod
+    def make_key(model, text):
+        return hashlib.sha256(f"{model}\x1f{normalize_question(text)}".encode("utf-8")).hexdigest()
+
+    def get_many(self, model, texts):
+        """texts と同じ順序でベクトル（無いものは None）のリストを返す。"""
+        keys = [self.make_key(model, text) for text in texts]
+        found = {}
+        now = time.time()
+        with self._pool.connection() as conn:
+            unique = list(dict.fromkeys(keys))
+            # SQLite のバインド変数の上限を超えないよう分けて取得する
+            for i in range(0, len(unique), 500):
+                chunk = unique[i:i + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                for key, blob in conn.execute(
+                    f"SELECT key, vector FROM embedding_cache WHERE key IN ({placeholders})", chunk
+                ):
+                    found[key] = unpack_vector(blob)
+            if found:
+                conn.executemany(
+                    "UPDATE embedding_cache SET last_used = ? WHERE key = ?", [(now, key) for key in found]
+                )
+        vectors = [found.get(key) for key in keys]
+        hits = sum(1 for vector in vectors if vector is not None)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(vectors) - hits
+        return vectors
+
+    def get(self, model, text):
+        return self.get_many(model, [text])[0]
+
+    def put_many(self, model, texts, vectors):
+        now = time.time()
+        rows = [
+            (self.make_key(model, text), model, text, len(vector), pack_vector(vector), now, now)
+            for text, vector in zip(texts, vectors)
+        ]
+        with self._pool.connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache "
+                "(key, model, text, dimensions, vector, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            count = conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM embedding_cache WHERE key IN "
+                    "(SELECT key FROM embedding_cache ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+
+    def put(self, model, text, vector):
+        self.put_many(model, [text], [vector])
+
+    def embed(self, client, model, texts, batch_size=BATCH_SIZE):
+        """
+        texts のベクトルを返す。キャッシュに無いものだけを batch_size 件ずつまとめて
+        client.embeddings.create で取得し、保存する。
+        """
+        vectors = self.get_many(model, texts)
+        # 正規化すると同じになる質問は1回だけ取得する
+        missing = {}
+        for text, vector in zip(texts, vectors):
+            if vector is None:
+                missing.setdefault(self.make_key(model, text), text)
+        batches = list(missing.values())
+        fetched = {}
+        for i in range(0, len(batches), batch_size):
+            batch = batches[i:i + batch_size]
+            response = client.embeddings.create(input=batch, model=model)
+            batch_vectors = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            self.put_many(model, batch, batch_vectors)
+            fetched.update((self.make_key(model, text), vector) for text, vector in zip(batch, batch_vectors))
+        return [
+            vector if vector is not None else fetched[self.make_key(model, text)]
+            for text, vector in zip(texts, vectors)
+        ]
+
+    def clear(self):
+        with self._pool.connection() as conn:
+            conn.execute("DELETE FROM embedding_cache")
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        with self._pool.connection() as conn:
+            entries, size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embedding_cache"
+            ).fetchone()
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+            "entries": entries,
+            "vector_bytes": size,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """プロセス内で共有する EmbeddingCache を返す（初回呼び出し時に作成）。"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+        return _cache
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="埋め込みベクトルのキャッシュ")
+    parser.add_argument("command", choices=["prewarm", "stats"])
+    parser.add_argument("file", nargs="?", help="prewarm: 1行1質問のテキストファイル")
+    parser.add_argument("--model", default=os.environ.get("AOAI_EMBEDDING_MODEL_NAME"))
+    args = parser.parse_args(argv)
+
+    cache = get_embedding_cache()
+    if args.command == "prewarm":
+        if not args.file or not args.model:
+            parser.error("prewarm には質問ファイルと --model（または AOAI_EMBEDDING_MODEL_NAME）が必要です")
+        from openai import AzureOpenAI
+
+        client = AzureOpenAI(
+            azure_endpoint=os.environ["AOAI_ENDPOINT"],
+            api_key=os.environ["AOAI_API_KEY"],
+            api_version=os.environ["AOAI_API_VERSION"],
+        )
+        with open(args.file, encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()]
+        started = time.perf_counter()
+        cache.embed(client, args.model, texts)
+        print(f"{len(texts)}件を {time.perf_counter() - started:.2f}秒 で処理しました（うちキャッシュ済み {cache.hits}件）")
+
+    stats = cache.stats()
+    print(f"保存件数 {stats['entries']} / ベクトル {stats['vector_bytes']:,} バイト")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+# OpenAI / Azure OpenAI クライアントのローカル代替（オフライン検証用）
+# client.chat.completions.create（stream=True を含む）と client.embeddings.create の
+# 最低限の形だけを再現する。遅延と応答内容は呼び出し側で指定できる。
+import hashlib
+import time
+from types import SimpleNamespace
+
+
+def _approx_tokens(text):
+    # 日本語混じりの文章の概算（1トークン ≒ 2文字）
+    return max(1, len(text) // 2)
+
+
+class _FakeCompletions:
+    def __init__(self, owner):
+        self.owner = owner
+
+    def create(self, model=None, messages=None, stream=False, **kwargs):
+        owner = self.owner
+        owner.calls += 1
+        content = owner.respond(messages or [])
+        prompt_tokens = sum(_approx_tokens(m.get("content") or "") for m in messages or [])
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=_approx_tokens(content),
+            total_tokens=prompt_tokens + _approx_tokens(content),
+        )
+        if owner.latency:
+            time.sleep(owner.latency)
+        if stream:
+            return owner._stream(content, model, usage)
+        message = SimpleNamespace(role="assistant", content=content)
+        return SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(index=0, message=message, finish_reason="stop")],
+            usage=usage,
+        )
+
+
+class _FakeEmbeddings:
+    def __init__(self, owner):
+        self.owner = owner
+
+    def create(self, input=None, model=None, **kwargs):
+        owner = self.owner
+        owner.calls += 1
+        if owner.latency:
+            time.sleep(owner.latency)
+        texts = [input] if isinstance(input, str) else list(input)
+        data = [SimpleNamespace(index=i, embedding=fake_embedding(t, owner.dimensions))
+                for i, t in enumerate(texts)]
+        return SimpleNamespace(data=data, model=model)
+
+
+def fake_embedding(text, dimensions=64):
+    """テキストから決定的に作るダミーのベクトル（同じ文字列なら同じベクトル）。"""
+    values = []
+    counter = 0
+    while len(values) < dimensions:
+        digest = hashlib.sha256(f"{counter}:{text}".encode("utf-8")).digest()
+        values.extend((b - 127.5) / 127.5 for b in digest)
+        counter += 1
+    return values[:dimensions]
+
+
+class FakeLLM:
+    """
+    OpenAI クライアントの代わりに使えるオブジェクト。
+
+    responses: ユーザーメッセージ（最後の user ロール）に含まれる文字列 → 応答 の辞書。
+               最初に部分一致したものを返す。一致しなければ default を返す。
+    latency:   1回の呼び出しで待つ秒数（ネットワーク往復の代わり）
+    token_delay: stream=True のとき、チャンクごとに待つ秒数
+    """
+
+    def __init__(self, responses=None, default="", latency=0.0, token_delay=0.0,
+                 chunk_size=4, dimensions=64):
+        self.responses = dict(responses or {})
+        self.default = default
+        self.latency = latency
+        self.token_delay = token_delay
+        self.chunk_size = chunk_size
+        self.dimensions = dimensions
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=_FakeCompletions(self))
+        self.embeddings = _FakeEmbeddings(self)
+
+    def respond(self, messages):
+        user_text = ""
+        for message in reversed(messages):
+            if message.get("role") == "user":
+                user_text = message.get("content") or ""
+                break
+        for pattern, response in self.responses.items():
+            if pattern in user_text:
+                return response(messages) if callable(response) else response
+        return self.default(messages) if callable(self.default) else self.default
+
+    def _stream(self, content, model, usage):
+        for i in range(0, len(content), self.chunk_size):
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            delta = SimpleNamespace(role="assistant", content=content[i:i + self.chunk_size])
+            yield SimpleNamespace(
+                model=model,
+                choices=[SimpleNamespace(index=0, delta=delta, finish_reason=None)],
+                usage=None,
+            )
+        yield SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(index=0, delta=SimpleNamespace(role=None, content=None),
+                                     finish_reason="stop")],
+            usage=None,
+        )
+        # stream_options={"include_usage": True} 指定時と同様、最後に usage だけのチャンクを返す
+        yield SimpleNamespace(model=model, choices=[], usage=usage)
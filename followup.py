@@ -0,0 +1,417 @@
+# 追加質問（直前の結果に対する絞り込み・並べ替え）への回答
+# 「じゃあYahooだけだと？」「それを合計の多い順に並べて」のような質問でも、これまでは毎回新しい質問として
+# 元のテーブルに対して SQL生成 → SQL実行 → 回答生成 をやり直していた。
+# セッションごとに直前の結果をメモリ上の SQLite（テーブル prev_result）に保持し、追加質問らしい場合は
+# まずそのテーブルに対するSQLを生成する。直前の結果だけでは答えられなければ、従来どおり元のテーブルで処理する。
+# 保持する結果の合計サイズと保持期間に上限を設け、超えたら古いセッションから破棄する。
+#
+# 使い方:
+#   python followup.py bench                            # 追加質問の処理時間を、元のテーブルでの再実行と比較（擬似LLM）
+#   python followup.py bench --latency 0.5 --repeat 10
+import argparse
+import json
+import os
+import re
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from query_guard import guarded
+from result_compact import fetch_compacted
+
+FOLLOWUP_ENABLED = os.environ.get("FOLLOWUP", "1") != "0"
+# 全セッションの直前の結果の合計サイズの上限（メモリ上の SQLite のページ数 × ページサイズ）
+MAX_BYTES = int(os.environ.get("FOLLOWUP_MAX_BYTES", str(64 * 1024 * 1024)))
+# 最後に使ってからこの秒数を過ぎた結果は破棄する
+TTL = float(os.environ.get("FOLLOWUP_TTL", "1800"))
+
+TABLE = "prev_result"
+# 直前の結果では答えられない場合にLLMが返す文字列
+NEED_BASE = "NEED_BASE"
+# プロンプトに載せる列ごとの値の例の数
+SAMPLE_VALUES = 3
+
+# 追加質問らしい言い回し（当てはまらない質問は、LLMに確認せず新しい質問として処理する）
+# 直前の結果を指す言い方（文頭の「じゃあ」「それ」「その」など）と、結果を絞る「だけ」「のみ」「以外」に限る。
+# 「上位」「順に」「トップ」などは新しい質問でもよく使うため、手掛かりにしない（毎回LLMへの確認が増える）。
+FOLLOWUP_CUES = re.compile(
+    r"^\s*(?:じゃあ|では|それ|その|この|さっき|上の|そこ)"
+    r"|だけ|のみ|以外"
+    r"|^\s*(?:then|what about)\b|\b(?:only|except|those|them)\b",
+    re.I,
+)
+
+FOLLOWUP_PROMPT = """
+あなたは経験豊富なデータアナリストです。
+ユーザーは直前の質問の結果を見たうえで、続けて質問しています。直前の結果はテーブル {table} に入っています。
+
+#### 直前の質問
+{question}
+
+#### 直前の結果を得たSQL
+{sql}
+
+#### 直前の結果のテーブル（{row_count}行）
+{schema}
+
+**重要**: 今回の質問が、直前の結果の絞り込み・並べ替え・上位の抽出・列の選択・再集計だけで答えられる場合は、テーブル {table} に対するSQLiteのSQLクエリ（SELECT文）のみを返してください。説明やMarkdownのコードブロック(```sql ... ```)は含めないでください。
+直前の結果に無い列や行、元のテーブルが必要な場合は、SQLではなく {need_base} とだけ返してください。
+""".strip()
+
+_TYPE_NAMES = {int: "INTEGER", float: "REAL", str: "TEXT", bytes: "BLOB"}
+
+
+def _quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _unique_columns(columns):
+    """重複・空の列名（SELECT a.Name, b.Name など）を Name, Name_2 のように一意にする。"""
+    seen = set()
+    names = []
+    for i, column in enumerate(columns):
+        base = column or f"column_{i + 1}"
+        name, n = base, 1
+        while name.lower() in seen:
+            n += 1
+            name = f"{base}_{n}"
+        seen.add(name.lower())
+        names.append(name)
+    return names
+
+
+def looks_like_followup(question):
+    """直前の結果に対する追加質問らしければ True（最終的に答えられるかはLLMが判断する）。"""
+    return FOLLOWUP_ENABLED and bool(FOLLOWUP_CUES.search(question or ""))
+
+
+class SessionResult:
+    """
+    1つのセッションの直前の結果。メモリ上の SQLite のテーブル prev_result として保持する。
+    question / sql は、この結果を得た質問とSQL（追加質問を重ねた場合はつなげたもの）。
+    """
+
+    def __init__(self, question, sql, columns, rows):
+        self.question = question
+        self.sql = sql
+        self.columns = _unique_columns(columns)
+        self.row_count = len(rows)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        # 型を宣言しない列は値をそのまま保存する（元の結果の型を変えない）
+        self.conn.execute(f"CREATE TABLE {TABLE} ({', '.join(map(_quote, self.columns))})")
+        placeholders = ", ".join("?" for _ in self.columns)
+        self.conn.executemany(f"INSERT INTO {TABLE} VALUES ({placeholders})", rows)
+        self.conn.commit()
+        # 生成されたSQLで prev_result を書き換えられないようにする
+        self.conn.execute("PRAGMA query_only = ON")
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        self.bytes = page_count * page_size
+        self.schema = self._describe(rows)
+        self.last_used = time.monotonic()
+
+    def _describe(self, rows):
+        """prev_result の CREATE TABLE 文（列ごとに値の型と例をコメントで付ける）。"""
+        lines = []
+        for i, name in enumerate(self.columns):
+            values = []
+            for row in rows:
+                value = row[i]
+                if value is not None and value not in values:
+                    values.append(value)
+                    if len(values) >= SAMPLE_VALUES:
+                        break
+            type_name = _TYPE_NAMES.get(type(values[0]), "TEXT") if values else "TEXT"
+            example = f"  -- 例: {', '.join(repr(v) for v in values)}" if values else ""
+            lines.append(f"  {_quote(name)} {type_name}{',' if i < len(self.columns) - 1 else ''}{example}")
+        return f"CREATE TABLE {TABLE} (\n" + "\n".join(lines) + "\n);"
+
+    def prompt(self):
+        return FOLLOWUP_PROMPT.format(table=TABLE, question=self.question, sql=self.sql, row_count=self.row_count,
+                                      schema=self.schema, need_base=NEED_BASE)
+
+    def query(self, sql, budget=None, cancel_event=None):
+        """prev_result に対してSQLを実行し、ResultSummary を返す。"""
+        with self.lock:
+            self.last_used = time.monotonic()
+            if budget is None:
+                return fetch_compacted(self.conn.execute(sql))
+            with guarded(self.conn, budget, cancel_event):
+                return fetch_compacted(self.conn.execute(sql))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class FollowupStore:
+    """
+    セッションID → 直前の結果（SessionResult）。
+    合計サイズが max_bytes を超えたら最後に使ったのが古いセッションから、ttl 秒使われていないものは常に破棄する。
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, ttl=TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _discard(self, session_id):
+        result = self._sessions.pop(session_id, None)
+        if result is not None:
+            self._bytes -= result.bytes
+            result.close()
+        return result
+
+    def _evict(self):
+        now = time.monotonic()
+        for session_id in [k for k, r in self._sessions.items() if now - r.last_used > self.ttl]:
+            self._discard(session_id)
+            self.evictions += 1
+        while self._bytes > self.max_bytes and self._sessions:
+            self._discard(next(iter(self._sessions)))
+            self.evictions += 1
+
+    def get(self, session_id):
+        """セッションの直前の結果を返す。無ければ（破棄済みを含む）None。"""
+        with self._lock:
+            self._evict()
+            result = self._sessions.get(session_id)
+            if result is None:
+                self.misses += 1
+                return None
+            self._sessions.move_to_end(session_id)
+            result.last_used = time.monotonic()
+            self.hits += 1
+            return result
+
+    def put(self, session_id, turn):
+        """
+        処理を終えたターン（pipeline.Turn）の結果を、セッションの直前の結果として保持する。
+        取得上限で打ち切った結果は、絞り込むと誤った答えになるため保持しない（直前の結果も破棄する）。
+        """
+        summary = turn.summary
+        if summary is None or summary.truncated or not summary.columns:
+            self.drop(session_id)
+            return None
+        result = SessionResult(turn.full_question, turn.full_sql, summary.columns, summary.rows)
+        if result.bytes > self.max_bytes:
+            result.close()
+            self.drop(session_id)
+            return None
+        with self._lock:
+            self._discard(session_id)
+            self._sessions[session_id] = result
+            self._bytes += result.bytes
+            self._evict()
+        return result
+
+    def drop(self, session_id):
+        with self._lock:
+            self._discard(session_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_followup_store():
+    """プロセス内で共有する FollowupStore を返す（初回呼び出し時に作成）。"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = FollowupStore()
+        return _store
+
+
+def previous_result(session_id, question):
+    """
+    question が追加質問らしく、セッションに直前の結果があればそれを返す（無ければ None）。
+    SQLキャッシュを引く前に呼び、結果を pipeline.start(previous=...) に渡す。
+    """
+    if session_id is None or not looks_like_followup(question):
+        return None
+    return get_followup_store().get(session_id)
+
+
+# ==========================================
+# 計測（擬似LLMで、追加質問と元のテーブルでの再実行を比較）
+# ==========================================
+
+# (最初の質問, SQL), [(追加質問, prev_result に対するSQL または NEED_BASE, 同じ内容の単独の質問, そのSQL), ...]
+# 追加質問は順に重ねる（2つ目は1つ目の結果に対する質問）
+_ARTIST_SALES = (
+    "SELECT ar.Name, SUM(il.UnitPrice * il.Quantity) AS Sales, COUNT(*) AS Lines FROM InvoiceLine il "
+    "JOIN Track t ON il.TrackId = t.TrackId JOIN Album al ON t.AlbumId = al.AlbumId "
+    "JOIN Artist ar ON al.ArtistId = ar.ArtistId GROUP BY ar.Name ORDER BY Sales DESC"
+)
+_MEDIA_MONTHLY = (
+    "SELECT media_type, year, month, SUM(cost) AS cost, SUM(conversions) AS conversions, "
+    "SUM(cost) / NULLIF(SUM(conversions), 0) AS cpa FROM AdPerformance GROUP BY media_type, year, month"
+)
+BENCH_SCENARIOS = {
+    "txt2sql": (
+        ("アーティスト別の売上", _ARTIST_SALES),
+        [
+            ("上位10件だけ見せて", f"SELECT * FROM {TABLE} ORDER BY Sales DESC LIMIT 10",
+             "アーティスト別の売上の上位10件", _ARTIST_SALES + " LIMIT 10"),
+            ("その中で名前順に並べて", f"SELECT * FROM {TABLE} ORDER BY Name",
+             "アーティスト別の売上の上位10件を名前順に", f"SELECT * FROM ({_ARTIST_SALES} LIMIT 10) ORDER BY Name"),
+            ("それをジャンル別にも分けて", NEED_BASE,
+             "アーティスト別・ジャンル別の売上の上位10件",
+             "SELECT ar.Name, g.Name AS Genre, SUM(il.UnitPrice * il.Quantity) AS Sales FROM InvoiceLine il "
+             "JOIN Track t ON il.TrackId = t.TrackId JOIN Genre g ON t.GenreId = g.GenreId "
+             "JOIN Album al ON t.AlbumId = al.AlbumId JOIN Artist ar ON al.ArtistId = ar.ArtistId "
+             "GROUP BY ar.Name, g.Name ORDER BY Sales DESC LIMIT 10"),
+        ],
+    ),
+    "mark_db": (
+        ("媒体別・月別のCPAを教えて", _MEDIA_MONTHLY),
+        [
+            ("じゃあYahooだけだと？", f"SELECT * FROM {TABLE} WHERE media_type = 'Yahoo'",
+             "Yahooの月別のCPAを教えて", _MEDIA_MONTHLY.replace("GROUP BY", "WHERE media_type = 'Yahoo' GROUP BY")),
+            ("それをCPAの高い順に並べて", f"SELECT * FROM {TABLE} ORDER BY cpa DESC",
+             "Yahooの月別のCPAを高い順に",
+             _MEDIA_MONTHLY.replace("GROUP BY", "WHERE media_type = 'Yahoo' GROUP BY") + " ORDER BY cpa DESC"),
+            ("その月の顧客獲得の予約数と比べて", NEED_BASE,
+             "Yahooの月別のCPAと予約数",
+             "SELECT a.year, a.month, a.cpa, c.reservations FROM ("
+             + _MEDIA_MONTHLY.replace("GROUP BY", "WHERE media_type = 'Yahoo' GROUP BY") + ") a "
+             "LEFT JOIN (SELECT CAST(strftime('%Y', date) AS INTEGER) AS year, "
+             "CAST(strftime('%m', date) AS INTEGER) AS month, SUM(y_yoyaku) AS reservations "
+             "FROM CustomerAcquisition GROUP BY 1, 2) c ON a.year = c.year AND a.month = c.month"),
+        ],
+    ),
+}
+
+
+def _bench_client(latency):
+    """通常のプロンプトには質問ごとのSQLを、追加質問のプロンプトには prev_result に対するSQLを返す擬似LLM。"""
+    from benchmark import FAKE_ANSWER
+    from fake_llm import FakeLLM
+
+    sql_by_question, followup_sql = {}, {}
+    for (question, sql), followups in BENCH_SCENARIOS.values():
+        sql_by_question[question] = sql
+        for followup, prev_sql, standalone, standalone_sql in followups:
+            followup_sql[followup] = prev_sql
+            sql_by_question[followup] = standalone_sql
+            sql_by_question[standalone] = standalone_sql
+
+    def respond(messages):
+        user = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "").strip()
+        if f"テーブル {TABLE}" in messages[0]["content"]:
+            return followup_sql.get(user, NEED_BASE)
+        return sql_by_question.get(user, FAKE_ANSWER)
+
+    return FakeLLM(default=respond, latency=latency)
+
+
+def _stats(values):
+    if not values:
+        return None
+    return {"p50_ms": round(statistics.median(values) * 1000, 1), "max_ms": round(max(values) * 1000, 1)}
+
+
+def bench(pipelines=("txt2sql", "mark_db"), repeat=5, latency=0.3):
+    """
+    各シナリオを repeat 回実行し、追加質問として処理した場合と、同じ内容の単独の質問を
+    元のテーブルで最初から処理した場合（キャッシュなし）の所要時間・トークン数を比較する。
+    """
+    import uuid
+
+    # ベンチマーク用のキャッシュ・トレースのファイルを使う（benchmark.py と共通）
+    from benchmark import BENCH_DATE
+    # python followup.py で実行した場合も、pipeline.py が使うのと同じモジュールの FollowupStore を見る
+    from followup import get_followup_store
+    from pipeline import PIPELINES, marketing_context
+
+    client = _bench_client(latency)
+    report = {"latency_sec": latency, "repeat": repeat, "pipelines": {}}
+    for name in pipelines:
+        pipeline = PIPELINES[name]
+        context = marketing_context(BENCH_DATE) if name == "mark_db" else {}
+        (question, _), followups = BENCH_SCENARIOS[name]
+        steps = {followup: {"followup": [], "cold": [], "followup_tokens": 0, "cold_tokens": 0,
+                            "followup_execute": [], "cold_execute": [], "answered_from_previous": 0}
+                 for followup, *_ in followups}
+        # 1周目はDBのページキャッシュなどの影響が大きいため、計測から外す
+        for i in range(repeat + 1):
+            session_id = f"bench:{name}:{uuid.uuid4().hex}"
+            pipeline.run(client, question, use_cache=False, session_id=session_id, **context)
+            for followup, _, standalone, _ in followups:
+                turn = pipeline.run(client, followup, use_cache=False, session_id=session_id, **context)
+                cold = pipeline.run(client, standalone, use_cache=False, **context)
+                if i == 0:
+                    continue
+                step = steps[followup]
+                step["followup"].append(turn.timings["total"])
+                step["cold"].append(cold.timings["total"])
+                step["followup_execute"].append(turn.timings.get("execute_sql", 0.0))
+                step["cold_execute"].append(cold.timings.get("execute_sql", 0.0))
+                step["followup_tokens"] += turn.trace.tokens[0]
+                step["cold_tokens"] += cold.trace.tokens[0]
+                step["answered_from_previous"] += turn.followup is not None
+        report["pipelines"][name] = {
+            followup: {
+                "answered_from_previous": f"{step['answered_from_previous']}/{repeat}",
+                "followup": _stats(step["followup"]),
+                "cold": _stats(step["cold"]),
+                "followup_execute": _stats(step["followup_execute"]),
+                "cold_execute": _stats(step["cold_execute"]),
+                "followup_prompt_tokens": step["followup_tokens"] // repeat,
+                "cold_prompt_tokens": step["cold_tokens"] // repeat,
+            }
+            for followup, step in steps.items()
+        }
+    report["store"] = get_followup_store().stats()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="追加質問を直前の結果で処理した場合の計測")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--pipelines", nargs="+", choices=list(BENCH_SCENARIOS), default=list(BENCH_SCENARIOS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.3, help="擬似LLMの1回あたりの遅延（秒）")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+
+    report = bench(args.pipelines, args.repeat, args.latency)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return 0
+    print(f"擬似LLMの遅延: {args.latency}秒/回、{args.repeat}回の中央値")
+    for name, steps in report["pipelines"].items():
+        print(f"== {name}")
+        for followup, item in steps.items():
+            print(f"  「{followup}」（直前の結果で回答: {item['answered_from_previous']}）")
+            print(f"    追加質問: {item['followup']['p50_ms']}ms（うちSQL実行 {item['followup_execute']['p50_ms']}ms）"
+                  f" / 入力 {item['followup_prompt_tokens']} トークン")
+            print(f"    再実行:   {item['cold']['p50_ms']}ms（うちSQL実行 {item['cold_execute']['p50_ms']}ms）"
+                  f" / 入力 {item['cold_prompt_tokens']} トークン")
+    store = report["store"]
+    print(f"直前の結果: {store['sessions']} セッション / {store['bytes'] / 1024:.0f}KB / 破棄 {store['evictions']} 件")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
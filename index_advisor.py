@@ -0,0 +1,436 @@
+# インデックスアドバイザー
+# txt2sql.py / mark_db.py で実行されたSQLを記録し（ワークロード）、
+# EXPLAIN QUERY PLAN で全件スキャンになっているテーブルに対してカバリングインデックスを提案する。
+# 提案はバージョン付きのマイグレーションファイルとして書き出し、migrate コマンドで適用する。
+#
+# 使い方:
+#   python index_advisor.py advise  marketing.db               # 提案を表示
+#   python index_advisor.py advise  marketing.db --write       # 提案をマイグレーションとして保存
+#   python index_advisor.py migrate marketing.db               # 未適用のマイグレーションを適用
+#   python index_advisor.py report  marketing.db               # 適用前後のレイテンシを比較
+import argparse
+import glob
+import json
+import os
+import re
+import sqlite3
+import statistics
+import sys
+import time
+from datetime import datetime
+
+from db_pool import get_pool, run_once
+from result_cache import normalize_sql
+
+WORKLOAD_DB_PATH = os.environ.get("WORKLOAD_LOG_PATH", os.path.join(".cache", "workload.db"))
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# 1つのインデックスに含める最大列数
+MAX_INDEX_COLUMNS = 8
+# レイテンシ計測の繰り返し回数（中央値を使う）
+BENCH_REPEAT = 5
+# 採用する候補の条件: この倍率以上速くなること
+MIN_SPEEDUP = 1.2
+# 最良の候補に対してこの割合以上の短縮が得られれば、既に採用した候補でまかなう
+NEAR_BEST_RATIO = 0.8
+# 1テーブルあたりの最大インデックス数（書き込みの負担を抑える）
+MAX_INDEXES_PER_TABLE = 3
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_SCAN = re.compile(r"^SCAN (\w+)(?: AS \w+)?$")
+
+
+# ==========================================
+# 1. ワークロードの記録
+# ==========================================
+
+def _setup_workload_db():
+    directory = os.path.dirname(WORKLOAD_DB_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with _get_workload_pool().connection() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS query_log (
+                db_name TEXT NOT NULL,
+                sql TEXT NOT NULL,
+                elapsed_ms REAL,
+                executed_at REAL NOT NULL
+            )
+        """)
+
+
+def _get_workload_pool():
+    return get_pool(WORKLOAD_DB_PATH, pragmas={"journal_mode": "WAL", "synchronous": "NORMAL"})
+
+
+def _workload_pool():
+    # ディレクトリとテーブルの作成はプロセス内で一度だけ行い、以降はプールを返すだけにする
+    run_once(("workload", WORKLOAD_DB_PATH), _setup_workload_db)
+    return _get_workload_pool()
+
+
+def record_query(db_path, sql, elapsed_ms=None):
+    """実行したSQLをワークロードとして記録する（記録に失敗しても呼び出し元は止めない）。"""
+    try:
+        with _workload_pool().connection() as conn:
+            conn.execute(
+                "INSERT INTO query_log (db_name, sql, elapsed_ms, executed_at) VALUES (?, ?, ?, ?)",
+                (os.path.basename(db_path), normalize_sql(sql), elapsed_ms, time.time()),
+            )
+    except sqlite3.Error:
+        pass
+
+
+def load_workload(db_path, workload_file=None):
+    """記録済みワークロード（またはSQLファイル）から [(sql, 実行回数)] を返す。"""
+    if workload_file:
+        with open(workload_file, encoding="utf-8") as f:
+            text = "\n".join(line for line in f if not line.strip().startswith("--"))
+        statements = [normalize_sql(s) for s in text.split(";")]
+        return [(s, 1) for s in statements if s]
+    if not os.path.exists(WORKLOAD_DB_PATH):
+        return []
+    with _workload_pool().connection() as conn:
+        return conn.execute(
+            "SELECT sql, COUNT(*) FROM query_log WHERE db_name = ? GROUP BY sql ORDER BY COUNT(*) DESC",
+            (os.path.basename(db_path),),
+        ).fetchall()
+
+
+# ==========================================
+# 2. 実行計画の分析とインデックス候補の生成
+# ==========================================
+
+def explain(conn, sql):
+    """EXPLAIN QUERY PLAN の detail 列を返す。"""
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+
+
+def scanned_tables(plan):
+    """インデックスを使わずに全件スキャンしているテーブル名を返す。"""
+    tables = set()
+    for detail in plan:
+        match = _SCAN.match(detail)
+        if match:
+            tables.add(match.group(1))
+    return tables
+
+
+def _table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+
+
+def _clause(sql, keyword, stops):
+    match = re.search(rf"\b{keyword}\b(.*?)(?:\b(?:{'|'.join(stops)})\b|$)", sql, re.I | re.S)
+    return match.group(1) if match else ""
+
+
+def _column_usage(sql, columns):
+    """SQL内での各列の使われ方（等価条件・範囲条件・GROUP BY/ORDER BY・参照）を調べる。"""
+    text = _STRING_LITERAL.sub("?", sql)
+    group_by = _clause(text, r"GROUP\s+BY", ["HAVING", "ORDER", "LIMIT"])
+    order_by = _clause(text, r"ORDER\s+BY", ["LIMIT"])
+    usage = {"eq": [], "range": [], "group": [], "referenced": []}
+    for col in columns:
+        name = re.escape(col)
+        if not re.search(rf"\b{name}\b", text, re.I):
+            continue
+        usage["referenced"].append(col)
+        if re.search(rf"\b{name}\b\s*(?:=|\bIN\b|\bIS\b)", text, re.I):
+            usage["eq"].append(col)
+        elif re.search(rf"\b{name}\b\s*(?:<|>|\bBETWEEN\b|\bLIKE\b)", text, re.I):
+            usage["range"].append(col)
+        if re.search(rf"\b{name}\b", group_by + " " + order_by, re.I):
+            usage["group"].append(col)
+    # GROUP BY / ORDER BY の列は記述順に並べる
+    keys = (group_by + " " + order_by).lower()
+    usage["group"].sort(key=lambda col: keys.find(col.lower()))
+    return usage
+
+
+def _dedupe(columns):
+    seen = []
+    for col in columns:
+        if col not in seen:
+            seen.append(col)
+    return tuple(seen[:MAX_INDEX_COLUMNS])
+
+
+def candidate_indexes(conn, sql):
+    """1つのSQLに対するインデックス候補 [(table, columns)] を返す。"""
+    candidates = []
+    for table in scanned_tables(explain(conn, sql)):
+        usage = _column_usage(sql, _table_columns(conn, table))
+        if not usage["referenced"]:
+            continue
+        eq, rng, group, rest = usage["eq"], usage["range"], usage["group"], usage["referenced"]
+        # 絞り込み優先（等価→範囲→集計キー）と、集計優先（等価→集計キー→範囲）の2通りを試す。
+        # いずれも参照列をすべて含めてカバリングインデックスにする。
+        candidates.append((table, _dedupe(eq + rng[:1] + group + rest)))
+        candidates.append((table, _dedupe(eq + group + rng[:1] + rest)))
+    return list(dict.fromkeys(candidates))
+
+
+def index_name(table, columns):
+    return "idx_" + "_".join([table] + list(columns)).lower()
+
+
+def index_statement(table, columns):
+    cols = ", ".join(f'"{c}"' for c in columns)
+    return f'CREATE INDEX IF NOT EXISTS "{index_name(table, columns)}" ON "{table}" ({cols})'
+
+
+# ==========================================
+# 3. 計測
+# ==========================================
+
+def _copy_to_memory(db_path):
+    src = sqlite3.connect(db_path)
+    mem = sqlite3.connect(":memory:")
+    src.backup(mem)
+    src.close()
+    return mem
+
+
+def time_query(conn, sql, repeat=BENCH_REPEAT):
+    """SQLを repeat 回実行し、実行時間（ミリ秒）の中央値を返す。"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        conn.execute(sql).fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def advise(db_path, workload):
+    """
+    ワークロードに対するインデックスを提案する。
+    DBのメモリ上のコピーで候補を1つずつ作成してワークロード全体を計測し、
+    短縮時間の大きい候補から貪欲に採用する（1つのインデックスで複数のSQLをまかなえるようにする）。
+    """
+    conn = _copy_to_memory(db_path)
+    baseline = {}
+    candidates = []
+    for sql, _ in workload:
+        try:
+            baseline[sql] = time_query(conn, sql)
+        except sqlite3.Error:
+            continue
+        candidates.extend(candidate_indexes(conn, sql))
+    candidates = list(dict.fromkeys(candidates))
+
+    # timings[候補][sql] = その候補を使った場合の実行時間（候補が実際に使われたSQLのみ）
+    timings = {}
+    for table, columns in candidates:
+        conn.execute(index_statement(table, columns))
+        name = index_name(table, columns)
+        try:
+            for sql in baseline:
+                if any(name in detail for detail in explain(conn, sql)):
+                    elapsed = time_query(conn, sql)
+                    if elapsed * MIN_SPEEDUP <= baseline[sql]:
+                        timings.setdefault((table, columns), {})[sql] = elapsed
+        finally:
+            conn.execute(f'DROP INDEX "{name}"')
+    conn.close()
+
+    counts = dict(workload)
+    best = {}
+    for per_sql in timings.values():
+        for sql, elapsed in per_sql.items():
+            best[sql] = max(best.get(sql, 0.0), baseline[sql] - elapsed)
+
+    def served(candidate, remaining):
+        # 最良の候補の短縮時間の NEAR_BEST_RATIO 以上を得られるSQLを「まかなえる」とみなす
+        return {sql: baseline[sql] - elapsed for sql, elapsed in timings[candidate].items()
+                if sql in remaining and baseline[sql] - elapsed >= NEAR_BEST_RATIO * best[sql]}
+
+    remaining = set(best)
+    per_table = {}
+    proposals = []
+    while remaining:
+        scored = []
+        for candidate in timings:
+            if per_table.get(candidate[0], 0) >= MAX_INDEXES_PER_TABLE:
+                continue
+            savings = served(candidate, remaining)
+            score = sum(saved * counts[sql] for sql, saved in savings.items())
+            if score > 0:
+                scored.append((score, candidate, savings))
+        if not scored:
+            break
+        score, (table, columns), savings = max(scored, key=lambda item: item[0])
+        remaining -= set(savings)
+        per_table[table] = per_table.get(table, 0) + 1
+        proposals.append({
+            "table": table,
+            "columns": list(columns),
+            "statement": index_statement(table, columns),
+            "queries": sum(counts[sql] for sql in savings),
+            "saved_ms": score,
+        })
+    return proposals
+
+
+def latency_report(db_path, workload, statements):
+    """DBのメモリ上のコピーで、statements の適用前後のレイテンシを比較する。"""
+    conn = _copy_to_memory(db_path)
+    rows = []
+    valid = []
+    for sql, count in workload:
+        try:
+            before = time_query(conn, sql)
+            valid.append((sql, count, before))
+        except sqlite3.Error as e:
+            rows.append({"sql": sql, "error": str(e)})
+    for statement in statements:
+        conn.execute(statement)
+    conn.execute("ANALYZE")
+    for sql, count, before in valid:
+        after = time_query(conn, sql)
+        rows.append({"sql": sql, "count": count, "before_ms": round(before, 3), "after_ms": round(after, 3)})
+    conn.close()
+    measured = [r for r in rows if "error" not in r]
+    total_before = sum(r["before_ms"] * r["count"] for r in measured)
+    total_after = sum(r["after_ms"] * r["count"] for r in measured)
+    return {
+        "queries": rows,
+        "total_before_ms": round(total_before, 3),
+        "total_after_ms": round(total_after, 3),
+        "speedup": round(total_before / total_after, 2) if total_after else None,
+    }
+
+
+# ==========================================
+# 4. マイグレーション
+# ==========================================
+
+def migrations_dir(db_path):
+    stem = os.path.splitext(os.path.basename(db_path))[0]
+    return os.path.join(MIGRATIONS_DIR, stem)
+
+
+def _migration_files(db_path):
+    files = []
+    for path in glob.glob(os.path.join(migrations_dir(db_path), "[0-9][0-9][0-9][0-9]_*.sql")):
+        name = os.path.basename(path)
+        files.append((int(name[:4]), name[5:-4], path))
+    return sorted(files)
+
+
+def write_migration(db_path, statements, name="indexes", generator="index_advisor.py"):
+    """statements を次のバージョン番号のマイグレーションファイルとして保存する。"""
+    directory = migrations_dir(db_path)
+    os.makedirs(directory, exist_ok=True)
+    files = _migration_files(db_path)
+    version = files[-1][0] + 1 if files else 1
+    path = os.path.join(directory, f"{version:04d}_{name}.sql")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"-- generated by {generator} ({datetime.now():%Y-%m-%d})\n")
+        for statement in statements:
+            f.write(statement + ";\n")
+        f.write("ANALYZE;\n")
+    return path
+
+
+def pending_statements(db_path):
+    """未適用のマイグレーションに含まれるSQL文を返す（report 用）。"""
+    applied = applied_versions(db_path)
+    statements = []
+    for version, _, path in _migration_files(db_path):
+        if version in applied:
+            continue
+        with open(path, encoding="utf-8") as f:
+            for statement in f.read().split(";"):
+                statement = "\n".join(
+                    line for line in statement.splitlines() if not line.strip().startswith("--")
+                ).strip()
+                if statement and statement.upper() != "ANALYZE":
+                    statements.append(statement)
+    return statements
+
+
+def applied_versions(db_path):
+    with sqlite3.connect(db_path) as conn:
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='schema_migrations'"
+        ).fetchone()
+        if not exists:
+            return set()
+        return {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+
+
+def apply_migrations(db_path):
+    """未適用のマイグレーションをバージョン順に1つずつトランザクション内で適用する。"""
+    applied = []
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TEXT NOT NULL
+            )
+        """)
+        conn.commit()
+        done = {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+        for version, name, path in _migration_files(db_path):
+            if version in done:
+                continue
+            with open(path, encoding="utf-8") as f:
+                script = f.read()
+            # executescript は直前のトランザクションを確定させるため、BEGIN/COMMIT で明示的に囲む
+            conn.executescript(
+                "BEGIN;\n" + script +
+                f"\nINSERT INTO schema_migrations (version, name, applied_at) "
+                f"VALUES ({version}, '{name}', datetime('now'));\nCOMMIT;"
+            )
+            applied.append(f"{version:04d}_{name}")
+    return applied
+
+
+# ==========================================
+# 5. コマンドライン
+# ==========================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ワークロードに基づくインデックスの提案と適用")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for command in ("advise", "report"):
+        p = sub.add_parser(command)
+        p.add_argument("db_path")
+        p.add_argument("--workload-file", help="記録済みワークロードの代わりに使うSQLファイル（; 区切り）")
+        if command == "advise":
+            p.add_argument("--write", action="store_true", help="提案をマイグレーションとして保存する")
+            p.add_argument("--name", default="indexes", help="マイグレーション名")
+    p = sub.add_parser("migrate")
+    p.add_argument("db_path")
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        applied = apply_migrations(args.db_path)
+        print("適用したマイグレーション: " + (", ".join(applied) if applied else "なし"))
+        return 0
+
+    workload = load_workload(args.db_path, args.workload_file)
+    if not workload:
+        print("ワークロードがありません。ページでの実行履歴か --workload-file を指定してください。")
+        return 1
+
+    if args.command == "advise":
+        proposals = advise(args.db_path, workload)
+        for p in proposals:
+            print(f"{p['statement']};  -- {p['queries']}クエリ, 約{p['saved_ms']:.2f}ms短縮")
+        if not proposals:
+            print("提案できるインデックスはありません。")
+        elif args.write:
+            print("保存しました: " + write_migration(args.db_path, [p["statement"] for p in proposals], args.name))
+        return 0
+
+    # report: 未適用のマイグレーションを適用した場合の前後比較
+    statements = pending_statements(args.db_path)
+    print(json.dumps(latency_report(args.db_path, workload, statements), ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
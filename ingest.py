@@ -0,0 +1,347 @@
+# marketing.db への差分取り込み
+# marketing.db はスナップショットで、新しい日の AdPerformance / CustomerAcquisition を追加する手段が
+# 無かった（更新するにはファイルごと作り直す必要があった）。ここでは CSV / parquet の差分ファイルを
+# チャンクごとに読み、テーブルごとの日付の high-water mark（取り込み済みの最新日）より前の行は読み飛ばす。
+#   - 自然キー（日付と媒体・アカウント / 日付と utm_*）ごとに、ファイルの内容で既存の行を置き換える
+#     （同じファイルを何度取り込んでも結果は変わらない）。CustomerAcquisition は同じキーの行が複数あり、
+#     utm_* が NULL の行もあるため、UNIQUE 制約＋ON CONFLICT ではなく、NULL も等しいとみなして置き換える
+#   - チャンクはまず一時テーブルに入れ、書き込みのロックはチャンクごとの置き換えの間だけ取る。
+#     DB は WAL モードにするため、取り込み中も mark_db.py の読み取りは待たされない
+#   - チャンクごとに件数・rows/sec・ロックを保持した時間を表示する
+# ファイル名はテーブル名で始める（例: AdPerformance_2025-12-01.csv, CustomerAcquisition-2025-12.parquet）。
+#
+# 使い方:
+#   python ingest.py marketing.db drops/                       # drops/ 内の CSV / parquet を取り込む
+#   python ingest.py marketing.db drops/AdPerformance_2025-12.csv --full   # high-water mark より前の行も取り込む
+#   python ingest.py marketing.db drops/ --probe               # 取り込み中の読み取りの待ち時間も計測する
+#   python ingest.py marketing.db --status                     # テーブルごとの high-water mark を表示
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+
+from bulk_load import read_source
+from index_advisor import apply_migrations
+
+# テーブルごとの自然キー（先頭は日付の列）
+NATURAL_KEYS = {
+    "AdPerformance": ("date", "media_type", "account_type"),
+    "CustomerAcquisition": ("date", "utm_medium", "utm_source", "utm_campaign"),
+}
+
+# 1回の置き換え（＝1回の書き込みトランザクション）で扱う行数
+BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "2000"))
+
+# 他の接続が書き込み中の場合に待つ秒数
+BUSY_TIMEOUT = 30.0
+
+# --probe で取り込み中に繰り返し実行する読み取り（mark_db.py でよくある集計）
+PROBE_SQL = "SELECT media_type, SUM(cost), SUM(conversions) FROM AdPerformance GROUP BY media_type"
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _key_match(left, right, keys):
+    """NULL 同士も等しいとみなすキーの比較条件（IS はインデックスも使える）。"""
+    return " AND ".join(f"{left}.{_quote(k)} IS {right}.{_quote(k)}" for k in keys)
+
+
+def table_for(path):
+    """ファイル名から取り込み先のテーブルを決める（長い名前を優先）。"""
+    name = os.path.basename(path)
+    for table in sorted(NATURAL_KEYS, key=len, reverse=True):
+        if name.startswith(table):
+            return table
+    raise ValueError(f"{name}: ファイル名が {' / '.join(NATURAL_KEYS)} で始まっていません")
+
+
+def drop_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                glob.glob(os.path.join(path, "*.csv")) + glob.glob(os.path.join(path, "*.parquet"))
+            ))
+        else:
+            files.append(path)
+    return files
+
+
+# ==========================================
+# 1. 状態（high-water mark）
+# ==========================================
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    # WAL では書き込み中も読み取りが待たされない（設定はDBファイルに保存される）
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+
+def high_water_marks(conn):
+    return {
+        row[0]: {"high_water": row[1], "rows": row[2], "updated_at": row[3]}
+        for row in conn.execute("SELECT table_name, high_water, rows, updated_at FROM ingest_state")
+    }
+
+
+def _update_state(conn, table, high_water, rows):
+    conn.execute(
+        "INSERT INTO ingest_state (table_name, high_water, rows, updated_at) VALUES (?, ?, ?, datetime('now')) "
+        "ON CONFLICT (table_name) DO UPDATE SET "
+        "high_water = max(COALESCE(high_water, ''), excluded.high_water), "
+        "rows = rows + excluded.rows, updated_at = excluded.updated_at",
+        (table, high_water, rows),
+    )
+
+
+# ==========================================
+# 2. 取り込み
+# ==========================================
+
+class Ingestor:
+    """1つのファイルの取り込み。ファイル内で最初に現れたキーだけ既存の行を消し、ファイルの行で置き換える。"""
+
+    def __init__(self, conn, table, columns):
+        keys = NATURAL_KEYS[table]
+        existing = [row[1] for row in conn.execute(f"PRAGMA table_info({_quote(table)})")]
+        unknown = [c for c in columns if c not in existing]
+        missing = [k for k in keys if k not in columns]
+        if unknown or missing:
+            raise ValueError(
+                f"{table}: " + ", ".join(
+                    ([f"テーブルに無い列 {unknown}"] if unknown else []) + ([f"キーの列が無い {missing}"] if missing else [])
+                )
+            )
+        self.conn = conn
+        self.table = table
+        self.columns = columns
+        self.keys = keys
+        self.date_index = columns.index(keys[0])
+        cols = ", ".join(map(_quote, columns))
+        key_cols = ", ".join(map(_quote, keys))
+        conn.execute("DROP TABLE IF EXISTS temp.ingest_stage")
+        conn.execute("DROP TABLE IF EXISTS temp.ingest_seen")
+        # 列の型（親和性）は取り込み先と同じにする（CSV の文字列も数値として比較される）
+        conn.execute(f"CREATE TEMP TABLE ingest_stage AS SELECT {cols} FROM main.{_quote(table)} WHERE 0")
+        conn.execute(f"CREATE TEMP TABLE ingest_seen AS SELECT {key_cols} FROM main.{_quote(table)} WHERE 0")
+        conn.execute(f"CREATE INDEX temp.idx_ingest_seen ON ingest_seen ({key_cols})")
+        self._stage = f"INSERT INTO temp.ingest_stage ({cols}) VALUES ({', '.join('?' for _ in columns)})"
+        self._delete = (
+            f"DELETE FROM main.{_quote(table)} WHERE rowid IN ("
+            f"SELECT t.rowid FROM (SELECT DISTINCT {key_cols} FROM temp.ingest_stage) AS s "
+            f"JOIN main.{_quote(table)} AS t ON {_key_match('t', 's', keys)} "
+            f"WHERE NOT EXISTS (SELECT 1 FROM temp.ingest_seen AS z WHERE {_key_match('z', 's', keys)}))"
+        )
+        self._seen = (
+            f"INSERT INTO temp.ingest_seen SELECT DISTINCT {key_cols} FROM temp.ingest_stage AS s "
+            f"WHERE NOT EXISTS (SELECT 1 FROM temp.ingest_seen AS z WHERE {_key_match('z', 's', keys)})"
+        )
+        self._insert = f"INSERT INTO main.{_quote(table)} ({cols}) SELECT {cols} FROM temp.ingest_stage"
+
+    def merge(self, rows):
+        """
+        rows を1回の書き込みトランザクションで反映し、(消した行数, ロックを保持した秒数) を返す。
+        一時テーブルへの書き込みは main のロックを取らないため、先に済ませておく。
+        """
+        self.conn.execute("DELETE FROM temp.ingest_stage")
+        self.conn.executemany(self._stage, rows)
+        started = time.perf_counter()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            deleted = self.conn.execute(self._delete).rowcount
+            self.conn.execute(self._seen)
+            self.conn.execute(self._insert)
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return deleted, time.perf_counter() - started
+
+    def close(self):
+        self.conn.execute("DROP TABLE IF EXISTS temp.ingest_stage")
+        self.conn.execute("DROP TABLE IF EXISTS temp.ingest_seen")
+
+
+def ingest(db_path, paths, full=False, batch_size=BATCH_SIZE, on_batch=None):
+    """
+    差分ファイルを取り込み、ファイル・チャンクごとの結果を返す。
+    high-water mark は開始時点の値を使い（同じ実行内の後のファイルが前のファイルを上書きできる）、
+    ファイルを最後まで取り込んだ時点で更新する（途中で失敗しても、再実行でファイル全体をやり直せる）。
+    """
+    files = drop_files(paths)
+    report = {"db_path": db_path, "migrations": apply_migrations(db_path), "files": [], "batches": []}
+    conn = connect(db_path)
+    started = time.perf_counter()
+    try:
+        marks = {} if full else {t: s["high_water"] for t, s in high_water_marks(conn).items()}
+        for path in files:
+            table = table_for(path)
+            mark = marks.get(table)
+            file_started = time.perf_counter()
+            columns, batches = read_source(path, batch_size)
+            ingestor = Ingestor(conn, table, columns)
+            item = {"file": path, "table": table, "high_water_before": mark,
+                    "rows": 0, "skipped": 0, "deleted": 0, "high_water": None}
+            try:
+                for number, batch in enumerate(batches, 1):
+                    batch_started = time.perf_counter()
+                    dates = [row[ingestor.date_index] for row in batch]
+                    rows = [row for row, day in zip(batch, dates) if day is not None and (mark is None or day >= mark)]
+                    item["skipped"] += len(batch) - len(rows)
+                    if not rows:
+                        continue
+                    deleted, lock_seconds = ingestor.merge(rows)
+                    newest = max(row[ingestor.date_index] for row in rows)
+                    item["high_water"] = max(item["high_water"] or newest, newest)
+                    item["rows"] += len(rows)
+                    item["deleted"] += deleted
+                    seconds = time.perf_counter() - batch_started
+                    entry = {
+                        "file": os.path.basename(path), "batch": number, "rows": len(rows),
+                        "skipped": len(batch) - len(rows), "deleted": deleted,
+                        "lock_ms": round(lock_seconds * 1000, 2),
+                        "rows_per_sec": round(len(rows) / seconds) if seconds > 0 else None,
+                    }
+                    report["batches"].append(entry)
+                    if on_batch is not None:
+                        on_batch(entry)
+                if item["rows"]:
+                    conn.execute("BEGIN IMMEDIATE")
+                    _update_state(conn, table, item["high_water"], item["rows"])
+                    conn.execute("COMMIT")
+            finally:
+                ingestor.close()
+            item["seconds"] = round(time.perf_counter() - file_started, 4)
+            report["files"].append(item)
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        report["state"] = high_water_marks(conn)
+    finally:
+        conn.close()
+
+    seconds = time.perf_counter() - started
+    rows = sum(item["rows"] for item in report["files"])
+    locks = [batch["lock_ms"] for batch in report["batches"]]
+    report["rows"] = rows
+    report["seconds"] = round(seconds, 4)
+    report["rows_per_sec"] = round(rows / seconds) if seconds > 0 else None
+    if locks:
+        report["lock_ms"] = {"p50": round(statistics.median(locks), 2), "max": max(locks), "total": round(sum(locks), 2)}
+    return report
+
+
+# ==========================================
+# 3. 読み取りへの影響の計測
+# ==========================================
+
+class ReaderProbe:
+    """取り込み中に別スレッドから読み取りを繰り返し、1回ごとの待ち時間を記録する。"""
+
+    def __init__(self, db_path, sql=PROBE_SQL):
+        self.db_path = db_path
+        self.sql = sql
+        self.latencies = []
+        self.errors = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=BUSY_TIMEOUT)
+        try:
+            while not self._stop.is_set():
+                started = time.perf_counter()
+                try:
+                    conn.execute(self.sql).fetchall()
+                    self.latencies.append((time.perf_counter() - started) * 1000)
+                except sqlite3.OperationalError:
+                    self.errors += 1
+        finally:
+            conn.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def summary(self):
+        if not self.latencies:
+            return {"queries": 0, "errors": self.errors}
+        ordered = sorted(self.latencies)
+        return {
+            "queries": len(ordered),
+            "errors": self.errors,
+            "p50_ms": round(statistics.median(ordered), 2),
+            "p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 2),
+            "max_ms": round(ordered[-1], 2),
+        }
+
+
+# ==========================================
+# 4. コマンドライン
+# ==========================================
+
+def _print_batch(entry):
+    print(f"  {entry['file']} #{entry['batch']}: {entry['rows']:,} 行（読み飛ばし {entry['skipped']:,}・"
+          f"置き換え {entry['deleted']:,}） {entry['rows_per_sec'] or 0:,} rows/s / ロック {entry['lock_ms']:.2f}ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="marketing.db に CSV / parquet の差分を取り込む")
+    parser.add_argument("db_path")
+    parser.add_argument("paths", nargs="*", help="差分ファイル、またはそれを含むディレクトリ")
+    parser.add_argument("--full", action="store_true", help="high-water mark を無視してすべての行を取り込む")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--probe", action="store_true", help="取り込み中の読み取りの待ち時間を計測する")
+    parser.add_argument("--status", action="store_true", help="high-water mark を表示して終了する")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    args = parser.parse_args(argv)
+
+    if args.status:
+        apply_migrations(args.db_path)
+        with sqlite3.connect(args.db_path) as conn:
+            print(json.dumps(high_water_marks(conn), ensure_ascii=False, indent=2))
+        return 0
+    if not args.paths:
+        parser.error("取り込むファイルを指定してください")
+
+    on_batch = None if args.json else _print_batch
+    if args.probe:
+        with ReaderProbe(args.db_path) as probe:
+            report = ingest(args.db_path, args.paths, args.full, args.batch_size, on_batch)
+        report["readers"] = probe.summary()
+    else:
+        report = ingest(args.db_path, args.paths, args.full, args.batch_size, on_batch)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return 0
+    if report["migrations"]:
+        print("適用したマイグレーション: " + ", ".join(report["migrations"]))
+    for item in report["files"]:
+        print(f"{item['file']} → {item['table']}: {item['rows']:,} 行（読み飛ばし {item['skipped']:,}・"
+              f"置き換え {item['deleted']:,}） high-water mark {item['high_water_before']} → {item['high_water'] or item['high_water_before']}")
+    print(f"合計 {report['rows']:,} 行 / {report['seconds']:.3f}秒（{report['rows_per_sec'] or 0:,} rows/s）")
+    if "lock_ms" in report:
+        lock = report["lock_ms"]
+        print(f"書き込みロック: p50 {lock['p50']}ms / 最大 {lock['max']}ms / 合計 {lock['total']}ms")
+    if "readers" in report:
+        readers = report["readers"]
+        print(f"取り込み中の読み取り: {readers['queries']} 回"
+              + (f" p50 {readers['p50_ms']}ms / p99 {readers['p99_ms']}ms / 最大 {readers['max_ms']}ms"
+                 if readers["queries"] else "") + f" / エラー {readers['errors']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# 回答生成（Phase 3）のストリーミング表示
+# 生成完了を待たずに、届いたトークンから順に画面へ表示する。
+import os
+import time
+
+# STREAM_ANSWER=0 で従来どおり生成完了後にまとめて表示する
+STREAM_ENABLED = os.environ.get("STREAM_ANSWER", "1") != "0"
+
+
+class StreamStats:
+    """ストリーミング1回分の計測値（最初のトークンまでの時間など）"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+        self.chunks = 0
+        self.text = ""
+        self.usage = None
+
+    @property
+    def time_to_first_token(self):
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    @property
+    def total_time(self):
+        if self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+
+def iter_stream_text(stream, stats=None):
+    """
+    chat.completions の stream から本文の断片だけを順に返すジェネレータ。
+    stats を渡すと、最初のトークンまでの時間と全文を記録する。
+    """
+    stats = stats if stats is not None else StreamStats()
+    parts = []
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                stats.usage = chunk.usage
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.content
+            if not content:
+                continue
+            if stats.first_token_at is None:
+                stats.first_token_at = time.perf_counter()
+            stats.chunks += 1
+            parts.append(content)
+            yield content
+    finally:
+        stats.finished_at = time.perf_counter()
+        stats.text = "".join(parts)
+
+
+def stream_chat(client, stats=None, include_usage=True, **kwargs):
+    """
+    client.chat.completions.create(stream=True) を呼び出し、本文の断片を返すジェネレータを返す。
+    st.write_stream() にそのまま渡せる。
+    include_usage=False は stream_options に未対応のAPIバージョン向け。
+    """
+    stats = stats if stats is not None else StreamStats()
+    stats.started_at = time.perf_counter()
+    if include_usage:
+        kwargs["stream_options"] = {"include_usage": True}
+    stream = client.chat.completions.create(stream=True, **kwargs)
+    return iter_stream_text(stream, stats)
+
+
+def write_answer(client, stats=None, spinner_text="回答を作成中...", **kwargs):
+    """
+    回答を生成して画面に表示し、全文を返す。
+    ストリーミング有効時は届いたトークンから順に表示し、無効時は完了後にまとめて表示する。
+    """
+    import streamlit as st
+
+    stats = stats if stats is not None else StreamStats()
+    if STREAM_ENABLED:
+        return st.write_stream(stream_chat(client, stats, **kwargs))
+
+    stats.started_at = time.perf_counter()
+    with st.spinner(spinner_text):
+        response = client.chat.completions.create(**kwargs)
+    stats.first_token_at = stats.finished_at = time.perf_counter()
+    stats.text = response.choices[0].message.content
+    stats.usage = getattr(response, "usage", None)
+    st.write(stats.text)
+    return stats.text
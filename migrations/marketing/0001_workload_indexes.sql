@@ -0,0 +1,8 @@
+-- generated by index_advisor.py (2026-10-18)
+CREATE INDEX IF NOT EXISTS "idx_adperformance_media_type_date_conversions_cost" ON "AdPerformance" ("media_type", "date", "conversions", "cost");
+CREATE INDEX IF NOT EXISTS "idx_adperformance_year_month_cost" ON "AdPerformance" ("year", "month", "cost");
+CREATE INDEX IF NOT EXISTS "idx_adperformance_date_media_type_conversions_cost" ON "AdPerformance" ("date", "media_type", "conversions", "cost");
+CREATE INDEX IF NOT EXISTS "idx_customeracquisition_utm_source_y_new" ON "CustomerAcquisition" ("utm_source", "y_new");
+CREATE INDEX IF NOT EXISTS "idx_customeracquisition_utm_source_date_y_junin" ON "CustomerAcquisition" ("utm_source", "date", "y_junin");
+CREATE INDEX IF NOT EXISTS "idx_customeracquisition_utm_campaign_date_y_yoyaku" ON "CustomerAcquisition" ("utm_campaign", "date", "y_yoyaku");
+ANALYZE;
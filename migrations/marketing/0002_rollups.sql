@@ -0,0 +1,74 @@
+-- generated by rollups.py (2026-10-18)
+CREATE TABLE IF NOT EXISTS "CustomerAcquisition_monthly" ("ym", "utm_medium", "utm_source", "utm_campaign", "y_new" NOT NULL DEFAULT 0, "y_yoyaku" NOT NULL DEFAULT 0, "y_junin" NOT NULL DEFAULT 0, "row_count" INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS "idx_customeracquisition_monthly_dims" ON "CustomerAcquisition_monthly" ("ym", "utm_medium", "utm_source", "utm_campaign");
+DELETE FROM "CustomerAcquisition_monthly";
+INSERT INTO "CustomerAcquisition_monthly" ("ym", "utm_medium", "utm_source", "utm_campaign", y_new, y_yoyaku, y_junin, row_count) SELECT substr(date, 1, 7), utm_medium, utm_source, utm_campaign, SUM(COALESCE("y_new", 0)), SUM(COALESCE("y_yoyaku", 0)), SUM(COALESCE("y_junin", 0)), COUNT(*) FROM "CustomerAcquisition" GROUP BY substr(date, 1, 7), utm_medium, utm_source, utm_campaign;
+CREATE TRIGGER IF NOT EXISTS "trg_customeracquisition_monthly_insert" AFTER INSERT ON "CustomerAcquisition" BEGIN
+    INSERT INTO "CustomerAcquisition_monthly" ("ym", "utm_medium", "utm_source", "utm_campaign") SELECT substr(NEW.date, 1, 7), NEW.utm_medium, NEW.utm_source, NEW.utm_campaign WHERE NOT EXISTS (SELECT 1 FROM "CustomerAcquisition_monthly" WHERE "ym" IS substr(NEW.date, 1, 7) AND "utm_medium" IS NEW.utm_medium AND "utm_source" IS NEW.utm_source AND "utm_campaign" IS NEW.utm_campaign);
+    UPDATE "CustomerAcquisition_monthly" SET "y_new" = "y_new" + COALESCE(NEW.y_new, 0), "y_yoyaku" = "y_yoyaku" + COALESCE(NEW.y_yoyaku, 0), "y_junin" = "y_junin" + COALESCE(NEW.y_junin, 0), row_count = row_count + 1 WHERE "ym" IS substr(NEW.date, 1, 7) AND "utm_medium" IS NEW.utm_medium AND "utm_source" IS NEW.utm_source AND "utm_campaign" IS NEW.utm_campaign;
+END;
+CREATE TRIGGER IF NOT EXISTS "trg_customeracquisition_monthly_delete" AFTER DELETE ON "CustomerAcquisition" BEGIN
+    UPDATE "CustomerAcquisition_monthly" SET "y_new" = "y_new" - COALESCE(OLD.y_new, 0), "y_yoyaku" = "y_yoyaku" - COALESCE(OLD.y_yoyaku, 0), "y_junin" = "y_junin" - COALESCE(OLD.y_junin, 0), row_count = row_count - 1 WHERE "ym" IS substr(OLD.date, 1, 7) AND "utm_medium" IS OLD.utm_medium AND "utm_source" IS OLD.utm_source AND "utm_campaign" IS OLD.utm_campaign;
+    DELETE FROM "CustomerAcquisition_monthly" WHERE row_count <= 0 AND "ym" IS substr(OLD.date, 1, 7) AND "utm_medium" IS OLD.utm_medium AND "utm_source" IS OLD.utm_source AND "utm_campaign" IS OLD.utm_campaign;
+END;
+CREATE TRIGGER IF NOT EXISTS "trg_customeracquisition_monthly_update" AFTER UPDATE ON "CustomerAcquisition" BEGIN
+    UPDATE "CustomerAcquisition_monthly" SET "y_new" = "y_new" - COALESCE(OLD.y_new, 0), "y_yoyaku" = "y_yoyaku" - COALESCE(OLD.y_yoyaku, 0), "y_junin" = "y_junin" - COALESCE(OLD.y_junin, 0), row_count = row_count - 1 WHERE "ym" IS substr(OLD.date, 1, 7) AND "utm_medium" IS OLD.utm_medium AND "utm_source" IS OLD.utm_source AND "utm_campaign" IS OLD.utm_campaign;
+    DELETE FROM "CustomerAcquisition_monthly" WHERE row_count <= 0 AND "ym" IS substr(OLD.date, 1, 7) AND "utm_medium" IS OLD.utm_medium AND "utm_source" IS OLD.utm_source AND "utm_campaign" IS OLD.utm_campaign;
+    INSERT INTO "CustomerAcquisition_monthly" ("ym", "utm_medium", "utm_source", "utm_campaign") SELECT substr(NEW.date, 1, 7), NEW.utm_medium, NEW.utm_source, NEW.utm_campaign WHERE NOT EXISTS (SELECT 1 FROM "CustomerAcquisition_monthly" WHERE "ym" IS substr(NEW.date, 1, 7) AND "utm_medium" IS NEW.utm_medium AND "utm_source" IS NEW.utm_source AND "utm_campaign" IS NEW.utm_campaign);
+    UPDATE "CustomerAcquisition_monthly" SET "y_new" = "y_new" + COALESCE(NEW.y_new, 0), "y_yoyaku" = "y_yoyaku" + COALESCE(NEW.y_yoyaku, 0), "y_junin" = "y_junin" + COALESCE(NEW.y_junin, 0), row_count = row_count + 1 WHERE "ym" IS substr(NEW.date, 1, 7) AND "utm_medium" IS NEW.utm_medium AND "utm_source" IS NEW.utm_source AND "utm_campaign" IS NEW.utm_campaign;
+END;
+CREATE TABLE IF NOT EXISTS "AdPerformance_monthly" ("ym", "year", "month", "media_type", "account_type", "impressions" NOT NULL DEFAULT 0, "clicks" NOT NULL DEFAULT 0, "conversions" NOT NULL DEFAULT 0, "cost" NOT NULL DEFAULT 0, "row_count" INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS "idx_adperformance_monthly_dims" ON "AdPerformance_monthly" ("ym", "year", "month", "media_type", "account_type");
+DELETE FROM "AdPerformance_monthly";
+INSERT INTO "AdPerformance_monthly" ("ym", "year", "month", "media_type", "account_type", impressions, clicks, conversions, cost, row_count) SELECT substr(date, 1, 7), year, month, media_type, account_type, SUM(COALESCE("impressions", 0)), SUM(COALESCE("clicks", 0)), SUM(COALESCE("conversions", 0)), SUM(COALESCE("cost", 0)), COUNT(*) FROM "AdPerformance" GROUP BY substr(date, 1, 7), year, month, media_type, account_type;
+CREATE TRIGGER IF NOT EXISTS "trg_adperformance_monthly_insert" AFTER INSERT ON "AdPerformance" BEGIN
+    INSERT INTO "AdPerformance_monthly" ("ym", "year", "month", "media_type", "account_type") SELECT substr(NEW.date, 1, 7), NEW.year, NEW.month, NEW.media_type, NEW.account_type WHERE NOT EXISTS (SELECT 1 FROM "AdPerformance_monthly" WHERE "ym" IS substr(NEW.date, 1, 7) AND "year" IS NEW.year AND "month" IS NEW.month AND "media_type" IS NEW.media_type AND "account_type" IS NEW.account_type);
+    UPDATE "AdPerformance_monthly" SET "impressions" = "impressions" + COALESCE(NEW.impressions, 0), "clicks" = "clicks" + COALESCE(NEW.clicks, 0), "conversions" = "conversions" + COALESCE(NEW.conversions, 0), "cost" = "cost" + COALESCE(NEW.cost, 0), row_count = row_count + 1 WHERE "ym" IS substr(NEW.date, 1, 7) AND "year" IS NEW.year AND "month" IS NEW.month AND "media_type" IS NEW.media_type AND "account_type" IS NEW.account_type;
+END;
+CREATE TRIGGER IF NOT EXISTS "trg_adperformance_monthly_delete" AFTER DELETE ON "AdPerformance" BEGIN
+    UPDATE "AdPerformance_monthly" SET "impressions" = "impressions" - COALESCE(OLD.impressions, 0), "clicks" = "clicks" - COALESCE(OLD.clicks, 0), "conversions" = "conversions" - COALESCE(OLD.conversions, 0), "cost" = "cost" - COALESCE(OLD.cost, 0), row_count = row_count - 1 WHERE "ym" IS substr(OLD.date, 1, 7) AND "year" IS OLD.year AND "month" IS OLD.month AND "media_type" IS OLD.media_type AND "account_type" IS OLD.account_type;
+    DELETE FROM "AdPerformance_monthly" WHERE row_count <= 0 AND "ym" IS substr(OLD.date, 1, 7) AND "year" IS OLD.year AND "month" IS OLD.month AND "media_type" IS OLD.media_type AND "account_type" IS OLD.account_type;
+END;
+CREATE TRIGGER IF NOT EXISTS "trg_adperformance_monthly_update" AFTER UPDATE ON "AdPerformance" BEGIN
+    UPDATE "AdPerformance_monthly" SET "impressions" = "impressions" - COALESCE(OLD.impressions, 0), "clicks" = "clicks" - COALESCE(OLD.clicks, 0), "conversions" = "conversions" - COALESCE(OLD.conversions, 0), "cost" = "cost" - COALESCE(OLD.cost, 0), row_count = row_count - 1 WHERE "ym" IS substr(OLD.date, 1, 7) AND "year" IS OLD.year AND "month" IS OLD.month AND "media_type" IS OLD.media_type AND "account_type" IS OLD.account_type;
+    DELETE FROM "AdPerformance_monthly" WHERE row_count <= 0 AND "ym" IS substr(OLD.date, 1, 7) AND "year" IS OLD.year AND "month" IS OLD.month AND "media_type" IS OLD.media_type AND "account_type" IS OLD.account_type;
+    INSERT INTO "AdPerformance_monthly" ("ym", "year", "month", "media_type", "account_type") SELECT substr(NEW.date, 1, 7), NEW.year, NEW.month, NEW.media_type, NEW.account_type WHERE NOT EXISTS (SELECT 1 FROM "AdPerformance_monthly" WHERE "ym" IS substr(NEW.date, 1, 7) AND "year" IS NEW.year AND "month" IS NEW.month AND "media_type" IS NEW.media_type AND "account_type" IS NEW.account_type);
+    UPDATE "AdPerformance_monthly" SET "impressions" = "impressions" + COALESCE(NEW.impressions, 0), "clicks" = "clicks" + COALESCE(NEW.clicks, 0), "conversions" = "conversions" + COALESCE(NEW.conversions, 0), "cost" = "cost" + COALESCE(NEW.cost, 0), row_count = row_count + 1 WHERE "ym" IS substr(NEW.date, 1, 7) AND "year" IS NEW.year AND "month" IS NEW.month AND "media_type" IS NEW.media_type AND "account_type" IS NEW.account_type;
+END;
+CREATE TABLE IF NOT EXISTS "AdPerformance_daily" ("date", "year", "month", "media_type", "impressions" NOT NULL DEFAULT 0, "clicks" NOT NULL DEFAULT 0, "conversions" NOT NULL DEFAULT 0, "cost" NOT NULL DEFAULT 0, "row_count" INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS "idx_adperformance_daily_dims" ON "AdPerformance_daily" ("date", "year", "month", "media_type");
+DELETE FROM "AdPerformance_daily";
+INSERT INTO "AdPerformance_daily" ("date", "year", "month", "media_type", impressions, clicks, conversions, cost, row_count) SELECT date, year, month, media_type, SUM(COALESCE("impressions", 0)), SUM(COALESCE("clicks", 0)), SUM(COALESCE("conversions", 0)), SUM(COALESCE("cost", 0)), COUNT(*) FROM "AdPerformance" GROUP BY date, year, month, media_type;
+CREATE TRIGGER IF NOT EXISTS "trg_adperformance_daily_insert" AFTER INSERT ON "AdPerformance" BEGIN
+    INSERT INTO "AdPerformance_daily" ("date", "year", "month", "media_type") SELECT NEW.date, NEW.year, NEW.month, NEW.media_type WHERE NOT EXISTS (SELECT 1 FROM "AdPerformance_daily" WHERE "date" IS NEW.date AND "year" IS NEW.year AND "month" IS NEW.month AND "media_type" IS NEW.media_type);
+    UPDATE "AdPerformance_daily" SET "impressions" = "impressions" + COALESCE(NEW.impressions, 0), "clicks" = "clicks" + COALESCE(NEW.clicks, 0), "conversions" = "conversions" + COALESCE(NEW.conversions, 0), "cost" = "cost" + COALESCE(NEW.cost, 0), row_count = row_count + 1 WHERE "date" IS NEW.date AND "year" IS NEW.year AND "month" IS NEW.month AND "media_type" IS NEW.media_type;
+END;
+CREATE TRIGGER IF NOT EXISTS "trg_adperformance_daily_delete" AFTER DELETE ON "AdPerformance" BEGIN
+    UPDATE "AdPerformance_daily" SET "impressions" = "impressions" - COALESCE(OLD.impressions, 0), "clicks" = "clicks" - COALESCE(OLD.clicks, 0), "conversions" = "conversions" - COALESCE(OLD.conversions, 0), "cost" = "cost" - COALESCE(OLD.cost, 0), row_count = row_count - 1 WHERE "date" IS OLD.date AND "year" IS OLD.year AND "month" IS OLD.month AND "media_type" IS OLD.media_type;
+    DELETE FROM "AdPerformance_daily" WHERE row_count <= 0 AND "date" IS OLD.date AND "year" IS OLD.year AND "month" IS OLD.month AND "media_type" IS OLD.media_type;
+END;
+CREATE TRIGGER IF NOT EXISTS "trg_adperformance_daily_update" AFTER UPDATE ON "AdPerformance" BEGIN
+    UPDATE "AdPerformance_daily" SET "impressions" = "impressions" - COALESCE(OLD.impressions, 0), "clicks" = "clicks" - COALESCE(OLD.clicks, 0), "conversions" = "conversions" - COALESCE(OLD.conversions, 0), "cost" = "cost" - COALESCE(OLD.cost, 0), row_count = row_count - 1 WHERE "date" IS OLD.date AND "year" IS OLD.year AND "month" IS OLD.month AND "media_type" IS OLD.media_type;
+    DELETE FROM "AdPerformance_daily" WHERE row_count <= 0 AND "date" IS OLD.date AND "year" IS OLD.year AND "month" IS OLD.month AND "media_type" IS OLD.media_type;
+    INSERT INTO "AdPerformance_daily" ("date", "year", "month", "media_type") SELECT NEW.date, NEW.year, NEW.month, NEW.media_type WHERE NOT EXISTS (SELECT 1 FROM "AdPerformance_daily" WHERE "date" IS NEW.date AND "year" IS NEW.year AND "month" IS NEW.month AND "media_type" IS NEW.media_type);
+    UPDATE "AdPerformance_daily" SET "impressions" = "impressions" + COALESCE(NEW.impressions, 0), "clicks" = "clicks" + COALESCE(NEW.clicks, 0), "conversions" = "conversions" + COALESCE(NEW.conversions, 0), "cost" = "cost" + COALESCE(NEW.cost, 0), row_count = row_count + 1 WHERE "date" IS NEW.date AND "year" IS NEW.year AND "month" IS NEW.month AND "media_type" IS NEW.media_type;
+END;
+CREATE TABLE IF NOT EXISTS "CustomerAcquisition_daily" ("date", "utm_medium", "utm_source", "utm_campaign", "y_new" NOT NULL DEFAULT 0, "y_yoyaku" NOT NULL DEFAULT 0, "y_junin" NOT NULL DEFAULT 0, "row_count" INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS "idx_customeracquisition_daily_dims" ON "CustomerAcquisition_daily" ("date", "utm_medium", "utm_source", "utm_campaign");
+DELETE FROM "CustomerAcquisition_daily";
+INSERT INTO "CustomerAcquisition_daily" ("date", "utm_medium", "utm_source", "utm_campaign", y_new, y_yoyaku, y_junin, row_count) SELECT date, utm_medium, utm_source, utm_campaign, SUM(COALESCE("y_new", 0)), SUM(COALESCE("y_yoyaku", 0)), SUM(COALESCE("y_junin", 0)), COUNT(*) FROM "CustomerAcquisition" GROUP BY date, utm_medium, utm_source, utm_campaign;
+CREATE TRIGGER IF NOT EXISTS "trg_customeracquisition_daily_insert" AFTER INSERT ON "CustomerAcquisition" BEGIN
+    INSERT INTO "CustomerAcquisition_daily" ("date", "utm_medium", "utm_source", "utm_campaign") SELECT NEW.date, NEW.utm_medium, NEW.utm_source, NEW.utm_campaign WHERE NOT EXISTS (SELECT 1 FROM "CustomerAcquisition_daily" WHERE "date" IS NEW.date AND "utm_medium" IS NEW.utm_medium AND "utm_source" IS NEW.utm_source AND "utm_campaign" IS NEW.utm_campaign);
+    UPDATE "CustomerAcquisition_daily" SET "y_new" = "y_new" + COALESCE(NEW.y_new, 0), "y_yoyaku" = "y_yoyaku" + COALESCE(NEW.y_yoyaku, 0), "y_junin" = "y_junin" + COALESCE(NEW.y_junin, 0), row_count = row_count + 1 WHERE "date" IS NEW.date AND "utm_medium" IS NEW.utm_medium AND "utm_source" IS NEW.utm_source AND "utm_campaign" IS NEW.utm_campaign;
+END;
+CREATE TRIGGER IF NOT EXISTS "trg_customeracquisition_daily_delete" AFTER DELETE ON "CustomerAcquisition" BEGIN
+    UPDATE "CustomerAcquisition_daily" SET "y_new" = "y_new" - COALESCE(OLD.y_new, 0), "y_yoyaku" = "y_yoyaku" - COALESCE(OLD.y_yoyaku, 0), "y_junin" = "y_junin" - COALESCE(OLD.y_junin, 0), row_count = row_count - 1 WHERE "date" IS OLD.date AND "utm_medium" IS OLD.utm_medium AND "utm_source" IS OLD.utm_source AND "utm_campaign" IS OLD.utm_campaign;
+    DELETE FROM "CustomerAcquisition_daily" WHERE row_count <= 0 AND "date" IS OLD.date AND "utm_medium" IS OLD.utm_medium AND "utm_source" IS OLD.utm_source AND "utm_campaign" IS OLD.utm_campaign;
+END;
+CREATE TRIGGER IF NOT EXISTS "trg_customeracquisition_daily_update" AFTER UPDATE ON "CustomerAcquisition" BEGIN
+    UPDATE "CustomerAcquisition_daily" SET "y_new" = "y_new" - COALESCE(OLD.y_new, 0), "y_yoyaku" = "y_yoyaku" - COALESCE(OLD.y_yoyaku, 0), "y_junin" = "y_junin" - COALESCE(OLD.y_junin, 0), row_count = row_count - 1 WHERE "date" IS OLD.date AND "utm_medium" IS OLD.utm_medium AND "utm_source" IS OLD.utm_source AND "utm_campaign" IS OLD.utm_campaign;
+    DELETE FROM "CustomerAcquisition_daily" WHERE row_count <= 0 AND "date" IS OLD.date AND "utm_medium" IS OLD.utm_medium AND "utm_source" IS OLD.utm_source AND "utm_campaign" IS OLD.utm_campaign;
+    INSERT INTO "CustomerAcquisition_daily" ("date", "utm_medium", "utm_source", "utm_campaign") SELECT NEW.date, NEW.utm_medium, NEW.utm_source, NEW.utm_campaign WHERE NOT EXISTS (SELECT 1 FROM "CustomerAcquisition_daily" WHERE "date" IS NEW.date AND "utm_medium" IS NEW.utm_medium AND "utm_source" IS NEW.utm_source AND "utm_campaign" IS NEW.utm_campaign);
+    UPDATE "CustomerAcquisition_daily" SET "y_new" = "y_new" + COALESCE(NEW.y_new, 0), "y_yoyaku" = "y_yoyaku" + COALESCE(NEW.y_yoyaku, 0), "y_junin" = "y_junin" + COALESCE(NEW.y_junin, 0), row_count = row_count + 1 WHERE "date" IS NEW.date AND "utm_medium" IS NEW.utm_medium AND "utm_source" IS NEW.utm_source AND "utm_campaign" IS NEW.utm_campaign;
+END;
+ANALYZE;
@@ -0,0 +1,5 @@
+-- generated by ingest.py (2026-10-18)
+CREATE TABLE IF NOT EXISTS "ingest_state" ("table_name" TEXT PRIMARY KEY, "high_water" TEXT, "rows" INTEGER NOT NULL DEFAULT 0, "updated_at" TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS "idx_adperformance_natural_key" ON "AdPerformance" ("date", "media_type", "account_type");
+CREATE INDEX IF NOT EXISTS "idx_customeracquisition_natural_key" ON "CustomerAcquisition" ("date", "utm_medium", "utm_source", "utm_campaign");
+ANALYZE;
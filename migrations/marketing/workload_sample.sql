@@ -0,0 +1,56 @@
+-- mark_db.py の質問例から作った代表的なワークロード（index_advisor.py --workload-file 用）
+
+-- 先月のGoogle広告のCPAはいくら？
+SELECT SUM(cost) / NULLIF(SUM(conversions), 0) AS cpa
+FROM AdPerformance
+WHERE media_type = 'Google' AND date BETWEEN '2025-10-01' AND '2025-10-31';
+
+-- 先月のGoogle広告のCPA（LIKE での月指定）
+SELECT SUM(cost) / NULLIF(SUM(conversions), 0) AS cpa
+FROM AdPerformance
+WHERE media_type = 'Google' AND date LIKE '2025-10%';
+
+-- 先月の媒体別CPA
+SELECT media_type, SUM(cost) / NULLIF(SUM(conversions), 0) AS cpa
+FROM AdPerformance
+WHERE date BETWEEN '2025-10-01' AND '2025-10-31'
+GROUP BY media_type;
+
+-- 媒体ごとの獲得件数を比較して
+SELECT media_type, SUM(conversions) AS conversions
+FROM AdPerformance
+GROUP BY media_type
+ORDER BY conversions DESC;
+
+-- 月別の広告費の推移
+SELECT year, month, SUM(cost) AS cost
+FROM AdPerformance
+GROUP BY year, month
+ORDER BY year, month;
+
+-- ブランド別の今月のクリック数
+SELECT account_type, SUM(clicks) AS clicks
+FROM AdPerformance
+WHERE date >= '2025-11-01'
+GROUP BY account_type;
+
+-- キャンペーンAからの予約数は？
+SELECT SUM(y_yoyaku) AS yoyaku
+FROM CustomerAcquisition
+WHERE utm_campaign = 'campaignA';
+
+-- 流入元別の新規リード数
+SELECT utm_source, SUM(y_new) AS y_new
+FROM CustomerAcquisition
+GROUP BY utm_source;
+
+-- 先月のyahooからの受任数
+SELECT SUM(y_junin) AS junin
+FROM CustomerAcquisition
+WHERE utm_source = 'yahoo' AND date BETWEEN '2025-10-01' AND '2025-10-31';
+
+-- 先月のキャンペーン別予約数
+SELECT utm_campaign, SUM(y_yoyaku) AS yoyaku
+FROM CustomerAcquisition
+WHERE date LIKE '2025-10%'
+GROUP BY utm_campaign;
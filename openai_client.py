@@ -0,0 +1,24 @@
+# txt2sql / mark_db で使う OpenAI クライアントのプロセス内共有
+# Streamlit は操作のたびにページのスクリプトを最初から実行し直すため、ページの先頭で
+# OpenAI(api_key=...) を作ると再実行ごとにクライアント（と HTTP の接続プール）を作り直していた。
+# openai パッケージの import も最初に必要になるまで遅らせる。
+import hashlib
+import threading
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_openai_client(api_key):
+    """
+    APIキーごとにプロセス内で共有する OpenAI クライアントを返す（初回呼び出し時に作成）。
+    キーそのものは保持せず、ハッシュで区別する。
+    """
+    fingerprint = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    with _clients_lock:
+        client = _clients.get(fingerprint)
+        if client is None:
+            from openai import OpenAI
+
+            client = _clients[fingerprint] = OpenAI(api_key=api_key)
+        return client
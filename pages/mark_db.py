@@ -1,9 +1,18 @@
 import os
 import sqlite3
+import uuid
 import streamlit as st
-from openai import OpenAI
 from datetime import datetime  # 追加: 日付操作用
 
+from followup import get_followup_store, previous_result
+from llm_stream import StreamStats, write_answer
+from openai_client import get_openai_client
+from pipeline import MODEL, PIPELINES, marketing_context
+from query_guard import QueryBudgetExceeded, st_run_cancellable
+from sql_cache import get_sql_cache
+from sql_candidates import PARALLEL_ENABLED, CandidateGenerationFailed
+from tracing import show_trace
+
 # ページ設定
 st.set_page_config(page_title="Marketing AI Analyst", layout="centered")
 
@@ -38,75 +47,32 @@ if not api_key:
     st.error("OpenAI APIキーが設定されていません。st.secrets または環境変数を設定してください。")
     st.stop()
 
-# OpenAIクライアントの初期化
-client = OpenAI(api_key=api_key)
+# OpenAIクライアント（プロセス内で共有し、再実行のたびには作り直さない）
+client = get_openai_client(api_key)
+
+# 候補SQLの並列生成（候補数・制限時間は SQL_CANDIDATES などで変更可能）
+parallel_generation = st.sidebar.checkbox("候補SQLを並列生成して自動修正する", value=PARALLEL_ENABLED)
 
 # ==========================================
-# 2. プロンプト定義 (スキーマ情報 + 日付指示)
+# 2. 処理の流れ（プロンプト定義・スキーマ情報は pipeline.py）
 # ==========================================
 
+pipeline = PIPELINES["mark_db"]
+
+# 追加質問（followup.py）で使う、このブラウザのセッションの直前の結果のキー（ページごとに分ける）
+followup_session = f"{pipeline.name}:{st.session_state.setdefault('followup_session_id', uuid.uuid4().hex)}"
+
 # 今日の日付を取得 (YYYY-MM-DD形式)
 current_date = datetime.now().strftime("%Y-%m-%d")
 
-DB_SCHEMA_PROMPT = """
-あなたは経験豊富なマーケティングデータアナリストです。
-以下のテーブル定義を参考にして、ユーザーの質問に対するSQLを生成してください。
-
-CREATE TABLE "AdPerformance" (
-    "date" TEXT,          -- 日付 (YYYY-MM-DD)
-    "media_type" TEXT,    -- 媒体 (Google, Yahooなど)
-    "account_type" TEXT,  -- アカウント/ブランド名
-    "impressions" INTEGER,-- 表示回数
-    "clicks" INTEGER,     -- クリック数
-    "conversions" INTEGER,-- コンバージョン(獲得)数
-    "cost" REAL,          -- 費用(コスト)
-    "month" INTEGER,      -- 月
-    "year" INTEGER        -- 年
-);
-
-CREATE TABLE "CustomerAcquisition" (
-    "date" TEXT,          -- 日付 (YYYY-MM-DD)
-    "utm_medium" TEXT,    -- 媒体 (cpc, organic, snsなど)
-    "utm_source" TEXT,    -- ソース (google, yahoo, instagramなど)
-    "utm_campaign" TEXT,  -- キャンペーン名（campaignA, campaignBなど）
-    "y_new" INTEGER,      -- 新規リード数
-    "y_yoyaku" INTEGER,   -- 予約数
-    "y_junin" INTEGER     -- 受任(成約)数
-);
-
-**重要ルール**:
-1. 日付カラム `date` は 'YYYY-MM-DD' 文字列形式です。
-2. **日付計算**: 「今日」「先月」「直近30日」などの指示があった場合は、後述する【現在の日付】を基準にSQLの `WHERE` 句を作成してください。
-   - 例（先月）: `WHERE date BETWEEN date('now', 'start of month', '-1 month') AND date('now', 'start of month', '-1 day')` ※SQLite関数を使用、または文字列比較で範囲指定を行ってください。
-   - SQLiteでは `strftime` や文字列比較が有効です。例: `date LIKE '2023-11%'`
-3. CPA（獲得単価）の計算: `SUM(cost) / NULLIF(SUM(conversions), 0)`
-4. 出力: 説明なしで、実行可能なSQLクエリ（SELECT文）のみを返してください。
-""".strip()
-
-RESPONSE_GENERATION_PROMPT_TEMPLATE = """
-以下の【データ】に基づき、ユーザーの問い合わせに対する適切な回答を作成してください。
-
-回答作成のガイドライン:
-1. **目的の確認:** ユーザーの質問意図を理解する。
-2. **結果の分析:** SQL実行結果から数値を読み取り、増減や傾向を分析する。
-3. **回答の構成:** 「現在の日付（{current_date}）時点でのデータによると...」のように、いつの時点の情報かを意識して回答する。
-
----
-### 【データ】
-#### ユーザーの問い合わせ
-{question}
-
-#### 実行されたSQL
-{sql}
-
-#### SQLの実行結果
-{context}
-""".strip()
-
 # ==========================================
 # 3. アプリケーションロジック
 # ==========================================
 
+# 前回の実行中にキャンセルボタンが押された場合
+if st.session_state.pop("query_cancelled", False):
+    st.info("実行中のクエリをキャンセルしました。")
+
 # ユーザーからの入力を受け取る
 if user_input := st.chat_input("質問を入力してください（例：先月の媒体別CPAを教えて）"):
 
@@ -115,66 +81,129 @@ if user_input := st.chat_input("質問を入力してください（例：先月
         st.write(user_input)
 
     with st.chat_message("assistant"):
+        # SQL生成の前に失敗した場合（キャッシュのDBのエラーなど）もエラー表示で参照できるようにする
+        turn = None
+        generated_sql = None
         # --- Phase 1: SQL生成 ---
         with st.spinner("データを分析中..."):
             try:
-                # APIに「今日の日付」を伝えるメッセージを追加
-                messages_for_sql = [
-                    {"role": "system", "content": DB_SCHEMA_PROMPT},
-                    {"role": "system", "content": f"【システム情報】現在の日付は {current_date} です。ユーザーが「今月」や「先月」と言った場合、この日付を基準にしてください。"},
-                    {"role": "user", "content": user_input}
-                ]
-
-                sql_response = client.chat.completions.create(
-                    model="gpt-4o", 
-                    messages=messages_for_sql,
-                )
-                generated_sql = sql_response.choices[0].message.content
-                
-                # SQLから余計な装飾（Markdownなど）があれば除去
-                generated_sql = generated_sql.replace("```sql", "").replace("```", "").strip()
+                db_path = pipeline.db_path
 
-                # --- Phase 2: SQL実行 ---
-                db_path = "marketing.db"
-                
                 if not os.path.exists(db_path):
                     st.error(f"データベース '{db_path}' が見つかりません。DB作成スクリプトを実行してください。")
                     st.stop()
 
-                with sqlite3.connect(db_path) as conn:
-                    cursor = conn.execute(generated_sql)
-                    columns = [description[0] for description in cursor.description]
-                    query_results = cursor.fetchall()
-                    
-                    formatted_results = [dict(zip(columns, row)) for row in query_results]
+                # APIに「今日の日付」を伝え、同じ質問・同じ基準日で生成済みのSQLがあれば再利用する
+                # （追加質問ではSQLキャッシュを使わない）
+                previous = previous_result(followup_session, user_input)
+                turn = pipeline.start(user_input, previous=previous, **marketing_context(current_date))
+                # 直前の結果の絞り込み・並べ替えで答えられる追加質問なら、その結果（prev_result）に対してSQLを生成・実行する
+                # （答えられなければ、直前の質問とSQLを伝えて元のテーブルで処理する）
+                if previous is not None:
+                    pipeline.followup(client, turn, previous)
+                if turn.sql is None and parallel_generation:
+                    # 候補SQLを並列に生成・実行して最初に成功したものを採用する（失敗した候補はエラーを伝えて修正させる）
+                    st_run_cancellable(lambda cancel_event: pipeline.generate_candidates(client, turn, cancel_event))
+                elif turn.sql is None:
+                    pipeline.generate_sql(client, turn)
+                generated_sql = turn.sql
+
+                # --- Phase 2: SQL実行 ---
+                # DBが変更されていなければ、同じSQLの実行結果を再利用する
+                # 集計クエリは集計済みテーブル（rollups.py）へ振り分ける（初回は元テーブルとの一致を確認）
+                if turn.summary is None and not pipeline.cached_result(turn):
+                    # 上限を超えたら中断する（実行中はキャンセルボタンでも中断できる）
+                    st_run_cancellable(lambda cancel_event: pipeline.execute(turn, cancel_event))
+                result_summary = turn.summary
+                executed_sql = turn.executed_sql
+
+                columns, query_results = result_summary.columns, result_summary.rows
+                formatted_results = [dict(zip(columns, row)) for row in query_results]
+
+                # 実行に成功したSQLのみキャッシュする
+                pipeline.remember_sql(turn)
 
                 # --- Phase 3: 自然言語での回答生成 ---
-                final_prompt = RESPONSE_GENERATION_PROMPT_TEMPLATE.format(
-                    question=user_input,
-                    sql=generated_sql,
-                    context=str(formatted_results),
-                    current_date=current_date # テンプレートにも日付を渡す
-                )
-
-                final_response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": "あなたはマーケティングデータのアシスタントです。"},
-                        {"role": "user", "content": final_prompt}
-                    ],
-                )
-                natural_language_answer = final_response.choices[0].message.content
-
-                # 結果の表示
-                st.write(natural_language_answer)
-                
+                # 1つの値・1行・短い一覧・小さな集計表は、LLMを呼ばずに定型文と表で回答する（answer_templates.py）
+                natural_language_answer = pipeline.template_answer(turn)
+                # 同じ質問・同じ結果・同じ基準日に対する回答が既にあれば再利用する
+                if natural_language_answer is None:
+                    natural_language_answer = pipeline.cached_answer(turn)
+                answer_stats = None
+                if natural_language_answer is not None:
+                    st.write(natural_language_answer)
+                else:
+                    # 結果の表示（生成されたトークンから順に表示する）
+                    answer_stats = StreamStats()
+                    natural_language_answer = write_answer(
+                        client,
+                        answer_stats,
+                        model=MODEL,
+                        messages=pipeline.answer_messages(turn),
+                    )
+                    pipeline.store_answer(turn, natural_language_answer, answer_stats)
+                # 次の質問が追加質問だった場合に使えるよう、この結果をセッションの直前の結果として保持する
+                get_followup_store().put(followup_session, turn)
+                turn.trace.finish("ok")
+
                 # デバッグ用情報
                 with st.expander(f"詳細データ（基準日: {current_date}）"):
+                    if turn.followup is not None:
+                        st.caption(f"直前の結果（{turn.followup.row_count} 行）に対して実行したSQL:")
                     st.code(generated_sql, language="sql")
+                    if executed_sql != generated_sql:
+                        st.caption("集計済みテーブルで実行したSQL:")
+                        st.code(executed_sql, language="sql")
                     st.write("検索結果:", formatted_results)
-
+                    if result_summary.truncated:
+                        st.caption(f"※ 結果が多いため先頭 {result_summary.row_count} 行までを取得しました。")
+                    token_report = result_summary.token_report(as_dicts=True)
+                    st.caption(f"回答生成に渡した結果: 約 {token_report['before']} → {token_report['after']} トークン")
+                    schema = turn.schema
+                    sql_generation_time = turn.timings.get("generate_sql")
+                    st.caption(
+                        f"スキーマ: {len(schema.tables)}/{len(schema.all_tables)} テーブル"
+                        f"（約 {schema.full_tokens} → {schema.tokens} トークン）"
+                        + (f" / SQL生成 {sql_generation_time:.2f}秒" if sql_generation_time is not None else "")
+                    )
+                    if turn.candidate_result is not None:
+                        winner = turn.candidate_result.winner
+                        st.caption(
+                            f"候補SQL: {len(turn.candidate_result.attempts)} 件実行"
+                            f"（採用: 候補{winner['candidate'] + 1}・修正 {winner['round']} 回）"
+                        )
+                    cache_stats = get_sql_cache().stats()
+                    st.caption(
+                        f"SQLキャッシュ: {'ヒット' if turn.sql_from_cache else 'ミス'}"
+                        f"（累計 ヒット {cache_stats['hits']} / ミス {cache_stats['misses']}）"
+                    )
+                    if turn.answer_template is not None:
+                        st.caption(f"回答生成: 定型文（結果の形: {turn.answer_template}）のためLLMを呼び出していません")
+                    if answer_stats is not None and answer_stats.time_to_first_token is not None:
+                        st.caption(
+                            f"回答生成: 最初のトークンまで {answer_stats.time_to_first_token:.2f}秒"
+                            f" / 完了まで {answer_stats.total_time:.2f}秒"
+                        )
+                    # フェーズごとの時間・トークン数・キャッシュの内訳（tracing.py）
+                    show_trace(turn.trace)
+
+            except QueryBudgetExceeded as e:
+                st.error(e.user_message())
+                st.json(e.to_dict())
+                if turn is not None and turn.sql:
+                    st.warning(f"生成されたSQL: {turn.sql}")
+            except CandidateGenerationFailed as e:
+                st.error(f"SQL実行エラー: {e}")
+                st.write("試行した候補SQL:", [
+                    {"候補": (a["candidate"] or 0) + 1, "SQL": a["sql"], "エラー": a["error"]} for a in e.attempts
+                ])
             except sqlite3.Error as e:
                 st.error(f"SQL実行エラー: {e}")
-                st.warning(f"生成されたSQL: {generated_sql}")
+                if turn is not None and turn.sql:
+                    st.warning(f"生成されたSQL: {turn.sql}")
             except Exception as e:
                 st.error(f"エラーが発生しました: {e}")
+            finally:
+                # 途中で失敗・中断したターンもエラーとして集計する
+                if turn is not None:
+                    turn.trace.finish("ok" if turn.answer is not None else "error")
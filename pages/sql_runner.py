@@ -1,67 +1,228 @@
 import streamlit as st
-import sqlite3
-import pandas as pd
 import os
 
+from db_pool import get_pool, run_once
+from db_writer import WriteTimeout, get_writer
+from result_cache import estimate_size
+from result_export import DOWNLOAD_MAX_BYTES, FORMATS, export_query, parquet_available
+
 # --- 1. データベース接続の設定 ---
 
 DB_NAME = "Chinook.db"
 
-# @st.cache_resource は削除！
+# @st.cache_resource で1本の接続を共有するとスレッド間で競合するため、
+# スレッドごとに接続を貸し出すプロセス共通のプールを使う。
 def get_connection(db_name):
     """
-    データベースへの新しい接続を作成します。
-    （接続は使用後に呼び出し元で閉じる必要があります。）
+    接続プールから接続を借ります。
+    （接続は使用後に呼び出し元で release_connection() により返却する必要があります。）
     """
     try:
-        # 接続を作成
-        conn = sqlite3.connect(db_name)
-        return conn
+        return get_pool(db_name).acquire()
     except Exception as e:
         st.error(f"データベース接続エラー: {e}")
         return None
 
+def release_connection(db_name, conn):
+    """借りた接続をプールに返却します（未確定の変更はロールバックされます）。"""
+    get_pool(db_name).release(conn)
+
 # 初期テーブル作成（初回実行時のみ。動作確認用）
-# setup_database関数内では、渡されたconnを commit/close する必要はありません。
+# setup_database関数は書き込み用のスレッド（db_writer.py）で実行されるため、
+# 渡されたconnを commit/close する必要はなく、st の関数も呼ばない。初期データを入れた場合は True を返す。
 def setup_database(conn):
-    # ... (変更なし) ...
-    try:
-        cursor = conn.cursor()
-        # テーブルが存在しない場合のみ作成
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                name TEXT NOT NULL,
-                age INTEGER
-            )
-        """)
-        # 初期データ挿入
-        cursor.execute("SELECT COUNT(*) FROM users")
-        if cursor.fetchone()[0] == 0:
-            cursor.execute("INSERT INTO users (name, age) VALUES ('Alice', 30)")
-            cursor.execute("INSERT INTO users (name, age) VALUES ('Bob', 25)")
-            conn.commit()
+    cursor = conn.cursor()
+    # テーブルが存在しない場合のみ作成
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            age INTEGER
+        )
+    """)
+    # 初期データ挿入
+    cursor.execute("SELECT COUNT(*) FROM users")
+    if cursor.fetchone()[0] == 0:
+        cursor.execute("INSERT INTO users (name, age) VALUES ('Alice', 30)")
+        cursor.execute("INSERT INTO users (name, age) VALUES ('Bob', 25)")
+        return True
+    return False
+
+
+def setup_database_once(db_name):
+    """setup_database をプロセス内で一度だけ実行する（rerunごとには実行しない）。"""
+    def _setup():
+        if get_writer(db_name).submit(setup_database).result():
             st.toast("初期テーブル (users) とデータを作成しました。", icon='✅')
+    try:
+        run_once(("setup_database", db_name), _setup)
+        return True
     except Exception as e:
         st.error(f"データベース初期設定エラー: {e}")
+        return False
+
+
+# --- 2. 参照クエリの結果表示（ページ単位） ---
+
+PAGE_SIZE_OPTIONS = [50, 100, 500, 1000]
+# 1ページの表示に使うメモリの上限（推定バイト数）
+MAX_PAGE_BYTES = 8 * 1024 * 1024
+FETCH_BATCH_SIZE = 200
+
+def fetch_page(conn, sql, page, page_size, max_bytes=MAX_PAGE_BYTES):
+    """
+    sql の page ページ目（0始まり）を取得します。
+    前のページの行は fetchmany で読み飛ばすだけで保持しないため、メモリ使用量は1ページ分に限られます。
+    戻り値: (列名, 行, 次の行があるか, メモリ上限でページの途中で打ち切ったか)
+    """
+    cursor = conn.execute(sql)
+    try:
+        columns = [description[0] for description in cursor.description or ()]
+        to_skip = page * page_size
+        while to_skip > 0:
+            batch = cursor.fetchmany(min(FETCH_BATCH_SIZE, to_skip))
+            if not batch:
+                break
+            to_skip -= len(batch)
+
+        rows = []
+        used = 0
+        truncated = False
+        while len(rows) < page_size and not truncated:
+            batch = cursor.fetchmany(min(FETCH_BATCH_SIZE, page_size - len(rows)))
+            if not batch:
+                break
+            for row in batch:
+                used += estimate_size(row)
+                if used > max_bytes:
+                    truncated = True
+                    break
+                rows.append(row)
+        has_more = truncated or bool(cursor.fetchmany(1))
+        return columns, rows, has_more, truncated
+    finally:
+        cursor.close()
+
+def count_rows(conn, sql):
+    """総行数を数えます（SELECT は COUNT(*) で、PRAGMA などは読み飛ばしながら数えます）。"""
+    if sql.strip().split()[0].upper() == "SELECT":
+        inner = sql.strip().rstrip(";")
+        return conn.execute(f"SELECT COUNT(*) FROM (\n{inner}\n)").fetchone()[0]
+    cursor = conn.execute(sql)
+    count = 0
+    while batch := cursor.fetchmany(1000):
+        count += len(batch)
+    return count
+
+def _change_page(delta):
+    st.session_state.sql_viewer["page"] = max(0, st.session_state.sql_viewer["page"] + delta)
+
+def _change_page_size():
+    st.session_state.sql_viewer["page_size"] = st.session_state.sql_viewer_page_size
+    st.session_state.sql_viewer["page"] = 0
+
+def _request_count():
+    st.session_state.sql_viewer["count_requested"] = True
+
+def render_result_viewer():
+    """直近に実行した参照クエリの結果を1ページずつ表示します。"""
+    state = st.session_state.get("sql_viewer")
+    if not state:
+        return
+
+    conn = get_connection(DB_NAME)
+    if conn is None:
+        return
+    try:
+        if state["count_requested"] and state["count"] is None:
+            state["count"] = count_rows(conn, state["sql"])
+        columns, rows, has_more, truncated = fetch_page(
+            conn, state["sql"], state["page"], state["page_size"]
+        )
+    except Exception as e:
+        st.error("クエリ実行エラーが発生しました。")
+        st.exception(e)
+        return
+    finally:
+        release_connection(DB_NAME, conn)
+
+    # pandas の import は結果を表示するときまで遅らせる（ページの初回表示を速くするため）
+    import pandas as pd
+
+    st.success("クエリ実行成功！ (参照)")
+    st.dataframe(pd.DataFrame(rows, columns=columns), use_container_width=True)
+    if truncated:
+        st.warning("1ページのデータ量が上限を超えたため、このページは途中までを表示しています。")
+
+    first = state["page"] * state["page_size"] + 1
+    last = first + len(rows) - 1
+    col_prev, col_info, col_next, col_size = st.columns([1, 2, 1, 1])
+    col_prev.button("◀ 前へ", on_click=_change_page, args=(-1,), disabled=state["page"] == 0)
+    col_info.caption(f"{first}〜{last}行目を表示中" if rows else "該当する行はありません")
+    col_next.button("次へ ▶", on_click=_change_page, args=(1,), disabled=not has_more)
+    col_size.selectbox(
+        "1ページの行数", PAGE_SIZE_OPTIONS,
+        index=PAGE_SIZE_OPTIONS.index(state["page_size"]),
+        key="sql_viewer_page_size", on_change=_change_page_size, label_visibility="collapsed",
+    )
+
+    # 総行数は全件を読む必要があるため、求められた場合のみ数える
+    if state["count"] is not None:
+        st.info(f"取得行数: {state['count']}行")
+    elif state["page"] == 0 and not has_more:
+        st.info(f"取得行数: {len(rows)}行")
+    else:
+        st.button("総行数を数える", on_click=_request_count)
 
+    render_export(state["sql"])
 
-# --- 2. Streamlitページのメイン処理 ---
+
+def render_export(sql):
+    """
+    参照クエリの結果全体（表示中のページだけでなく全行）をファイルに書き出してダウンロードできるようにします。
+    カーソルから一定の行数ずつ書き出すため、DataFrame は作らず、結果が大きくてもメモリは増えません。
+    """
+    with st.expander("結果をファイルに書き出す（CSV / Parquet）"):
+        formats = ["csv"] + (["parquet"] if parquet_available() else [])
+        fmt = st.radio("形式", formats, horizontal=True, key="sql_export_format")
+        if st.button("書き出す", key="sql_export_button"):
+            try:
+                with st.spinner("書き出し中..."):
+                    st.session_state.sql_export = dict(export_query(DB_NAME, sql, fmt), sql=sql)
+            except Exception as e:
+                st.error("書き出しに失敗しました。")
+                st.exception(e)
+                return
+
+        result = st.session_state.get("sql_export")
+        if not result or result["sql"] != sql or not os.path.exists(result["path"]):
+            return
+        size_mb = result["bytes"] / 1024 / 1024
+        if "rows" in result:
+            st.caption(f"{result['rows']}行 / {size_mb:.1f}MB / {result['seconds']:.2f}秒"
+                       f"（{result['rows_per_sec'] or 0:,} rows/s）")
+        else:
+            st.caption(f"{size_mb:.1f}MB（DBが変更されていないため、前回書き出したファイルを使います）")
+        if result["bytes"] > DOWNLOAD_MAX_BYTES:
+            st.info(f"ファイルが大きいためダウンロードボタンは表示しません。サーバー上の `{result['path']}` を使うか、"
+                    "`python result_export.py export` で書き出してください。")
+            return
+        with open(result["path"], "rb") as f:
+            st.download_button(
+                "ダウンロード", f, file_name=f"query_result.{result['format']}", mime=FORMATS[result["format"]],
+            )
+
+
+# --- 3. Streamlitページのメイン処理 ---
 
 def sql_runner_page():
     st.title("🗄️ SQLクエリ実行ページ")
     st.markdown(f"**接続データベース:** `{DB_NAME}` (SQLite)")
 
-    # setup_databaseのための一時的な接続
-    temp_conn = get_connection(DB_NAME)
-
-    if temp_conn is None:
+    # 初回実行時のみデータベースのセットアップを行う（プロセス内で一度だけ）
+    if not setup_database_once(DB_NAME):
         st.stop()
 
-    # 初回実行時にデータベースのセットアップを行う
-    setup_database(temp_conn)
-    temp_conn.close() # ★ セットアップが終わったら接続を閉じる
-
     # ユーザーがクエリを入力するためのテキストエリア
     # ... (変更なし) ...
     default_query = "SELECT name FROM sqlite_master WHERE type='table'"
@@ -79,46 +240,52 @@ def sql_runner_page():
 
         query_type = sql_query.strip().split()[0].upper()
 
-        # ★ ここで新しい接続を作成する (最も重要な修正点)
+        # ★ プールから接続を借りる（毎回 connect/close はしない）
         conn = get_connection(DB_NAME)
         if conn is None:
             return
-            
+
         try:
             if query_type in ["SELECT", "PRAGMA"]:
                 # 参照クエリの場合
-                # pandasのread_sqlを使用して、結果をDataFrameとして取得
-                df = pd.read_sql(sql_query, conn) # ここで新しい接続を使用
-                
-                st.success("クエリ実行成功！ (参照)")
-                st.dataframe(df, use_container_width=True)
-                st.info(f"取得行数: {len(df.index)}行")
+                # 全件を DataFrame に読み込まず、下の render_result_viewer で1ページずつ表示する
+                page_size = st.session_state.get("sql_viewer_page_size", PAGE_SIZE_OPTIONS[1])
+                st.session_state.sql_viewer = {
+                    "sql": sql_query, "page": 0, "page_size": page_size,
+                    "count": None, "count_requested": False,
+                }
 
             elif query_type in ["INSERT", "UPDATE", "DELETE", "CREATE", "DROP"]:
                 # 変更クエリの場合
-                cursor = conn.cursor()
-                cursor.execute(sql_query)
-                conn.commit() # 変更を確定
-                
-                rowcount = cursor.rowcount if cursor.rowcount >= 0 else 0
+                # 全セッションの書き込みを1つのキューで順に実行する（確定後に実行結果のキャッシュも破棄される）
+                rowcount = get_writer(DB_NAME).execute(sql_query)
+                rowcount = rowcount if rowcount >= 0 else 0
                 
                 st.success(f"クエリ実行成功！ (変更) - 影響行数: {rowcount}行")
                 
             else:
                 # その他のクエリ（例: ALTERなど）の場合
-                cursor = conn.cursor()
-                cursor.execute(sql_query)
-                conn.commit()
+                get_writer(DB_NAME).execute(sql_query)
                 st.success("クエリ実行成功！")
 
+        except WriteTimeout as e:
+            # 実行中で取り消せなかった書き込みは、このあと反映される場合がある
+            if e.started:
+                st.warning(f"{e} 結果を確認してから再実行してください。")
+            else:
+                st.error(str(e))
+
         except Exception as e:
             # エラー発生時の処理
             st.error("クエリ実行エラーが発生しました。")
             st.exception(e)
 
         finally:
-            # ★ 処理が終わったら必ず接続を閉じる
-            conn.close() 
+            # ★ 処理が終わったら必ず接続をプールに返却する
+            release_connection(DB_NAME, conn)
+
+    # 参照クエリの結果（ページ送り・行数カウントの操作でも再表示する）
+    render_result_viewer()
 
 # ページ処理を実行
 sql_runner_page()
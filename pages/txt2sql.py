@@ -1,7 +1,18 @@
 import os
 import sqlite3
+import uuid
 import streamlit as st
-from openai import OpenAI
+
+from followup import get_followup_store, previous_result
+from llm_stream import StreamStats, write_answer
+from openai_client import get_openai_client
+from parquet_backend import DEFAULT_BACKEND, PARQUET_DIR
+from parquet_backend import get_backend as get_parquet_backend, is_available as parquet_is_available
+from pipeline import MODEL, PIPELINES
+from query_guard import QueryBudgetExceeded, st_run_cancellable
+from sql_cache import get_sql_cache
+from sql_candidates import PARALLEL_ENABLED, CandidateGenerationFailed
+from tracing import show_trace
 
 # ページ設定（オプション）
 st.set_page_config(page_title="AI Data Analyst", layout="centered")
@@ -36,166 +47,42 @@ if not api_key:
     st.error("OpenAI APIキーが設定されていません。st.secrets または環境変数を設定してください。")
     st.stop()
 
-# OpenAIクライアントの初期化
-client = OpenAI(api_key=api_key)
+# OpenAIクライアント（プロセス内で共有し、再実行のたびには作り直さない）
+client = get_openai_client(api_key)
+
+# 実行エンジンの選択（parquet は duckdb があり、SQLite との一致確認に通った場合のみ選択可能。
+# 一致確認はバックグラウンドで行うため、終わるまでは SQLite のみ）
+backend_labels = {"sqlite": "SQLite (Chinook.db)", "parquet": "Parquet / DuckDB (parquet/)"}
+available_backends = ["sqlite"] + (["parquet"] if parquet_is_available() else [])
+query_backend = st.sidebar.radio(
+    "SQLの実行エンジン",
+    available_backends,
+    index=available_backends.index(DEFAULT_BACKEND) if DEFAULT_BACKEND in available_backends else 0,
+    format_func=backend_labels.get,
+)
+
+# 候補SQLの並列生成（SQLite で実行する場合のみ。候補数・制限時間は SQL_CANDIDATES などで変更可能）
+parallel_generation = query_backend == "sqlite" and st.sidebar.checkbox(
+    "候補SQLを並列生成して自動修正する", value=PARALLEL_ENABLED
+)
 
 # ==========================================
-# 2. プロンプト定義 (スキーマ情報)
+# 2. 処理の流れ（プロンプト定義・スキーマ情報は pipeline.py）
 # ==========================================
 
-DB_SCHEMA_PROMPT = """
-あなたは経験豊富なデータアナリストです。
-以下のテーブル定義を参考にして、ユーザーの質問に対するSQLを生成してください。
-
-CREATE TABLE "Album" (
-    "AlbumId" INTEGER NOT NULL, 
-    "Title" NVARCHAR(160) NOT NULL, 
-    "ArtistId" INTEGER NOT NULL, 
-    PRIMARY KEY ("AlbumId"), 
-    FOREIGN KEY("ArtistId") REFERENCES "Artist" ("ArtistId")
-);
-
-CREATE TABLE "Artist" (
-    "ArtistId" INTEGER NOT NULL, 
-    "Name" NVARCHAR(120), 
-    PRIMARY KEY ("ArtistId")
-);
-
-CREATE TABLE "Customer" (
-    "CustomerId" INTEGER NOT NULL, 
-    "FirstName" NVARCHAR(40) NOT NULL, 
-    "LastName" NVARCHAR(20) NOT NULL, 
-    "Company" NVARCHAR(80), 
-    "Address" NVARCHAR(70), 
-    "City" NVARCHAR(40), 
-    "State" NVARCHAR(40), 
-    "Country" NVARCHAR(40), 
-    "PostalCode" NVARCHAR(10), 
-    "Phone" NVARCHAR(24), 
-    "Fax" NVARCHAR(24), 
-    "Email" NVARCHAR(60) NOT NULL, 
-    "SupportRepId" INTEGER, 
-    PRIMARY KEY ("CustomerId"), 
-    FOREIGN KEY("SupportRepId") REFERENCES "Employee" ("EmployeeId")
-);
-
-CREATE TABLE "Employee" (
-    "EmployeeId" INTEGER NOT NULL, 
-    "LastName" NVARCHAR(20) NOT NULL, 
-    "FirstName" NVARCHAR(20) NOT NULL, 
-    "Title" NVARCHAR(30), 
-    "ReportsTo" INTEGER, 
-    "BirthDate" DATETIME, 
-    "HireDate" DATETIME, 
-    "Address" NVARCHAR(70), 
-    "City" NVARCHAR(40), 
-    "State" NVARCHAR(40), 
-    "Country" NVARCHAR(40), 
-    "PostalCode" NVARCHAR(10), 
-    "Phone" NVARCHAR(24), 
-    "Fax" NVARCHAR(24), 
-    "Email" NVARCHAR(60), 
-    PRIMARY KEY ("EmployeeId"), 
-    FOREIGN KEY("ReportsTo") REFERENCES "Employee" ("EmployeeId")
-);
-
-CREATE TABLE "Genre" (
-    "GenreId" INTEGER NOT NULL, 
-    "Name" NVARCHAR(120), 
-    PRIMARY KEY ("GenreId")
-);
-
-CREATE TABLE "Invoice" (
-    "InvoiceId" INTEGER NOT NULL, 
-    "CustomerId" INTEGER NOT NULL, 
-    "InvoiceDate" DATETIME NOT NULL, 
-    "BillingAddress" NVARCHAR(70), 
-    "BillingCity" NVARCHAR(40), 
-    "BillingState" NVARCHAR(40), 
-    "BillingCountry" NVARCHAR(40), 
-    "BillingPostalCode" NVARCHAR(10), 
-    "Total" NUMERIC(10, 2) NOT NULL, 
-    PRIMARY KEY ("InvoiceId"), 
-    FOREIGN KEY("CustomerId") REFERENCES "Customer" ("CustomerId")
-);
-
-CREATE TABLE "InvoiceLine" (
-    "InvoiceLineId" INTEGER NOT NULL, 
-    "InvoiceId" INTEGER NOT NULL, 
-    "TrackId" INTEGER NOT NULL, 
-    "UnitPrice" NUMERIC(10, 2) NOT NULL, 
-    "Quantity" INTEGER NOT NULL, 
-    PRIMARY KEY ("InvoiceLineId"), 
-    FOREIGN KEY("TrackId") REFERENCES "Track" ("TrackId"), 
-    FOREIGN KEY("InvoiceId") REFERENCES "Invoice" ("InvoiceId")
-);
-
-CREATE TABLE "MediaType" (
-    "MediaTypeId" INTEGER NOT NULL, 
-    "Name" NVARCHAR(120), 
-    PRIMARY KEY ("MediaTypeId")
-);
-
-CREATE TABLE "Playlist" (
-    "PlaylistId" INTEGER NOT NULL, 
-    "Name" NVARCHAR(120), 
-    PRIMARY KEY ("PlaylistId")
-);
-
-CREATE TABLE "PlaylistTrack" (
-    "PlaylistId" INTEGER NOT NULL, 
-    "TrackId" INTEGER NOT NULL, 
-    PRIMARY KEY ("PlaylistId", "TrackId"), 
-    FOREIGN KEY("TrackId") REFERENCES "Track" ("TrackId"), 
-    FOREIGN KEY("PlaylistId") REFERENCES "Playlist" ("PlaylistId")
-);
-
-CREATE TABLE "Track" (
-    "TrackId" INTEGER NOT NULL, 
-    "Name" NVARCHAR(200) NOT NULL, 
-    "AlbumId" INTEGER, 
-    "MediaTypeId" INTEGER NOT NULL, 
-    "GenreId" INTEGER, 
-    "Composer" NVARCHAR(220), 
-    "Milliseconds" INTEGER NOT NULL, 
-    "Bytes" INTEGER, 
-    "UnitPrice" NUMERIC(10, 2) NOT NULL, 
-    PRIMARY KEY ("TrackId"), 
-    FOREIGN KEY("MediaTypeId") REFERENCES "MediaType" ("MediaTypeId"), 
-    FOREIGN KEY("GenreId") REFERENCES "Genre" ("GenreId"), 
-    FOREIGN KEY("AlbumId") REFERENCES "Album" ("AlbumId")
-);
-
-**重要**: あなたは、ユーザーの質問に対し、このスキーマに基づくSQLiteのSQLクエリ（SELECT文）のみを生成してください。その他の説明は一切含めないでください。Markdownのコードブロック(```sql ... ```)も含めず、純粋なSQLのみを返してください。
-""".strip()
-
-RESPONSE_GENERATION_PROMPT_TEMPLATE = """
-以下の【データ】に基づき、ユーザーの問い合わせに対する適切な回答を作成してください。
-
-回答を作成する際は、以下のステップとガイドラインに従ってください。
-
-### 回答作成のためのガイドライン
-1. **目的の確認:** 【データ】内の「ユーザーの問い合わせ」の意図を正確に理解する。
-2. **結果の分析:** 【データ】内の「実行されたSQL」と「SQLの返り値」を分析し、問いに答えるために必要な情報を抽出する。
-3. **回答の構成:** SQLの返り値をそのまま表示するのではなく、ユーザーが**理解しやすい自然な言葉**（日本語）で結論や必要な情報を提示する。
-4. **情報の明確化:** 必要に応じて、どのデータが何を示しているかを明確に伝える。
+pipeline = PIPELINES["txt2sql"]
 
----
-### 【データ】
-#### ユーザーの問い合わせ
-{question}
-
-#### 実行されたSQL
-{sql}
-
-#### SQLの実行結果
-{context}
-""".strip()
+# 追加質問（followup.py）で使う、このブラウザのセッションの直前の結果のキー（ページごとに分ける）
+followup_session = f"{pipeline.name}:{st.session_state.setdefault('followup_session_id', uuid.uuid4().hex)}"
 
 # ==========================================
 # 3. アプリケーションロジック
 # ==========================================
 
+# 前回の実行中にキャンセルボタンが押された場合
+if st.session_state.pop("query_cancelled", False):
+    st.info("実行中のクエリをキャンセルしました。")
+
 # ユーザーからの入力を受け取る
 if user_input := st.chat_input("質問を入力してください。"):
 
@@ -205,60 +92,139 @@ if user_input := st.chat_input("質問を入力してください。"):
 
     with st.chat_message("assistant"):
         status_placeholder = st.empty()
+        # SQL生成の前に失敗した場合（キャッシュのDBのエラーなど）もエラー表示で参照できるようにする
+        turn = None
+        generated_sql = None
         
         try:
-            # --- Phase 1: SQL生成 ---
-            with st.spinner("データベースを確認中..."):
-                sql_response = client.chat.completions.create(
-                    model="gpt-4o",  # gpt-5-nano は未公開のため gpt-4o に変更 (必要に応じて変更可)
-                    messages=[
-                        {"role": "system", "content": DB_SCHEMA_PROMPT},
-                        {"role": "user", "content": user_input}
-                    ],
-                )
-                generated_sql = sql_response.choices[0].message.content
-                
-                # SQLから余計な装飾（Markdownなど）があれば除去する簡易処理
-                generated_sql = generated_sql.replace("```sql", "").replace("```", "").strip()
-
-            # --- Phase 2: SQL実行 ---
-            # DB接続には with 構文を使用して確実に閉じる
-            db_path = "Chinook.db"
+            db_path = pipeline.db_path
             if not os.path.exists(db_path):
                  st.error(f"データベースファイル '{db_path}' が見つかりません。")
                  st.stop()
 
-            with sqlite3.connect(db_path) as conn:
-                cursor = conn.execute(generated_sql)
-                query_results = cursor.fetchall()
+            # --- Phase 1: SQL生成 ---
+            # 質問に関係するテーブルだけのスキーマでプロンプトを作り、
+            # 同じ質問で生成済みのSQLがあればLLMを呼ばずに再利用する（追加質問ではSQLキャッシュを使わない）
+            previous = previous_result(followup_session, user_input)
+            turn = pipeline.start(user_input, previous=previous)
+            # 直前の結果の絞り込み・並べ替えで答えられる追加質問なら、その結果（prev_result）に対してSQLを生成・実行する
+            # （答えられなければ、直前の質問とSQLを伝えて元のテーブルで処理する）
+            if previous is not None:
+                with st.spinner("直前の結果を確認中..."):
+                    pipeline.followup(client, turn, previous)
+            if turn.sql is None and parallel_generation:
+                # 候補SQLを並列に生成・実行して最初に成功したものを採用する（失敗した候補はエラーを伝えて修正させる）
+                st_run_cancellable(lambda cancel_event: pipeline.generate_candidates(client, turn, cancel_event))
+            elif turn.sql is None:
+                with st.spinner("データベースを確認中..."):
+                    pipeline.generate_sql(client, turn)
+            generated_sql = turn.sql
+
+            # --- Phase 2: SQL実行 ---
+            # DBが変更されていなければ、同じSQLの実行結果を再利用する
+            # （parquet で実行する場合は parquet/ を結果の出どころとしてキャッシュを分ける）
+            if turn.summary is None and query_backend == "parquet" and not pipeline.cached_result(turn, PARQUET_DIR):
+                try:
+                    with turn.trace.span("execute_sql", backend="parquet") as span:
+                        # SQLite と同じ実行時間の上限とキャンセルボタンを使う（超えたら DuckDB の interrupt() で中断）
+                        turn.summary = st_run_cancellable(
+                            lambda cancel_event: get_parquet_backend().run(generated_sql, pipeline.budget, cancel_event),
+                            key="cancel_parquet_query",
+                        )
+                        span.set(rows=turn.summary.row_count, truncated=turn.summary.truncated or None)
+                    pipeline.store_rows(turn)
+                except QueryBudgetExceeded:
+                    raise
+                except Exception as e:
+                    # DuckDB で実行できないSQL（方言の違いなど）は SQLite で実行する
+                    st.caption(f"parquet での実行に失敗したため SQLite で実行します: {e}")
+            if turn.summary is None and not pipeline.cached_result(turn):
+                # 上限を超えたら中断する（実行中はキャンセルボタンでも中断できる）
+                st_run_cancellable(lambda cancel_event: pipeline.execute(turn, cancel_event))
+            result_summary = turn.summary
+            query_results = result_summary.rows
+
+            # 実行に成功したSQLのみキャッシュする
+            pipeline.remember_sql(turn)
 
             # --- Phase 3: 自然言語での回答生成 ---
-            with st.spinner("回答を作成中..."):
-                final_prompt = RESPONSE_GENERATION_PROMPT_TEMPLATE.format(
-                    question=user_input,
-                    sql=generated_sql,
-                    context=query_results
-                )
-
-                final_response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": "あなたはデータに基づき、ユーザーにわかりやすく日本語で答えるアシスタントです。"},
-                        {"role": "user", "content": final_prompt}
-                    ],
+            # 1つの値・1行・短い一覧・小さな集計表は、LLMを呼ばずに定型文と表で回答する（answer_templates.py）
+            natural_language_answer = pipeline.template_answer(turn)
+            # 同じ質問・同じ結果に対する回答が既にあれば再利用する
+            if natural_language_answer is None:
+                natural_language_answer = pipeline.cached_answer(turn)
+            answer_stats = None
+            if natural_language_answer is not None:
+                st.write(natural_language_answer)
+            else:
+                # 結果の表示（生成されたトークンから順に表示する）
+                answer_stats = StreamStats()
+                natural_language_answer = write_answer(
+                    client,
+                    answer_stats,
+                    model=MODEL,
+                    messages=pipeline.answer_messages(turn),
                 )
-                natural_language_answer = final_response.choices[0].message.content
+                pipeline.store_answer(turn, natural_language_answer, answer_stats)
+            # 次の質問が追加質問だった場合に使えるよう、この結果をセッションの直前の結果として保持する
+            get_followup_store().put(followup_session, turn)
+            turn.trace.finish("ok")
 
-            # 結果の表示
-            st.write(natural_language_answer)
-            
             # デバッグ用情報（エキスパンダーに隠す）
             with st.expander("詳細データを見る（SQLと生の検索結果）"):
+                if turn.followup is not None:
+                    st.caption(f"直前の結果（{turn.followup.row_count} 行）に対して実行したSQL:")
                 st.code(generated_sql, language="sql")
                 st.write("検索結果:", query_results)
-
+                if result_summary.truncated:
+                    st.caption(f"※ 結果が多いため先頭 {result_summary.row_count} 行までを取得しました。")
+                token_report = result_summary.token_report()
+                st.caption(f"回答生成に渡した結果: 約 {token_report['before']} → {token_report['after']} トークン")
+                schema = turn.schema
+                sql_generation_time = turn.timings.get("generate_sql")
+                st.caption(
+                    f"スキーマ: {len(schema.tables)}/{len(schema.all_tables)} テーブル"
+                    f"（約 {schema.full_tokens} → {schema.tokens} トークン）"
+                    + (f" / SQL生成 {sql_generation_time:.2f}秒" if sql_generation_time is not None else "")
+                )
+                if turn.candidate_result is not None:
+                    winner = turn.candidate_result.winner
+                    st.caption(
+                        f"候補SQL: {len(turn.candidate_result.attempts)} 件実行"
+                        f"（採用: 候補{winner['candidate'] + 1}・修正 {winner['round']} 回）"
+                    )
+                cache_stats = get_sql_cache().stats()
+                st.caption(
+                    f"SQLキャッシュ: {'ヒット' if turn.sql_from_cache else 'ミス'}"
+                    f"（累計 ヒット {cache_stats['hits']} / ミス {cache_stats['misses']}）"
+                )
+                if turn.answer_template is not None:
+                    st.caption(f"回答生成: 定型文（結果の形: {turn.answer_template}）のためLLMを呼び出していません")
+                if answer_stats is not None and answer_stats.time_to_first_token is not None:
+                    st.caption(
+                        f"回答生成: 最初のトークンまで {answer_stats.time_to_first_token:.2f}秒"
+                        f" / 完了まで {answer_stats.total_time:.2f}秒"
+                    )
+                # フェーズごとの時間・トークン数・キャッシュの内訳（tracing.py）
+                show_trace(turn.trace)
+
+        except QueryBudgetExceeded as e:
+            st.error(e.user_message())
+            st.json(e.to_dict())
+            if turn is not None and turn.sql:
+                st.warning(f"生成されたSQL: {turn.sql}")
+        except CandidateGenerationFailed as e:
+            st.error(f"SQL実行エラー: {e}")
+            st.write("試行した候補SQL:", [
+                {"候補": (a["candidate"] or 0) + 1, "SQL": a["sql"], "エラー": a["error"]} for a in e.attempts
+            ])
         except sqlite3.Error as e:
             st.error(f"SQL実行エラー: {e}")
-            st.warning(f"生成されたSQL: {generated_sql}")
+            if turn is not None and turn.sql:
+                st.warning(f"生成されたSQL: {turn.sql}")
         except Exception as e:
             st.error(f"エラーが発生しました: {e}")
+        finally:
+            # 途中で失敗・中断したターンもエラーとして集計する
+            if turn is not None:
+                turn.trace.finish("ok" if turn.answer is not None else "error")
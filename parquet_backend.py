@@ -0,0 +1,282 @@
+# parquet/ ディレクトリを対象にした列指向の実行エンジン（DuckDB）
+# txt2sql.py で生成された SELECT 文を、Chinook.db の代わりに parquet/*.parquet に対して実行する。
+# DuckDB はビュー越しでも parquet の読み込みに列の絞り込み（projection pushdown）と
+# 条件の押し下げ（filter pushdown）を行うため、集計・結合の多い質問で速くなる。
+#
+# 使い方:
+#   python parquet_backend.py parity   # SQLite と結果が一致するかを確認
+#   python parquet_backend.py bench    # SQLite と実行時間を比較
+import argparse
+import glob
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+from index_advisor import time_query
+from query_guard import QueryBudgetExceeded
+from result_compact import fetch_compacted
+from rollups import results_equal
+from sql_candidates import validate_sql
+
+PARQUET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parquet")
+SQLITE_DB_PATH = "Chinook.db"
+
+# 実行エンジンの既定値（"sqlite" または "parquet"）
+DEFAULT_BACKEND = os.environ.get("TXT2SQL_BACKEND", "sqlite")
+
+# 実行中のクエリの上限・キャンセルを確認する間隔（秒）
+WATCH_INTERVAL = 0.05
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+
+def translate_sql(sql):
+    """
+    SQLite 向けに生成されたSQLを、DuckDB で同じ意味になるように書き換える。
+    - LIKE: SQLite は英字の大文字小文字を区別しないため ILIKE にする
+    - strftime(format, value): DuckDB は引数の順序が逆
+    """
+    literals = []
+
+    def keep(match):
+        literals.append(match.group(0))
+        return f"'\x00{len(literals) - 1}'"
+
+    text = _STRING_LITERAL.sub(keep, sql)
+    text = re.sub(r"\bLIKE\b", "ILIKE", text, flags=re.I)
+    text = re.sub(
+        r"\bstrftime\s*\(\s*('\x00\d+')\s*,\s*([^()]+?)\s*\)",
+        r"strftime(CAST(\2 AS TIMESTAMP), \1)",
+        text,
+        flags=re.I,
+    )
+    return re.sub(r"'\x00(\d+)'", lambda m: literals[int(m.group(1))], text)
+
+
+class ParquetBackend:
+    """
+    parquet/ 内の各ファイルを同名のビューとして公開する DuckDB 接続。
+    LLM が生成したSQLを実行するため、ビューの作成後は parquet/ 以外のファイルの読み書き
+    （read_text / read_csv / COPY ... TO / ATTACH など）を禁止し、設定も変更できないようにする。
+    """
+
+    def __init__(self, parquet_dir=PARQUET_DIR, threads=None):
+        try:
+            import duckdb
+        except ImportError as e:
+            raise RuntimeError("parquet バックエンドには duckdb パッケージが必要です。") from e
+        self.duckdb = duckdb
+        self.parquet_dir = parquet_dir
+        self._conn = duckdb.connect(":memory:")
+        # SQLite と同じく、整数同士の割り算は整数にする
+        # （SET だけでは cursor() で複製した接続に引き継がれないため GLOBAL で設定する）
+        self._conn.execute("SET GLOBAL integer_division = true")
+        if threads:
+            self._conn.execute(f"SET threads = {int(threads)}")
+        self.tables = []
+        for path in sorted(glob.glob(os.path.join(parquet_dir, "*.parquet"))):
+            table = os.path.splitext(os.path.basename(path))[0]
+            escaped = path.replace("'", "''")
+            self._conn.execute(f"CREATE VIEW \"{table}\" AS SELECT * FROM read_parquet('{escaped}')")
+            self.tables.append(table)
+        self._conn.execute("SET allowed_directories = ?", [[os.path.join(os.path.abspath(parquet_dir), "")]])
+        self._conn.execute("SET enable_external_access = false")
+        self._conn.execute("SET lock_configuration = true")
+        self._local = threading.local()
+
+    def _cursor(self):
+        # DuckDB の接続はスレッドごとに cursor() で複製して使う
+        cursor = getattr(self._local, "cursor", None)
+        if cursor is None:
+            cursor = self._conn.cursor()
+            self._local.cursor = cursor
+        return cursor
+
+    def execute(self, sql):
+        """
+        SQLを実行してカーソルを返す（fetchmany / description は sqlite3 と同様に使える）。
+        1文の SELECT 以外は ValueError（sql_candidates.validate_sql）。
+        """
+        validate_sql(sql)
+        return self._cursor().execute(translate_sql(sql))
+
+    def run(self, sql, budget, cancel_event=None):
+        """
+        SQLを実行し、行数・サイズの上限付きで結果（ResultSummary）を返す。
+        budget（query_guard.QueryBudget）の時間の上限を超えた・cancel_event がセットされた場合は
+        DuckDB の interrupt() で中断し、QueryBudgetExceeded を送出する（処理量の上限は SQLite のみ）。
+        """
+        cursor = self._cursor()
+        started = time.perf_counter()
+        done = threading.Event()
+        state = {"reason": None}
+
+        def watch():
+            while not done.wait(WATCH_INTERVAL):
+                if cancel_event is not None and cancel_event.is_set():
+                    state["reason"] = "cancelled"
+                elif budget.timeout and time.perf_counter() - started > budget.timeout:
+                    state["reason"] = "timeout"
+                else:
+                    continue
+                cursor.interrupt()
+                return
+
+        watcher = threading.Thread(target=watch, name="parquet-watch", daemon=True)
+        watcher.start()
+        try:
+            return fetch_compacted(self.execute(sql))
+        except self.duckdb.Error as e:
+            if state["reason"] is None:
+                raise
+            limit = budget.timeout if state["reason"] == "timeout" else None
+            raise QueryBudgetExceeded(state["reason"], time.perf_counter() - started, None, limit) from e
+        finally:
+            done.set()
+            watcher.join()
+
+    def fetchall(self, sql):
+        cursor = self.execute(sql)
+        return [description[0] for description in cursor.description], cursor.fetchall()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """プロセス内で共有する ParquetBackend を返す（duckdb が無い場合は RuntimeError）。"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = ParquetBackend()
+        return _backend
+
+
+_parity_ok = None
+_parity_thread = None
+_parity_lock = threading.Lock()
+
+
+def _check_parity():
+    global _parity_ok
+    try:
+        ok = all(item["equal"] for item in parity())
+    except Exception:
+        ok = False
+    with _parity_lock:
+        _parity_ok = ok
+
+
+def is_available():
+    """
+    parquet バックエンドを選択できるかを返す。
+    duckdb と parquet ファイルがあり、PARITY_QUERIES の結果が SQLite と一致した場合のみ True。
+    一致確認は初回の呼び出しでバックグラウンドのスレッドを起動して一度だけ行い、終わるまでは False を返す
+    （画面の表示を待たせない。結果は `python parquet_backend.py parity` でも確認できる）。
+    """
+    global _parity_thread
+    try:
+        import duckdb  # noqa: F401
+    except ImportError:
+        return False
+    if not glob.glob(os.path.join(PARQUET_DIR, "*.parquet")):
+        return False
+    with _parity_lock:
+        if _parity_thread is None:
+            _parity_thread = threading.Thread(target=_check_parity, name="parquet-parity", daemon=True)
+            _parity_thread.start()
+        return bool(_parity_ok)
+
+
+# ==========================================
+# 一致確認・ベンチマーク
+# ==========================================
+
+# txt2sql.py の質問例と、結合・集計の多い質問に相当するSQL
+PARITY_QUERIES = {
+    "AC/DCのアルバムを全て教えて":
+        "SELECT Album.Title FROM Album JOIN Artist ON Album.ArtistId = Artist.ArtistId "
+        "WHERE Artist.Name = 'AC/DC'",
+    "一番売上が高いジャンルは何ですか？":
+        "SELECT g.Name, SUM(il.UnitPrice * il.Quantity) AS Sales FROM InvoiceLine il "
+        "JOIN Track t ON il.TrackId = t.TrackId JOIN Genre g ON t.GenreId = g.GenreId "
+        "GROUP BY g.Name ORDER BY Sales DESC LIMIT 1",
+    "ブラジルの顧客リストを表示して":
+        "SELECT FirstName, LastName, City FROM Customer WHERE Country = 'Brazil'",
+    "国別の売上合計":
+        "SELECT BillingCountry, SUM(Total) AS Total, COUNT(*) AS Invoices FROM Invoice "
+        "GROUP BY BillingCountry ORDER BY Total DESC",
+    "アーティスト別の売上トップ10":
+        "SELECT ar.Name, SUM(il.UnitPrice * il.Quantity) AS Sales FROM InvoiceLine il "
+        "JOIN Track t ON il.TrackId = t.TrackId JOIN Album al ON t.AlbumId = al.AlbumId "
+        "JOIN Artist ar ON al.ArtistId = ar.ArtistId GROUP BY ar.Name ORDER BY Sales DESC LIMIT 10",
+    "担当者別の顧客数と売上":
+        "SELECT e.FirstName, e.LastName, COUNT(DISTINCT c.CustomerId) AS Customers, SUM(i.Total) AS Sales "
+        "FROM Employee e JOIN Customer c ON c.SupportRepId = e.EmployeeId "
+        "JOIN Invoice i ON i.CustomerId = c.CustomerId GROUP BY e.EmployeeId, e.FirstName, e.LastName",
+    "プレイリスト別の曲数と合計時間（分）":
+        "SELECT p.Name, COUNT(*) AS Tracks, SUM(t.Milliseconds) / 60000 AS Minutes FROM Playlist p "
+        "JOIN PlaylistTrack pt ON p.PlaylistId = pt.PlaylistId JOIN Track t ON pt.TrackId = t.TrackId "
+        "GROUP BY p.PlaylistId, p.Name",
+    "名前に rock を含むジャンルの曲数":
+        "SELECT g.Name, COUNT(*) FROM Track t JOIN Genre g ON t.GenreId = g.GenreId "
+        "WHERE g.Name LIKE '%rock%' GROUP BY g.Name",
+    "年別の売上":
+        "SELECT strftime('%Y', InvoiceDate) AS Year, SUM(Total) FROM Invoice GROUP BY Year",
+}
+
+
+def parity(db_path=SQLITE_DB_PATH, queries=PARITY_QUERIES):
+    """各SQLを SQLite と parquet の両方で実行し、結果が一致するかを返す。"""
+    backend = get_backend()
+    report = []
+    with sqlite3.connect(db_path) as conn:
+        for question, sql in queries.items():
+            expected = conn.execute(sql).fetchall()
+            try:
+                _, actual = backend.fetchall(sql)
+                report.append({"question": question, "equal": results_equal(expected, [tuple(r) for r in actual])})
+            except Exception as e:
+                report.append({"question": question, "equal": False, "error": str(e)})
+    return report
+
+
+def bench(db_path=SQLITE_DB_PATH, queries=PARITY_QUERIES, repeat=5):
+    """各SQLの実行時間（ミリ秒の中央値）を SQLite と parquet で比較する。"""
+    backend = get_backend()
+    report = []
+    with sqlite3.connect(db_path) as conn:
+        for question, sql in queries.items():
+            report.append({
+                "question": question,
+                "sqlite_ms": round(time_query(conn, sql, repeat), 3),
+                "parquet_ms": round(time_query(backend._cursor(), translate_sql(sql), repeat), 3),
+            })
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="parquet バックエンドの一致確認とベンチマーク")
+    parser.add_argument("command", choices=["parity", "bench"])
+    parser.add_argument("--db", default=SQLITE_DB_PATH)
+    args = parser.parse_args(argv)
+
+    if args.command == "parity":
+        ok = True
+        for item in parity(args.db):
+            ok = ok and item["equal"]
+            status = "一致" if item["equal"] else "不一致"
+            print(f"[{status}] {item['question']}" + (f"  ({item['error']})" if "error" in item else ""))
+        return 0 if ok else 1
+
+    for item in bench(args.db):
+        print(f"{item['question']}: SQLite {item['sqlite_ms']}ms / parquet {item['parquet_ms']}ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,456 @@
+# text-to-SQL の処理の流れ（Phase 1: SQL生成 → Phase 2: SQL実行 → Phase 3: 回答生成）
+# 画面（pages/txt2sql.py, pages/mark_db.py）とベンチマーク・バッチ実行で同じ処理を使うため、
+# プロンプトと各フェーズの処理をここにまとめる。画面への表示は含まない。
+import os
+import sqlite3
+import time
+
+from answer_templates import TEMPLATES_ENABLED, template_answer
+from db_pool import get_readonly_pool
+from followup import NEED_BASE, get_followup_store, previous_result
+from index_advisor import record_query
+from query_guard import get_budget, guarded
+from result_cache import get_result_cache
+from result_compact import fetch_compacted, summarize_rows
+from rollups import ROLLUPS, get_router
+from schema_prompt import get_prompter
+from sql_cache import get_sql_cache
+from sql_candidates import clean_sql, generate_and_execute, validate_sql
+from tracing import Trace
+
+MODEL = "gpt-4o"  # gpt-5-nano は未公開のため gpt-4o に変更 (必要に応じて変更可)
+
+# ==========================================
+# プロンプト定義
+# ==========================================
+
+# テーブル定義は各DBから生成し、質問に関係するテーブルだけを入れる（schema_prompt.py）
+CHINOOK_SCHEMA_HEADER = """
+あなたは経験豊富なデータアナリストです。
+以下のテーブル定義を参考にして、ユーザーの質問に対するSQLを生成してください。
+"""
+
+CHINOOK_SCHEMA_RULES = """
+**重要**: あなたは、ユーザーの質問に対し、このスキーマに基づくSQLiteのSQLクエリ（SELECT文）のみを生成してください。その他の説明は一切含めないでください。Markdownのコードブロック(```sql ... ```)も含めず、純粋なSQLのみを返してください。
+"""
+
+CHINOOK_ANSWER_TEMPLATE = """
+以下の【データ】に基づき、ユーザーの問い合わせに対する適切な回答を作成してください。
+
+回答を作成する際は、以下のステップとガイドラインに従ってください。
+
+### 回答作成のためのガイドライン
+1. **目的の確認:** 【データ】内の「ユーザーの問い合わせ」の意図を正確に理解する。
+2. **結果の分析:** 【データ】内の「実行されたSQL」と「SQLの返り値」を分析し、問いに答えるために必要な情報を抽出する。
+3. **回答の構成:** SQLの返り値をそのまま表示するのではなく、ユーザーが**理解しやすい自然な言葉**（日本語）で結論や必要な情報を提示する。
+4. **情報の明確化:** 必要に応じて、どのデータが何を示しているかを明確に伝える。
+
+---
+### 【データ】
+#### ユーザーの問い合わせ
+{question}
+
+#### 実行されたSQL
+{sql}
+
+#### SQLの実行結果
+{context}
+""".strip()
+
+CHINOOK_ANSWER_SYSTEM_PROMPT = "あなたはデータに基づき、ユーザーにわかりやすく日本語で答えるアシスタントです。"
+
+MARKETING_SCHEMA_HEADER = """
+あなたは経験豊富なマーケティングデータアナリストです。
+以下のテーブル定義を参考にして、ユーザーの質問に対するSQLを生成してください。
+"""
+
+MARKETING_SCHEMA_RULES = """
+**重要ルール**:
+1. 日付カラム `date` は 'YYYY-MM-DD' 文字列形式です。
+2. **日付計算**: 「今日」「先月」「直近30日」などの指示があった場合は、後述する【現在の日付】を基準にSQLの `WHERE` 句を作成してください。
+   - 例（先月）: `WHERE date BETWEEN date('now', 'start of month', '-1 month') AND date('now', 'start of month', '-1 day')` ※SQLite関数を使用、または文字列比較で範囲指定を行ってください。
+   - SQLiteでは `strftime` や文字列比較が有効です。例: `date LIKE '2023-11%'`
+3. CPA（獲得単価）の計算: `SUM(cost) / NULLIF(SUM(conversions), 0)`
+4. 出力: 説明なしで、実行可能なSQLクエリ（SELECT文）のみを返してください。
+"""
+
+MARKETING_ANSWER_TEMPLATE = """
+以下の【データ】に基づき、ユーザーの問い合わせに対する適切な回答を作成してください。
+
+回答作成のガイドライン:
+1. **目的の確認:** ユーザーの質問意図を理解する。
+2. **結果の分析:** SQL実行結果から数値を読み取り、増減や傾向を分析する。
+3. **回答の構成:** 「現在の日付（{current_date}）時点でのデータによると...」のように、いつの時点の情報かを意識して回答する。
+
+---
+### 【データ】
+#### ユーザーの問い合わせ
+{question}
+
+#### 実行されたSQL
+{sql}
+
+#### SQLの実行結果
+{context}
+""".strip()
+
+MARKETING_ANSWER_SYSTEM_PROMPT = "あなたはマーケティングデータのアシスタントです。"
+
+# 追加質問を直前の結果で答えられず、元のテーブルで処理する場合に付ける直前の質問とSQL
+PREVIOUS_CONTEXT_NOTE = """
+【直前の質問】
+{question}
+
+【直前の質問に対して実行したSQL】
+{sql}
+
+今回の質問は直前の質問の続きです。直前の質問の条件を引き継いだうえで、元のテーブルに対するSQLを生成してください。
+""".strip()
+
+
+def marketing_context(current_date):
+    """
+    mark_db の質問に付ける基準日の情報（start / run にそのまま渡す）。
+    「先月」などの相対日付は基準日によって結果が変わるため、キャッシュのキーにも日付を含める。
+    """
+    return {
+        "notes": [f"【システム情報】現在の日付は {current_date} です。ユーザーが「今月」や「先月」と言った場合、この日付を基準にしてください。"],
+        "cache_extra": (current_date,),
+        "template_vars": {"current_date": current_date},
+    }
+
+
+# ==========================================
+# 処理の流れ
+# ==========================================
+
+class Turn:
+    """1つの質問の処理状態と、フェーズごとの計測（tracing.Trace）。"""
+
+    def __init__(self, page, question, schema, messages, cache_extra, template_vars):
+        self.question = question
+        self.schema = schema
+        self.messages = messages
+        self.cache_extra = tuple(cache_extra)
+        self.template_vars = dict(template_vars or {})
+        self.sql_cache_key = None
+        self.sql = None
+        self.sql_from_cache = False
+        self.candidate_result = None
+        self.result_source = None
+        self.result_from_cache = False
+        self.executed_sql = None
+        self.summary = None
+        self.answer = None
+        self.answer_from_cache = False
+        self.answer_template = None  # 定型文で回答した場合の結果の形（answer_templates.py）
+        self.previous = None  # 追加質問らしく、直前の結果（followup.SessionResult）があった場合
+        self.followup = None  # 直前の結果（followup.SessionResult）で答えた場合
+        self.trace = Trace(page, question)
+        self.trace.record("schema", schema.elapsed, tables=len(schema.tables), schema_tokens=schema.tokens)
+
+    @property
+    def timings(self):
+        """フェーズ名 → 所要時間（秒）。"""
+        return self.trace.timings
+
+    @property
+    def full_question(self):
+        """追加質問の場合は、直前の質問とつなげた質問（元のテーブルで処理した場合も同じ）。"""
+        previous = self.followup or self.previous
+        if previous is None:
+            return self.question
+        return f"{previous.question} → {self.question}"
+
+    @property
+    def full_sql(self):
+        """追加質問の場合は、直前の結果を得たSQLと prev_result に対するSQL。"""
+        if self.followup is None:
+            return self.sql
+        return f"{self.followup.sql}\n-- その結果に対して:\n{self.sql}"
+
+
+class SqlPipeline:
+    """
+    1つのDBに対する text-to-SQL の処理。
+    route=True の場合は集計クエリを集計済みテーブル（rollups.py）へ振り分ける。
+    """
+
+    def __init__(self, name, db_path, schema_header, schema_rules, answer_system_prompt, answer_template,
+                 route=False, as_dicts=False, exclude=()):
+        self.name = name
+        self.db_path = db_path
+        self.schema_header = schema_header
+        self.schema_rules = schema_rules
+        self.answer_system_prompt = answer_system_prompt
+        self.answer_template = answer_template
+        self.route = route
+        self.as_dicts = as_dicts
+        self.exclude = set(exclude)
+        # 生成されたSQLの実行時間・処理量の上限（<NAME>_QUERY_TIMEOUT / <NAME>_QUERY_MAX_STEPS で変更可能）
+        self.budget = get_budget(name)
+
+    @property
+    def prompter(self):
+        return get_prompter(self.db_path, self.schema_header, self.schema_rules, exclude=self.exclude)
+
+    # --- Phase 1: SQL生成 ---
+
+    def start(self, question, notes=(), cache_extra=(), template_vars=None, previous=None):
+        """
+        質問に合わせたスキーマでプロンプトを作り、生成済みのSQLがあればキャッシュから取り出す。
+        previous（followup.previous_result）を渡した場合は追加質問として扱い、SQLキャッシュは使わない
+        （同じ言い回しでも、直前の質問によって意味が変わるため）。
+        """
+        schema = self.prompter.select(question)
+        messages = [
+            {"role": "system", "content": schema.prompt},
+            *({"role": "system", "content": note} for note in notes),
+            {"role": "user", "content": question},
+        ]
+        turn = Turn(self.name, question, schema, messages, cache_extra, template_vars)
+        turn.previous = previous
+        if previous is not None:
+            return turn
+        sql_cache = get_sql_cache()
+        turn.sql_cache_key = sql_cache.make_key(question, schema.prompt, os.path.basename(self.db_path), *cache_extra)
+        turn.sql = sql_cache.get(turn.sql_cache_key)
+        turn.sql_from_cache = turn.sql is not None
+        turn.trace.cache_result("sql", turn.sql_from_cache)
+        return turn
+
+    def generate_sql(self, client, turn):
+        with turn.trace.span("generate_sql") as span:
+            response = client.chat.completions.create(model=MODEL, messages=turn.messages)
+            span.add_usage(getattr(response, "usage", None))
+        # SQLから余計な装飾（Markdownなど）があれば除去する
+        turn.sql = clean_sql(response.choices[0].message.content)
+        return turn.sql
+
+    def generate_candidates(self, client, turn, cancel_event=None):
+        """候補SQLを並列に生成・実行し、最初に成功したものを採用する（sql_candidates.py）。"""
+        result = generate_and_execute(client, turn.messages, self._execute_readonly, model=MODEL,
+                                      cancel_event=cancel_event)
+        turn.candidate_result = result
+        turn.sql = result.sql
+        turn.executed_sql, turn.summary = result.value
+        turn.result_source = self.db_path
+        # 候補ごとの生成・実行をまとめて SQL生成 のフェーズとして記録する
+        turn.trace.record(
+            "generate_sql", result.elapsed,
+            candidates=len(result.attempts),
+            prompt_tokens=sum(a.get("prompt_tokens", 0) for a in result.attempts),
+            completion_tokens=sum(a.get("completion_tokens", 0) for a in result.attempts),
+        )
+        # インデックス提案（index_advisor.py）用にワークロードとして記録する
+        record_query(self.db_path, turn.executed_sql, result.winner["execute_ms"])
+        self.store_rows(turn)
+        return turn.sql
+
+    def followup(self, client, turn, previous, cancel_event=None):
+        """
+        直前の結果（followup.SessionResult）のテーブルに対するSQLを生成・実行する（答えられれば True）。
+        直前の結果だけでは答えられない場合は False を返す。turn には直前の質問とSQLを伝えるメッセージを加え、
+        元のテーブルで処理を続けられる状態にする。
+        """
+        if self._query_previous(client, turn, previous, cancel_event):
+            return True
+        context = PREVIOUS_CONTEXT_NOTE.format(question=previous.question, sql=previous.sql)
+        turn.messages.insert(len(turn.messages) - 1, {"role": "system", "content": context})
+        return False
+
+    def _query_previous(self, client, turn, previous, cancel_event):
+        messages = [{"role": "system", "content": previous.prompt()}, *turn.messages[1:]]
+        with turn.trace.span("followup_sql", rows=previous.row_count) as span:
+            response = client.chat.completions.create(model=MODEL, messages=messages)
+            span.add_usage(getattr(response, "usage", None))
+            sql = clean_sql(response.choices[0].message.content)
+            if NEED_BASE in sql:
+                span.set(fallback="need_base")
+                return False
+            started = time.perf_counter()
+            try:
+                validate_sql(sql)
+                summary = previous.query(sql, self.budget, cancel_event)
+            except (ValueError, sqlite3.Error) as e:
+                # 生成されたSQLが prev_result で実行できなければ、元のテーブルで処理する
+                span.set(fallback=type(e).__name__)
+                return False
+        turn.trace.record("execute_sql", time.perf_counter() - started, source="prev_result",
+                          rows=summary.row_count)
+        turn.followup = previous
+        turn.sql, turn.sql_from_cache = sql, False
+        turn.executed_sql, turn.summary = sql, summary
+        turn.trace.cache.pop("sql", None)
+        turn.trace.set(followup=True)
+        return True
+
+    # --- Phase 2: SQL実行 ---
+
+    def _run_query(self, conn, sql, cancel_event):
+        # 集計済みテーブルへの振り分けの一致確認は、ユーザーのクエリの上限とは別に数える
+        executed_sql = get_router().route(conn, sql, self.db_path, cancel_event) if self.route else sql
+        # 上限を超えたら中断する（cancel_event がセットされた場合も中断する）
+        with guarded(conn, self.budget, cancel_event):
+            # 行数・サイズの上限付きで取得し、列ごとの統計も同時に計算する
+            return executed_sql, fetch_compacted(conn.execute(executed_sql))
+
+    def _execute_readonly(self, sql, cancel_event):
+        with get_readonly_pool(self.db_path).connection() as conn:
+            return self._run_query(conn, sql, cancel_event)
+
+    def cached_result(self, turn, source=None):
+        """
+        DBが変更されていなければ、同じSQLの実行結果をキャッシュから取り出す（見つかれば True）。
+        source は結果の出どころ（parquet で実行する場合は parquet/ のディレクトリ）。
+        """
+        turn.result_source = source or self.db_path
+        cached = get_result_cache().get_rows(turn.result_source, turn.sql)
+        turn.trace.cache_result("result", cached is not None)
+        if cached is None:
+            return False
+        turn.summary = summarize_rows(*cached)
+        turn.executed_sql = turn.sql
+        turn.result_from_cache = True
+        return True
+
+    def execute(self, turn, cancel_event=None):
+        """
+        SQLを実行する。DB接続はプロセス共通の読み取り専用（mode=ro）のプールから借り、with 構文で確実に返却する。
+        """
+        with turn.trace.span("execute_sql") as span:
+            with get_readonly_pool(self.db_path).connection() as conn:
+                turn.executed_sql, turn.summary = self._run_query(conn, turn.sql, cancel_event)
+            span.set(rows=turn.summary.row_count, truncated=turn.summary.truncated or None)
+        turn.result_source = self.db_path
+        record_query(self.db_path, turn.executed_sql, span.duration * 1000)
+        self.store_rows(turn)
+        return turn.summary
+
+    def store_rows(self, turn):
+        if not turn.summary.truncated:
+            get_result_cache().put_rows(turn.result_source, turn.sql, turn.summary.columns, turn.summary.rows)
+
+    def remember_sql(self, turn):
+        """
+        実行に成功したSQLのみキャッシュする（トレースにはSQLと結果の行数を記録する）。
+        追加質問（turn.previous がある場合）のSQLは、直前の質問が無いと意味が変わるためキャッシュしない。
+        """
+        turn.trace.set(
+            sql=turn.sql,
+            executed_sql=turn.executed_sql if turn.executed_sql != turn.sql else None,
+            rows=turn.summary.row_count,
+        )
+        if not turn.sql_from_cache and turn.previous is None:
+            get_sql_cache().put(turn.sql_cache_key, turn.question, turn.sql)
+
+    # --- Phase 3: 回答生成 ---
+
+    def template_answer(self, turn):
+        """
+        結果が単純な形なら、LLMを呼ばずに定型文と表で回答する（answer_templates.py。該当しなければ None）。
+        ANSWER_TEMPLATES=0 の場合は常に None（画面・一括実行のどちらでもLLMで回答する）。
+        """
+        if not TEMPLATES_ENABLED:
+            return None
+        started = time.perf_counter()
+        shape, answer = template_answer(turn.question, turn.summary, **turn.template_vars)
+        if answer is None:
+            return None
+        turn.trace.record("answer", time.perf_counter() - started, template=shape)
+        turn.trace.set(answer_template=shape)
+        turn.answer_template = shape
+        turn.answer = answer
+        return answer
+
+    def cached_answer(self, turn):
+        """同じ質問・同じ結果に対する回答が既にあれば返す（追加質問では使わない）。"""
+        if turn.previous is not None:
+            return None
+        answer = get_result_cache().get_answer(turn.result_source, turn.sql, turn.question, *turn.cache_extra)
+        turn.answer_from_cache = answer is not None
+        turn.trace.cache_result("answer", turn.answer_from_cache)
+        if answer is not None:
+            turn.answer = answer
+        return answer
+
+    def answer_messages(self, turn):
+        final_prompt = self.answer_template.format(
+            question=turn.full_question,
+            sql=turn.full_sql,
+            # 大きな結果はプレビュー＋統計に圧縮する
+            context=turn.summary.to_prompt_context(as_dicts=self.as_dicts),
+            **turn.template_vars,
+        )
+        return [
+            {"role": "system", "content": self.answer_system_prompt},
+            {"role": "user", "content": final_prompt},
+        ]
+
+    def store_answer(self, turn, answer, stats=None):
+        """生成した回答を保存する。stats（llm_stream.StreamStats）を渡すと回答生成のフェーズとして記録する。"""
+        if stats is not None and stats.total_time is not None:
+            turn.trace.record(
+                "answer", stats.total_time, usage=stats.usage,
+                first_token_sec=round(stats.time_to_first_token, 3) if stats.time_to_first_token is not None else None,
+            )
+        turn.answer = answer
+        if turn.previous is None:
+            get_result_cache().put_answer(turn.result_source, turn.sql, turn.question, answer, *turn.cache_extra)
+
+    # --- 画面を使わない実行 ---
+
+    def run(self, client, question, parallel=False, use_cache=True, session_id=None, templates=TEMPLATES_ENABLED,
+            **context):
+        """
+        1つの質問を最後まで処理する（ベンチマーク・バッチ実行用。回答はストリーミングしない）。
+        use_cache=False の場合はSQL・実行結果・回答のキャッシュを使わずに全フェーズを実行する。
+        templates=False の場合は結果が単純でも定型文を使わず、LLMで回答を作る。
+        session_id を渡すと、そのセッションの直前の結果に対する追加質問として処理できるか先に確認する。
+        """
+        # 追加質問かどうかは、SQLキャッシュを引く前に確認する
+        previous = previous_result(session_id, question)
+        turn = self.start(question, previous=previous, **context)
+        try:
+            if not use_cache:
+                turn.sql, turn.sql_from_cache = None, False
+                turn.trace.cache.pop("sql", None)
+            if previous is not None:
+                self.followup(client, turn, previous)
+            if turn.sql is None:
+                if parallel:
+                    self.generate_candidates(client, turn)
+                else:
+                    self.generate_sql(client, turn)
+            if turn.summary is None and not (use_cache and self.cached_result(turn)):
+                self.execute(turn)
+            self.remember_sql(turn)
+            answer = self.template_answer(turn) if templates else None
+            if answer is None and use_cache:
+                answer = self.cached_answer(turn)
+            if answer is None:
+                with turn.trace.span("answer") as span:
+                    response = client.chat.completions.create(model=MODEL, messages=self.answer_messages(turn))
+                    span.add_usage(getattr(response, "usage", None))
+                self.store_answer(turn, response.choices[0].message.content)
+            if session_id is not None:
+                get_followup_store().put(session_id, turn)
+        finally:
+            turn.trace.finish("ok" if turn.answer is not None else "error")
+        return turn
+
+
+PIPELINES = {
+    "txt2sql": SqlPipeline(
+        "txt2sql", "Chinook.db",
+        CHINOOK_SCHEMA_HEADER, CHINOOK_SCHEMA_RULES,
+        CHINOOK_ANSWER_SYSTEM_PROMPT, CHINOOK_ANSWER_TEMPLATE,
+    ),
+    # 集計済みテーブル（rollups.py）は自動で振り分けるため、LLMには元テーブルだけを見せる
+    "mark_db": SqlPipeline(
+        "mark_db", "marketing.db",
+        MARKETING_SCHEMA_HEADER, MARKETING_SCHEMA_RULES,
+        MARKETING_ANSWER_SYSTEM_PROMPT, MARKETING_ANSWER_TEMPLATE,
+        route=True, as_dicts=True, exclude={rollup.name for rollup in ROLLUPS},
+    ),
+}
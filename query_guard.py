@@ -0,0 +1,157 @@
+# LLMが生成したSQLの実行時間・VMステップ数の上限とキャンセル
+# sqlite3 の progress handler で実行中のクエリを定期的に確認し、
+# 上限を超えた・キャンセルされた場合は中断して構造化したエラーを返す。
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+
+# progress handler を呼び出す間隔（SQLite VM の命令数）
+PROGRESS_INTERVAL = 10_000
+
+# ページごとの既定の上限（環境変数 <PAGE>_QUERY_TIMEOUT / <PAGE>_QUERY_MAX_STEPS で上書き可能）
+DEFAULT_BUDGETS = {
+    "txt2sql": {"timeout": 10.0, "max_steps": 500_000_000},
+    "mark_db": {"timeout": 10.0, "max_steps": 500_000_000},
+}
+
+# クエリを実行するワーカースレッドの数（暴走したクエリがスレッドを使い切らないよう上限を設ける）
+QUERY_WORKERS = int(os.environ.get("QUERY_WORKERS", "8"))
+
+
+class QueryBudget:
+    """1クエリあたりの上限。None の項目は無制限。"""
+
+    def __init__(self, timeout=None, max_steps=None):
+        self.timeout = timeout
+        self.max_steps = max_steps
+
+
+def get_budget(page):
+    defaults = DEFAULT_BUDGETS.get(page, {})
+    prefix = page.upper()
+    timeout = os.environ.get(f"{prefix}_QUERY_TIMEOUT")
+    max_steps = os.environ.get(f"{prefix}_QUERY_MAX_STEPS")
+    return QueryBudget(
+        timeout=float(timeout) if timeout else defaults.get("timeout"),
+        max_steps=int(max_steps) if max_steps else defaults.get("max_steps"),
+    )
+
+
+class QueryBudgetExceeded(Exception):
+    """クエリが上限を超えた、またはキャンセルされたために中断されたことを表す。"""
+
+    MESSAGES = {
+        "timeout": "クエリの実行時間が上限（{limit}秒）を超えたため中断しました。",
+        "steps": "クエリの処理量が上限（{limit:,}ステップ）を超えたため中断しました。",
+        "cancelled": "クエリはキャンセルされました。",
+    }
+
+    def __init__(self, reason, elapsed, steps, limit=None):
+        self.reason = reason
+        self.elapsed = elapsed
+        self.steps = steps
+        self.limit = limit
+        super().__init__(self.user_message())
+
+    def user_message(self):
+        return self.MESSAGES[self.reason].format(limit=self.limit)
+
+    def to_dict(self):
+        return {
+            "reason": self.reason,
+            "elapsed_sec": round(self.elapsed, 3),
+            "steps": self.steps,
+            "limit": self.limit,
+        }
+
+
+@contextmanager
+def guarded(conn, budget, cancel_event=None):
+    """
+    with ブロック内で conn が実行するSQL（execute と fetch の両方）に上限を適用する。
+    上限超過・キャンセル時は QueryBudgetExceeded を送出する。
+    """
+    started = time.perf_counter()
+    state = {"calls": 0, "reason": None}
+
+    def handler():
+        state["calls"] += 1
+        if cancel_event is not None and cancel_event.is_set():
+            state["reason"] = "cancelled"
+        elif budget.max_steps and state["calls"] * PROGRESS_INTERVAL > budget.max_steps:
+            state["reason"] = "steps"
+        elif budget.timeout and time.perf_counter() - started > budget.timeout:
+            state["reason"] = "timeout"
+        # 0 以外を返すと SQLite は実行を中断する（OperationalError: interrupted）
+        return 1 if state["reason"] else 0
+
+    conn.set_progress_handler(handler, PROGRESS_INTERVAL)
+    try:
+        yield
+    except sqlite3.OperationalError as e:
+        if state["reason"] is None:
+            raise
+        limit = {"timeout": budget.timeout, "steps": budget.max_steps}.get(state["reason"])
+        raise QueryBudgetExceeded(
+            state["reason"], time.perf_counter() - started, state["calls"] * PROGRESS_INTERVAL, limit
+        ) from e
+    finally:
+        conn.set_progress_handler(None, PROGRESS_INTERVAL)
+
+
+_executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="query")
+
+
+def run_cancellable(func, on_wait=None, poll_interval=0.2):
+    """
+    func(cancel_event) をワーカースレッドで実行し、結果を返す。
+    待っている間は poll_interval ごとに on_wait() を呼ぶ。on_wait が例外を送出した場合
+    （Streamlit の再実行要求など）は cancel_event をセットしてクエリを中断させる。
+    """
+    cancel_event = threading.Event()
+    future = _executor.submit(func, cancel_event)
+    try:
+        while True:
+            try:
+                return future.result(timeout=poll_interval)
+            except FutureTimeout:
+                if on_wait is not None:
+                    on_wait()
+    finally:
+        cancel_event.set()
+
+
+def st_run_cancellable(func, key="cancel_query"):
+    """
+    run_cancellable の Streamlit 版。実行中は経過時間とキャンセルボタンを表示する。
+    ボタンを押すと Streamlit が再実行を要求し、次の画面更新の時点でクエリが中断される。
+    """
+    import streamlit as st
+
+    status = st.empty()
+    button = st.empty()
+    button.button("クエリをキャンセル", key=key)
+    started = time.perf_counter()
+
+    interrupted = False
+
+    def on_wait():
+        nonlocal interrupted
+        try:
+            status.caption(f"SQLを実行中...（{time.perf_counter() - started:.1f}秒）")
+        except BaseException:
+            # ボタンによる再実行要求（RerunException など）。クエリ自体のエラーはここを通らない
+            interrupted = True
+            raise
+
+    try:
+        return run_cancellable(func, on_wait)
+    finally:
+        if interrupted:
+            # 再実行後の画面で「キャンセルしました」と表示するための印
+            st.session_state["query_cancelled"] = True
+        status.empty()
+        button.empty()
@@ -0,0 +1,128 @@
+# main.py の回答生成の流れ（質問のベクトル化 → ベクトル検索 → 回答生成）
+# 画面（main.py）とベンチマークで同じ処理を使うため、プロンプトと各ステップをここにまとめる。
+# クライアント（Azure OpenAI / AI Search）は呼び出し側から渡す。
+from embedding_cache import get_embedding_cache
+from tracing import Trace
+from vector_index import VECTOR_BACKEND, get_local_index
+
+MODEL = "gpt-4o-mini"
+
+# 検索する文書の件数
+TOP_K = 3
+
+# AIのキャラクターを決めるシステムメッセージ
+SYSTEM_MESSAGE = """
+あなたは経験豊富なデータアナリストです。
+以下のテーブル定義を参考にして、ユーザーの質問に対するDataverse SQL を生成・実行して回答してください。
+生成するDataverse SQLは、指定されたテーブルとカラムのみを使用し、正確で効率的でDataverseがサポートしている内容である必要があります。Dataverse SQLで期間を指定する際は絶対的な期間指定をお願いします。
+
+【スキーマ情報】
+--- テーブル定義 ---
+- テーブル名: cr187_koutuu
+  説明: Web広告の指標を格納するテーブル
+  カラム:
+  - cr187_koutuuId StringType- 一意識別子,
+  - cr187_date DateType - 広告の配信日, 
+  - cr187_impressions IntegerType - 広告の表示回数, 
+  - cr187_clicks IntegerType- 広告のクリック数, 
+  - cr187_cost DoubleType- 広告費,
+  - cr187_medium StringType- 広告のメディア。Google, Yahooなど,
+  - cr187_account StringType- 事業ドメイン
+  - cr187_column08 - 新規登録された顧客数
+  - cr187_column09 - 予約した顧客数
+  - cr187_column10 - 受任意志を示した顧客数
+  - cr187_column11 - 受任契約をした顧客数
+
+【ルール】
+1. DataverseのTDSエンドポイントで実行可能なSQL構文を使用してください。
+2. SELECT文のみを生成してください。UPDATEやDELETEは禁止です。
+3. 必要に応じてJOINを使用してください。
+4. Dataverse SQL 内で日付を使う場合、絶対的な日付を使用してください。
+
+"""
+
+
+def embed_question(client, model, question, trace=None, use_cache=True):
+    """質問をベクトル化する（同じ質問のベクトルはキャッシュから取り出す）。"""
+    trace = trace or Trace("main", question)
+    cache = get_embedding_cache()
+    with trace.span("embed") as span:
+        vector = cache.get(model, question) if use_cache else None
+        if use_cache:
+            trace.cache_result("embedding", vector is not None)
+        if vector is None:
+            response = client.embeddings.create(input=[question], model=model)
+            span.add_usage(getattr(response, "usage", None))
+            vector = response.data[0].embedding
+            cache.put(model, question, vector)
+    return vector
+
+
+def retrieve(question_vector, search_client=None, k=TOP_K, local_index=None, trace=None):
+    """
+    ベクトル検索を行い、result["id"] / result["content"] を持つ結果のリストを返す。
+    local_index を渡すか VECTOR_BACKEND=local の場合はプロセス内の索引（vector_index.py）を使う。
+    """
+    trace = trace or Trace("main")
+    with trace.span("retrieve") as span:
+        if local_index is not None or VECTOR_BACKEND == "local":
+            span.set(backend="local")
+            results = (local_index or get_local_index()).search(question_vector, k=k)
+        else:
+            from azure.search.documents.models import VectorizedQuery
+
+            span.set(backend="azure")
+            # ベクトル化された質問を Azure AI Searchに対し検索するためのクエリを生成する
+            vector_query = VectorizedQuery(
+                vector=question_vector,
+                k_nearest_neighbor=k,
+                fields="contentVector"
+            )
+            # ベクトル化された質問を用いて、Azure AI Searchに対してベクトル検索を行う。
+            # （結果は反復したときに取得されるため、ここでリストにして検索時間に含める）
+            results = list(search_client.search(
+                vector_queries=[vector_query],
+                select=["id", "content"]
+            ))
+        span.set(documents=len(results))
+    return results
+
+
+def build_messages(question, results):
+    """システムメッセージと、質問・検索した情報源を含むユーザーメッセージを作る。"""
+    # Azure AI Searchから取得した内容を追加する
+    sources = ["[Source" + result["id"] + "]:" + result["content"] for result in results]
+    source = "\n".join(sources)
+
+    # ユーザーの質問と情報源を含むメッセージを生成する
+    user_message = """
+    {query}
+
+    Sources:
+    {source}
+    """.format(query=question, source=source)
+
+    return [
+        {"role": "system", "content": SYSTEM_MESSAGE},
+        {"role": "user", "content": user_message},
+    ]
+
+
+def run(question, embedding_client, chat_client, embedding_model, search_client=None, local_index=None,
+        use_cache=True):
+    """
+    1つの質問を最後まで処理し、(回答, トレース) を返す（ベンチマーク用。回答はストリーミングしない）。
+    use_cache=False の場合は埋め込みベクトルのキャッシュを使わない。
+    """
+    trace = Trace("main", question)
+    answer = None
+    try:
+        question_vector = embed_question(embedding_client, embedding_model, question, trace, use_cache)
+        results = retrieve(question_vector, search_client, local_index=local_index, trace=trace)
+        with trace.span("answer") as span:
+            response = chat_client.chat.completions.create(model=MODEL, messages=build_messages(question, results))
+            span.add_usage(getattr(response, "usage", None))
+        answer = response.choices[0].message.content
+    finally:
+        trace.finish("ok" if answer is not None else "error")
+    return answer, trace
@@ -0,0 +1,170 @@
+# SQL実行結果キャッシュ
+# DBが変更されていない限り、同じSQLの実行結果（とそれに対する回答文）を再利用する。
+# メモリを使い切らないよう、結果の推定サイズの合計で上限を設ける。
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+from sql_cache import normalize_question
+
+MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# 1件でこれを超える結果はキャッシュしない
+MAX_ENTRY_BYTES = int(os.environ.get("RESULT_CACHE_MAX_ENTRY_BYTES", str(8 * 1024 * 1024)))
+
+_SPACES = re.compile(r"\s+")
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+
+def protect_literals(sql):
+    """文字列リテラルを置き換え用の印に置き換え、(置き換え後のSQL, 元のリテラルのリスト) を返す。"""
+    literals = []
+
+    def keep(match):
+        literals.append(match.group(0))
+        return f"'\x00{len(literals) - 1}'"
+
+    return _STRING_LITERAL.sub(keep, sql), literals
+
+
+def restore_literals(sql, literals):
+    return re.sub(r"'\x00(\d+)'", lambda m: literals[int(m.group(1))], sql)
+
+
+def normalize_sql(sql):
+    """空白の違いと末尾のセミコロンを吸収したSQL文字列を返す（文字列リテラルの中の空白はそのまま）。"""
+    protected, literals = protect_literals(sql)
+    return restore_literals(_SPACES.sub(" ", protected).strip().rstrip(";").strip(), literals)
+
+
+def estimate_size(value):
+    """結果セットのおおよそのメモリ使用量（バイト）を返す。"""
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            size += estimate_size(item)
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            size += estimate_size(k) + estimate_size(v)
+    return size
+
+
+class ResultCache:
+    """
+    (DBパス, DBのバージョン, 正規化SQL) をキーに実行結果を保持するキャッシュ。
+    DBのバージョンはファイル（および -wal ファイル）の更新時刻・サイズと、
+    invalidate() で進める世代番号から作るため、DBが書き換わると自動的に別キーになる。
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, max_entry_bytes=MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries = OrderedDict()   # key -> (value, size)
+        self._bytes = 0
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # --- キー ---
+
+    def db_version(self, db_path):
+        path = os.path.abspath(db_path)
+        stamp = [self._generations.get(path, 0)]
+        for suffix in ("", "-wal"):
+            try:
+                st = os.stat(path + suffix)
+                stamp.extend((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                stamp.extend((0, 0))
+        return tuple(stamp)
+
+    def _rows_key(self, db_path, sql):
+        path = os.path.abspath(db_path)
+        return ("rows", path, self.db_version(path), normalize_sql(sql))
+
+    def _answer_key(self, db_path, sql, question, extra):
+        path = os.path.abspath(db_path)
+        return ("answer", path, self.db_version(path), normalize_sql(sql),
+                normalize_question(question), tuple(map(str, extra)))
+
+    # --- 基本操作 ---
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _put(self, key, value):
+        size = estimate_size(value)
+        if size > self.max_entry_bytes:
+            return False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            # 合計サイズが上限を超えたら古いものから削除する
+            while self._bytes > self.max_bytes and self._entries:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+        return True
+
+    # --- 実行結果 ---
+
+    def get_rows(self, db_path, sql):
+        """キャッシュ済みの (columns, rows) を返す。無ければ None。"""
+        return self._get(self._rows_key(db_path, sql))
+
+    def put_rows(self, db_path, sql, columns, rows):
+        return self._put(self._rows_key(db_path, sql), (list(columns), list(rows)))
+
+    # --- 回答文（Phase 3） ---
+
+    def get_answer(self, db_path, sql, question, *extra):
+        return self._get(self._answer_key(db_path, sql, question, extra))
+
+    def put_answer(self, db_path, sql, question, answer, *extra):
+        return self._put(self._answer_key(db_path, sql, question, extra), answer)
+
+    # --- 無効化 ---
+
+    def invalidate(self, db_path):
+        """db_path の結果をすべて破棄する（INSERT/UPDATE/DELETE 実行後に呼ぶ）。"""
+        path = os.path.abspath(db_path)
+        with self._lock:
+            self._generations[path] = self._generations.get(path, 0) + 1
+            for key in [k for k in self._entries if k[1] == path]:
+                _, size = self._entries.pop(key)
+                self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """プロセス内で共有する ResultCache を返す（初回呼び出し時に作成）。"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache()
+        return _cache
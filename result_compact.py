@@ -0,0 +1,173 @@
+# SQL実行結果の圧縮（Phase 3 のプロンプト用）
+# fetchall() の結果をそのままプロンプトに入れると、数万行の結果でプロンプトが肥大化する。
+# fetchmany で上限付きに取得しつつ列ごとの統計を逐次計算し、
+# LLMには「先頭数行のプレビュー＋列の統計」だけを渡す。
+import os
+from collections import Counter
+
+# 取得する最大行数・最大サイズ（これを超えたら打ち切る）
+MAX_FETCH_ROWS = int(os.environ.get("RESULT_MAX_FETCH_ROWS", "10000"))
+MAX_FETCH_BYTES = int(os.environ.get("RESULT_MAX_FETCH_BYTES", str(16 * 1024 * 1024)))
+FETCH_BATCH_SIZE = 500
+
+# プロンプトに入れるプレビューの上限
+PREVIEW_ROWS = int(os.environ.get("RESULT_PREVIEW_ROWS", "20"))
+PREVIEW_BYTES = int(os.environ.get("RESULT_PREVIEW_BYTES", "4000"))
+
+# 上位値を数える列の種類数の上限（これを超えた列は上位値を出さない）
+TOP_K = 5
+MAX_DISTINCT_TRACKED = 1000
+
+
+def approx_tokens(text):
+    """トークン数の概算（英数字は約4文字で1トークン、それ以外は1文字1トークン）。"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+class ColumnStats:
+    """1列分の統計（件数・NULL数・最小/最大・合計・上位値）を逐次計算する。"""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        self.sum = 0
+        self.numeric = True
+        self.top = Counter()
+        self.top_overflow = False
+
+    def add(self, value):
+        if value is None:
+            self.nulls += 1
+            return
+        self.count += 1
+        is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+        if is_number and self.numeric:
+            self.sum += value
+        else:
+            self.numeric = False
+        try:
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+        except TypeError:
+            # 型が混在する列は最小/最大を比較できない
+            pass
+        if not is_number and not self.top_overflow:
+            self.top[value] += 1
+            if len(self.top) > MAX_DISTINCT_TRACKED:
+                self.top_overflow = True
+                self.top.clear()
+
+    def describe(self):
+        parts = [f"件数 {self.count}"]
+        if self.nulls:
+            parts.append(f"NULL {self.nulls}")
+        if self.count:
+            parts.append(f"最小 {self.min}")
+            parts.append(f"最大 {self.max}")
+        if self.numeric and self.count:
+            parts.append(f"合計 {round(self.sum, 4)}")
+        elif self.top:
+            top = ", ".join(f"{value}({n})" for value, n in self.top.most_common(TOP_K))
+            parts.append(f"上位: {top}")
+        elif self.top_overflow:
+            parts.append(f"種類数 {MAX_DISTINCT_TRACKED}超")
+        return f"- {self.name}: " + ", ".join(parts)
+
+
+class ResultSummary:
+    """
+    SQL実行結果と、その列統計。
+    rows には取得した行（上限まで）をすべて保持し、画面の詳細表示に使う。
+    """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.rows = []
+        self.stats = [ColumnStats(name) for name in self.columns]
+        self.raw_bytes = 0
+        self.raw_tokens = 0
+        self.truncated = False
+
+    def add_rows(self, rows):
+        for row in rows:
+            self.rows.append(row)
+            text = repr(row)
+            self.raw_bytes += len(text)
+            self.raw_tokens += approx_tokens(text)
+            for stats, value in zip(self.stats, row):
+                stats.add(value)
+
+    @property
+    def row_count(self):
+        return len(self.rows)
+
+    def _preview(self, as_dicts, max_rows, max_bytes):
+        preview = []
+        used = 0
+        for row in self.rows[:max_rows]:
+            item = dict(zip(self.columns, row)) if as_dicts else row
+            used += len(repr(item))
+            if preview and used > max_bytes:
+                break
+            preview.append(item)
+        return preview
+
+    def to_prompt_context(self, as_dicts=False, max_rows=PREVIEW_ROWS, max_bytes=PREVIEW_BYTES):
+        """
+        LLMに渡す結果テキストを返す。
+        全行がプレビューに収まる場合は従来どおり結果そのものを返し、
+        収まらない場合は先頭行のプレビューと列の統計を返す。
+        """
+        preview = self._preview(as_dicts, max_rows, max_bytes)
+        if len(preview) == self.row_count and not self.truncated:
+            return str(preview)
+
+        total = f"{self.row_count}行以上（取得上限で打ち切り）" if self.truncated else f"{self.row_count}行"
+        lines = [
+            f"列: {', '.join(self.columns)}",
+            f"全{total}のうち、先頭{len(preview)}行を表示します。",
+            "先頭行:",
+            str(preview),
+            f"列ごとの統計（取得した先頭{self.row_count}行が対象。残りの行は含みません）:" if self.truncated
+            else "列ごとの統計（全行が対象）:",
+        ]
+        lines.extend(stats.describe() for stats in self.stats)
+        return "\n".join(lines)
+
+    def token_report(self, as_dicts=False):
+        """圧縮前後のトークン数の概算を返す。"""
+        # 圧縮前のテキストは作らず、取得時に数えた行ごとの概算を使う
+        compacted = approx_tokens(self.to_prompt_context(as_dicts))
+        return {"before": max(compacted, self.raw_tokens), "after": compacted}
+
+
+def fetch_compacted(cursor, max_rows=MAX_FETCH_ROWS, max_bytes=MAX_FETCH_BYTES,
+                    batch_size=FETCH_BATCH_SIZE):
+    """実行済みのカーソルから、行数・サイズの上限付きで結果を取得し統計を計算する。"""
+    columns = [description[0] for description in cursor.description or ()]
+    summary = ResultSummary(columns)
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        remaining = max_rows - summary.row_count
+        summary.add_rows(batch[:remaining])
+        if summary.row_count >= max_rows or summary.raw_bytes >= max_bytes:
+            # 上限に達した。続きがあるかどうかだけ確認する
+            summary.truncated = len(batch) > remaining or bool(cursor.fetchmany(1))
+            break
+    return summary
+
+
+def summarize_rows(columns, rows, truncated=False):
+    """取得済みの行（キャッシュから取り出した結果など）から ResultSummary を作る。"""
+    summary = ResultSummary(columns)
+    summary.add_rows(rows)
+    summary.truncated = truncated
+    return summary
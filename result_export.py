@@ -0,0 +1,314 @@
+# 参照クエリの結果の書き出し（CSV / Parquet）
+# sql_runner.py では結果を st.dataframe で表示する以外に取り出す方法が無かった（表示には全件を読み込んでいた）。
+# カーソルから一定の行数（batch_size）ずつ取り出してそのままファイルに書くため、結果の行数によらず
+# メモリの使用量は一定になる。Parquet は pyarrow の ParquetWriter でバッチごとに1つの行グループとして書く。
+# 読み取り専用（mode=ro）の接続で実行するため、書き込みを含む文は実行できない。
+#
+# 使い方:
+#   python result_export.py export "SELECT * FROM Track" track.csv
+#   python result_export.py export "SELECT * FROM Track" track.parquet --db Chinook.db --batch-size 20000
+#   python result_export.py bench                   # 大きな結合の書き出しで rows/sec とピークメモリを比較
+#   python result_export.py bench --copies 500      # 結合結果を 500 倍にして計測
+import argparse
+import csv
+import glob
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from db_pool import get_readonly_pool
+from result_cache import get_result_cache
+
+# 1回の fetchmany で取り出す行数（Parquet では1つの行グループの行数）
+BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "10000"))
+
+# ページから書き出したファイルの置き場所と、残しておくファイル数
+EXPORT_DIR = os.environ.get("EXPORT_DIR", os.path.join(".cache", "exports"))
+EXPORT_KEEP = int(os.environ.get("EXPORT_KEEP", "20"))
+
+# st.download_button は再実行のたびにファイルの内容をメモリに読み込むため、これより大きいファイルは
+# ダウンロードボタンを出さず、サーバー上のファイルか CLI での書き出しを案内する
+DOWNLOAD_MAX_BYTES = int(os.environ.get("EXPORT_DOWNLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+
+FORMATS = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+
+def parquet_available():
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def format_for(path):
+    fmt = os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"対応していない形式です: {path}（.csv または .parquet）")
+    return fmt
+
+
+# ==========================================
+# 1. 書き出し
+# ==========================================
+
+def write_csv(cursor, f, batch_size=BATCH_SIZE):
+    """カーソルの結果を CSV としてテキストファイル f に書き、行数を返す（NULL は空欄）。"""
+    writer = csv.writer(f)
+    writer.writerow([d[0] for d in cursor.description or ()])
+    rows = 0
+    while batch := cursor.fetchmany(batch_size):
+        writer.writerows(batch)
+        rows += len(batch)
+    return rows
+
+
+def _arrow_type(pa, values):
+    """先頭のバッチの値から列の型を決める（SQLite は行ごとに型が違いうるため、整数と実数の混在は実数にする）。"""
+    kinds = {type(v) for v in values if v is not None}
+    if kinds and kinds <= {int}:
+        return pa.int64()
+    if kinds and kinds <= {int, float}:
+        return pa.float64()
+    if kinds == {bytes}:
+        return pa.binary()
+    return pa.string()
+
+
+def write_parquet(cursor, path, batch_size=BATCH_SIZE):
+    """カーソルの結果を Parquet としてバッチごとに1つの行グループで書き、行数を返す（pyarrow が無い場合は RuntimeError）。"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("Parquet での書き出しには pyarrow パッケージが必要です。") from e
+
+    names = [d[0] for d in cursor.description or ()]
+    batch = cursor.fetchmany(batch_size)
+    columns = list(zip(*batch)) if batch else [()] * len(names)
+    schema = pa.schema([(name, _arrow_type(pa, values)) for name, values in zip(names, columns)])
+    rows = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        while batch:
+            columns = list(zip(*batch))
+            arrays = []
+            for field, values in zip(schema, columns):
+                if field.type == pa.string():
+                    values = [v if v is None or isinstance(v, str) else str(v) for v in values]
+                try:
+                    arrays.append(pa.array(values, type=field.type))
+                except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                    raise ValueError(
+                        f"列 {field.name} の型が途中の行で {field.type} から変わりました。"
+                        f"CAST で型を揃えるか CSV で書き出してください: {e}"
+                    ) from e
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            rows += len(batch)
+            batch = cursor.fetchmany(batch_size)
+    return rows
+
+
+def export(conn, sql, path, fmt=None, batch_size=BATCH_SIZE):
+    """
+    sql の結果を path に書き出す（同じディレクトリの一時ファイルに書いてから置き換える）。行数・サイズ・時間を返す。
+    一時ファイルは mkstemp で作るため、複数のセッションが同じ path に書き出しても混ざらない。
+    """
+    fmt = fmt or format_for(path)
+    started = time.perf_counter()
+    cursor = conn.execute(sql)
+    # 先頭を "." にして、_prune（export-*）の対象にしない
+    fd, partial = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.", suffix=".part"
+    )
+    try:
+        if fmt == "parquet":
+            os.close(fd)
+            rows = write_parquet(cursor, partial, batch_size)
+        else:
+            with open(fd, "w", newline="", encoding="utf-8") as f:
+                rows = write_csv(cursor, f, batch_size)
+        # mkstemp は所有者だけが読める権限で作るため、通常のファイルと同じ権限にしてから置き換える
+        os.chmod(partial, 0o644)
+        os.replace(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    finally:
+        cursor.close()
+    seconds = time.perf_counter() - started
+    return {
+        "path": path, "format": fmt, "rows": rows, "bytes": os.path.getsize(path),
+        "seconds": round(seconds, 4), "rows_per_sec": round(rows / seconds) if seconds > 0 else None,
+    }
+
+
+def export_query(db_path, sql, fmt="csv", batch_size=BATCH_SIZE):
+    """
+    ページ用: sql の結果を EXPORT_DIR に書き出す。DBが変更されていなければ、同じSQLで書き出したファイルを再利用する。
+    """
+    version = get_result_cache().db_version(db_path)
+    key = hashlib.sha256(json.dumps([os.path.abspath(db_path), version, sql]).encode("utf-8")).hexdigest()[:16]
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, f"export-{key}.{fmt}")
+    if os.path.exists(path):
+        return {"path": path, "format": fmt, "bytes": os.path.getsize(path), "reused": True}
+    with get_readonly_pool(db_path).connection() as conn:
+        result = export(conn, sql, path, fmt, batch_size)
+    _prune(EXPORT_DIR, EXPORT_KEEP)
+    return result
+
+
+def _prune(directory, keep):
+    """古い書き出しファイルを削除する（新しい順に keep 個を残す）。"""
+    files = sorted(glob.glob(os.path.join(directory, "export-*")), key=os.path.getmtime, reverse=True)
+    for path in files[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# ==========================================
+# 2. ベンチマーク（大きな結合の書き出し）
+# ==========================================
+
+# InvoiceLine ⋈ Track ⋈ Album を copies 倍にした結果
+BENCH_SQL = """
+WITH RECURSIVE copies(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM copies WHERE n < {copies})
+SELECT copies.n AS copy, il.InvoiceLineId, il.InvoiceId, il.UnitPrice, il.Quantity,
+       t.Name AS Track, t.Composer, t.Milliseconds, t.Bytes, a.Title AS Album
+FROM InvoiceLine il
+JOIN Track t ON t.TrackId = il.TrackId
+JOIN Album a ON a.AlbumId = t.AlbumId
+CROSS JOIN copies
+"""
+
+# 1つの方式を新しいプロセスで実行し、ピークメモリ（ru_maxrss）を計測する子プロセス
+# 引数: DBのパス, SQL, 方式, 出力先, バッチサイズ
+_RUN_MODE = r"""
+import json, resource, sqlite3, sys, time
+import result_export
+
+db_path, sql, mode, out, batch_size = sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], int(sys.argv[5])
+conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+started = time.perf_counter()
+if mode == "stream":
+    rows = result_export.export(conn, sql, out, batch_size=batch_size)["rows"]
+else:
+    # 変更前と同じく全件をメモリに読み込んでから書き出す（pandas があれば DataFrame を経由する）
+    try:
+        import pandas as pd
+    except ImportError:
+        cursor = conn.execute(sql)
+        columns = [d[0] for d in cursor.description]
+        data = cursor.fetchall()
+        with open(out, "w", newline="", encoding="utf-8") as f:
+            import csv
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(data)
+        rows = len(data)
+    else:
+        frame = pd.read_sql(sql, conn)
+        frame.to_parquet(out) if out.endswith(".parquet") else frame.to_csv(out, index=False)
+        rows = len(frame)
+seconds = time.perf_counter() - started
+print(json.dumps({"rows": rows, "seconds": seconds,
+                  "baseline_rss_kb": before, "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+"""
+
+
+def bench(db_path="Chinook.db", copies=200, batch_size=BATCH_SIZE, formats=None):
+    """
+    BENCH_SQL の結果を、全件を読み込んでから書く方式（fetchall）とバッチごとに書く方式（stream）で
+    書き出し、rows/sec とピークメモリを比較する。各方式は新しいプロセスで実行する。
+    """
+    formats = formats or ["csv"] + (["parquet"] if parquet_available() else [])
+    sql = BENCH_SQL.format(copies=copies)
+    root = os.path.dirname(os.path.abspath(__file__))
+    report = {"copies": copies, "batch_size": batch_size, "results": []}
+    with tempfile.TemporaryDirectory(prefix="export-bench-") as directory:
+        for fmt in formats:
+            for mode in ("fetchall", "stream"):
+                out = os.path.join(directory, f"{mode}.{fmt}")
+                completed = subprocess.run(
+                    [sys.executable, "-c", _RUN_MODE, os.path.abspath(db_path), sql, mode, out, str(batch_size)],
+                    cwd=root, capture_output=True, text=True,
+                )
+                item = {"format": fmt, "mode": mode}
+                if completed.returncode != 0:
+                    item["error"] = (completed.stderr.strip().splitlines() or ["失敗しました"])[-1]
+                else:
+                    run = json.loads(completed.stdout.strip().splitlines()[-1])
+                    item.update(
+                        rows=run["rows"], seconds=round(run["seconds"], 3),
+                        rows_per_sec=round(run["rows"] / run["seconds"]) if run["seconds"] > 0 else None,
+                        # ru_maxrss は Linux では KB 単位
+                        peak_rss_mb=round(run["max_rss_kb"] / 1024, 1),
+                        added_rss_mb=round((run["max_rss_kb"] - run["baseline_rss_kb"]) / 1024, 1),
+                        file_mb=round(os.path.getsize(out) / 1024 / 1024, 1),
+                    )
+                report["results"].append(item)
+    return report
+
+
+# ==========================================
+# 3. コマンドライン
+# ==========================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="参照クエリの結果を CSV / Parquet に書き出す")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("export")
+    p.add_argument("sql")
+    p.add_argument("out", help="出力先（拡張子 .csv / .parquet で形式を決める。- で標準出力に CSV）")
+    p.add_argument("--db", default="Chinook.db")
+    p.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    p = sub.add_parser("bench")
+    p.add_argument("--db", default="Chinook.db")
+    p.add_argument("--copies", type=int, default=200, help="結合結果を何倍にするか")
+    p.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    p.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        conn = sqlite3.connect(f"file:{os.path.abspath(args.db)}?mode=ro", uri=True)
+        try:
+            if args.out == "-":
+                out = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8", newline="")
+                write_csv(conn.execute(args.sql), out, args.batch_size)
+                out.flush()
+                out.detach()
+                return 0
+            result = export(conn, args.sql, args.out, batch_size=args.batch_size)
+        finally:
+            conn.close()
+        print(f"{result['path']}: {result['rows']:,} 行 / {result['bytes'] / 1024 / 1024:.1f}MB / "
+              f"{result['seconds']:.3f}秒（{result['rows_per_sec'] or 0:,} rows/s）", file=sys.stderr)
+        return 0
+
+    report = bench(args.db, args.copies, args.batch_size)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return 0
+    print(f"InvoiceLine ⋈ Track ⋈ Album × {report['copies']}（バッチ {report['batch_size']:,} 行）")
+    for item in report["results"]:
+        if "error" in item:
+            print(f"  {item['format']:<8} {item['mode']:<9} 計測できませんでした: {item['error']}")
+            continue
+        print(f"  {item['format']:<8} {item['mode']:<9} {item['rows']:,} 行 {item['seconds']:.2f}秒"
+              f"（{item['rows_per_sec']:,} rows/s） ピークメモリ {item['peak_rss_mb']}MB"
+              f"（+{item['added_rss_mb']}MB） ファイル {item['file_mb']}MB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
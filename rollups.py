@@ -0,0 +1,351 @@
+# marketing.db の集計済み（ロールアップ）テーブルと、集計クエリの自動振り分け
+# mark_db.py で生成されるSQLの多くは AdPerformance / CustomerAcquisition を
+# 日付・月 × 媒体・流入元・キャンペーン で SUM するだけなので、
+# 事前に集計したテーブル（数百〜数千行）に振り分ければ数万行のスキャンが不要になる。
+#
+# ロールアップはトリガーで増分更新されるため、元テーブルへの INSERT/UPDATE/DELETE に追従する。
+#
+# 使い方:
+#   python rollups.py write-migration marketing.db   # migrations/marketing/ に作成用SQLを保存
+#   python index_advisor.py migrate marketing.db      # 適用（バージョン管理はマイグレーションに従う）
+#   python rollups.py verify marketing.db             # サンプルワークロードで元テーブルとの一致と速度を確認
+import argparse
+import math
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+from index_advisor import load_workload, migrations_dir, time_query, write_migration
+from query_guard import PROGRESS_INTERVAL
+from result_cache import protect_literals, restore_literals
+
+# 初回の一致確認（元テーブルとロールアップの両方を実行）の制限時間。ユーザーのクエリの上限とは別に数える
+VERIFY_TIMEOUT = float(os.environ.get("ROLLUP_VERIFY_TIMEOUT", "5"))
+# 制限時間・キャンセルで確認できなかったSQLは、この秒数が過ぎるまで振り分けずに元のSQLで実行する
+VERIFY_RETRY = float(os.environ.get("ROLLUP_VERIFY_RETRY", "300"))
+
+AD_MEASURES = ["impressions", "clicks", "conversions", "cost"]
+CA_MEASURES = ["y_new", "y_yoyaku", "y_junin"]
+
+
+class Rollup:
+    """
+    ロールアップテーブルの定義。
+    dims: ロールアップの列名 → 元テーブルでの式
+    measures: SUM を保持する列（元テーブルと同名）
+    """
+
+    def __init__(self, name, base, dims, measures):
+        self.name = name
+        self.base = base
+        self.dims = dims
+        self.measures = measures
+
+    # --- 作成用SQL ---
+
+    def ddl(self):
+        columns = [f'"{d}"' for d in self.dims] + [f'"{m}" NOT NULL DEFAULT 0' for m in self.measures]
+        columns.append('"row_count" INTEGER NOT NULL DEFAULT 0')
+        dim_list = ", ".join(f'"{d}"' for d in self.dims)
+        dim_exprs = ", ".join(self.dims.values())
+        sums = ", ".join(f'SUM(COALESCE("{m}", 0))' for m in self.measures)
+        statements = [
+            f'CREATE TABLE IF NOT EXISTS "{self.name}" ({", ".join(columns)})',
+            f'CREATE INDEX IF NOT EXISTS "idx_{self.name.lower()}_dims" ON "{self.name}" ({dim_list})',
+            f'DELETE FROM "{self.name}"',
+            f'INSERT INTO "{self.name}" ({dim_list}, {", ".join(self.measures)}, row_count) '
+            f'SELECT {dim_exprs}, {sums}, COUNT(*) FROM "{self.base}" GROUP BY {dim_exprs}',
+        ]
+        statements.extend(self._triggers())
+        return statements
+
+    def _match(self, row):
+        # NULL を含むキーでも一致させるため = ではなく IS で比較する
+        return " AND ".join(f'"{d}" IS {self._expr(expr, row)}' for d, expr in self.dims.items())
+
+    def _expr(self, expr, row):
+        # 元テーブルでの式（列名）を NEW./OLD. 付きに置き換える
+        return re.sub(r'"?\b([a-z_]+)\b"?(?!\s*\()', lambda m: f"{row}.{m.group(1)}", expr)
+
+    def _add(self, row, sign):
+        dim_list = ", ".join(f'"{d}"' for d in self.dims)
+        dim_values = ", ".join(self._expr(expr, row) for expr in self.dims.values())
+        updates = ", ".join(f'"{m}" = "{m}" {sign} COALESCE({row}.{m}, 0)' for m in self.measures)
+        statements = []
+        if sign == "+":
+            statements.append(
+                f'INSERT INTO "{self.name}" ({dim_list}) SELECT {dim_values} '
+                f'WHERE NOT EXISTS (SELECT 1 FROM "{self.name}" WHERE {self._match(row)})'
+            )
+        statements.append(
+            f'UPDATE "{self.name}" SET {updates}, row_count = row_count {sign} 1 WHERE {self._match(row)}'
+        )
+        if sign == "-":
+            statements.append(f'DELETE FROM "{self.name}" WHERE row_count <= 0 AND {self._match(row)}')
+        return statements
+
+    def _triggers(self):
+        name = self.name.lower()
+        body_insert = ";\n    ".join(self._add("NEW", "+"))
+        body_delete = ";\n    ".join(self._add("OLD", "-"))
+        return [
+            f'CREATE TRIGGER IF NOT EXISTS "trg_{name}_insert" AFTER INSERT ON "{self.base}" BEGIN\n'
+            f'    {body_insert};\nEND',
+            f'CREATE TRIGGER IF NOT EXISTS "trg_{name}_delete" AFTER DELETE ON "{self.base}" BEGIN\n'
+            f'    {body_delete};\nEND',
+            f'CREATE TRIGGER IF NOT EXISTS "trg_{name}_update" AFTER UPDATE ON "{self.base}" BEGIN\n'
+            f'    {body_delete};\n    {body_insert};\nEND',
+        ]
+
+
+# 行数の少ない順（振り分け時はこの順に適用可能なものを探す）
+ROLLUPS = [
+    Rollup("CustomerAcquisition_monthly", "CustomerAcquisition",
+           {"ym": "substr(date, 1, 7)", "utm_medium": "utm_medium", "utm_source": "utm_source",
+            "utm_campaign": "utm_campaign"}, CA_MEASURES),
+    Rollup("AdPerformance_monthly", "AdPerformance",
+           {"ym": "substr(date, 1, 7)", "year": "year", "month": "month", "media_type": "media_type",
+            "account_type": "account_type"}, AD_MEASURES),
+    Rollup("AdPerformance_daily", "AdPerformance",
+           {"date": "date", "year": "year", "month": "month", "media_type": "media_type"}, AD_MEASURES),
+    Rollup("CustomerAcquisition_daily", "CustomerAcquisition",
+           {"date": "date", "utm_medium": "utm_medium", "utm_source": "utm_source",
+            "utm_campaign": "utm_campaign"}, CA_MEASURES),
+]
+
+
+# ==========================================
+# クエリの振り分け
+# ==========================================
+
+_UNSUPPORTED = re.compile(r"\b(?:JOIN|UNION|INTERSECT|EXCEPT|WITH|OVER|ROWID)\b|\(\s*SELECT\b", re.I)
+_AGGREGATE = re.compile(r"\bSUM\s*\(|\bCOUNT\s*\(|\bGROUP\s+BY\b|\bSELECT\s+DISTINCT\b", re.I)
+_STAR = re.compile(r"\bSELECT\s+\*|,\s*\*|\w\.\*", re.I)
+_COUNT_STAR = re.compile(r"\bCOUNT\s*\(\s*(?:\*|1)\s*\)", re.I)
+# 合計の合計では計算できない集計（COUNT(列) はロールアップの行数を数えてしまう）
+_NON_ADDITIVE = re.compile(r"\b(?:AVG|TOTAL|GROUP_CONCAT)\s*\(|\bCOUNT\s*\(\s*(?!DISTINCT\b|\*|1\s*\))", re.I)
+# 年月で絞り込む書き方（ym 列に置き換えられるもの）
+_MONTH_PATTERNS = [
+    re.compile(r"\b(?:\w+\.)?date\s+LIKE\s+'(\d{4}-\d{2})%'", re.I),
+    re.compile(r"\bstrftime\s*\(\s*'%Y-%m'\s*,\s*(?:\w+\.)?date\s*\)", re.I),
+    re.compile(r"\bsubstr\s*\(\s*(?:\w+\.)?date\s*,\s*1\s*,\s*7\s*\)", re.I),
+]
+
+
+def _column_ref(col):
+    # 列の参照（関数呼び出し date(...) は除く）
+    return re.compile(rf'(?<![\w.])(?:\w+\.)?"?{col}"?(?!\w)(?!\s*\()', re.I)
+
+
+def _rewrite_for(rollup, sql, base_columns):
+    """rollup で同じ結果が得られるなら書き換えたSQLを、得られないなら None を返す。"""
+    text = sql
+    if "ym" in rollup.dims:
+        # date LIKE 'YYYY-MM%' → ym = 'YYYY-MM' など、年月単位の条件は ym 列で表す
+        text = _MONTH_PATTERNS[0].sub(lambda m: f"ym = '{m.group(1)}'", text)
+        for pattern in _MONTH_PATTERNS[1:]:
+            text = pattern.sub("ym", text)
+    protected, literals = protect_literals(text)
+
+    # FROM 句が元テーブル1つだけ（別名は可）であること
+    table = re.compile(
+        rf'\bFROM\s+"?{rollup.base}"?'
+        rf'(?=(?:\s+(?:AS\s+)?(?!(?:WHERE|GROUP|ORDER|LIMIT|HAVING)\b)\w+)?\s*'
+        rf'(?:\b(?:WHERE|GROUP|ORDER|LIMIT|HAVING)\b|;|$))',
+        re.I,
+    )
+    if len(re.findall(r"\bFROM\b", protected, re.I)) != 1 or not table.search(protected):
+        return None
+    if _STAR.search(protected) or _NON_ADDITIVE.search(protected):
+        return None
+
+    # SUM(measure) は合計の合計として計算できる。それ以外での measure の参照や SUM は不可
+    # （AS の別名と、ORDER BY での別名の参照は列の参照ではないので除く）
+    aliases = re.findall(r'\bAS\s+"?(\w+)"?', protected, re.I)
+    without_sums = re.sub(r'\bAS\s+"?\w+"?', "", _COUNT_STAR.sub("", protected), flags=re.I)
+    order_by = re.search(r"\bORDER\s+BY\b", without_sums, re.I)
+    if order_by:
+        tail = without_sums[order_by.end():]
+        for alias in aliases:
+            tail = re.sub(rf'(?<![\w.])"?{alias}"?(?!\w)', "", tail)
+        without_sums = without_sums[:order_by.start()] + " " + tail
+    for measure in rollup.measures:
+        without_sums = re.sub(rf'\bSUM\s*\(\s*(?:\w+\.)?"?{measure}"?\s*\)', "", without_sums, flags=re.I)
+    if re.search(r"\bSUM\s*\(", without_sums, re.I):
+        return None
+    for col in base_columns:
+        if col not in rollup.dims and _column_ref(col).search(without_sums):
+            return None
+
+    protected = _COUNT_STAR.sub("SUM(row_count)", protected)
+    protected = table.sub(f'FROM "{rollup.name}"', protected)
+    return restore_literals(protected, literals)
+
+
+class QueryRouter:
+    """
+    集計クエリをロールアップテーブルへ振り分ける。
+    書き換えたSQLは、初回に元テーブルでの結果と一致することを確認してから使う。
+    """
+
+    def __init__(self, rollups=ROLLUPS):
+        self.rollups = rollups
+        self._verified = {}   # (db, 元SQL) → 書き換え後SQL（不一致なら None）
+        self._retry_at = {}   # (db, 元SQL) → 確認を再試行できる時刻（確認が中断された場合）
+        self._lock = threading.Lock()
+
+    def _available(self, conn):
+        names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        return [r for r in self.rollups if r.name in names and r.base in names]
+
+    def rewrite(self, conn, sql):
+        """振り分け可能なら書き換えたSQLを、不可能なら None を返す（一致確認はしない）。"""
+        if _UNSUPPORTED.search(sql) or not _AGGREGATE.search(sql):
+            return None
+        for rollup in self._available(conn):
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{rollup.base}")')]
+            routed = _rewrite_for(rollup, sql, columns)
+            if routed is not None:
+                return routed
+        return None
+
+    def _verify(self, db_path, sql, routed, cancel_event=None):
+        """
+        別の読み取り専用の接続で両方のSQLを実行し、結果が一致すれば True を返す。
+        呼び出し元のクエリの上限とは別に VERIFY_TIMEOUT で打ち切り、打ち切った・キャンセルされた場合は None。
+        """
+        conn = sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True)
+        started = time.perf_counter()
+
+        def handler():
+            cancelled = cancel_event is not None and cancel_event.is_set()
+            return 1 if cancelled or time.perf_counter() - started > VERIFY_TIMEOUT else 0
+
+        conn.set_progress_handler(handler, PROGRESS_INTERVAL)
+        try:
+            return results_equal(conn.execute(sql).fetchall(), conn.execute(routed).fetchall())
+        except sqlite3.OperationalError as e:
+            if "interrupted" in str(e):
+                return None
+            return False
+        except sqlite3.Error:
+            return False
+        finally:
+            conn.close()
+
+    def route(self, conn, sql, db_path, cancel_event=None):
+        """
+        実行すべきSQLを返す。振り分けできない・結果が一致しない場合は元のSQLを返す。
+        一致確認は呼び出し元の上限（guarded）の外で呼ぶこと。確認が中断された場合は結果を覚えず、
+        VERIFY_RETRY 秒後に再び確認する（それまでは元のSQLで実行する）。
+        """
+        key = (os.path.abspath(db_path), sql)
+        with self._lock:
+            if key in self._verified:
+                return self._verified[key] or sql
+            if time.monotonic() < self._retry_at.get(key, 0):
+                return sql
+        routed = self.rewrite(conn, sql)
+        if routed is not None:
+            equal = self._verify(db_path, sql, routed, cancel_event)
+            if equal is None:
+                with self._lock:
+                    self._retry_at[key] = time.monotonic() + VERIFY_RETRY
+                return sql
+            if not equal:
+                routed = None
+        with self._lock:
+            self._verified[key] = routed
+            self._retry_at.pop(key, None)
+        return routed or sql
+
+
+def _values_equal(a, b):
+    if isinstance(a, float) or isinstance(b, float):
+        if a is None or b is None:
+            return a is b
+        return math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-6)
+    return a == b
+
+
+def results_equal(rows_a, rows_b):
+    """行の順序と浮動小数点の丸め誤差を無視して結果を比較する。"""
+    if len(rows_a) != len(rows_b):
+        return False
+    key = lambda row: tuple((v is None, str(type(v)), v if not isinstance(v, float) else round(v, 4)) for v in row)
+    for row_a, row_b in zip(sorted(rows_a, key=key), sorted(rows_b, key=key)):
+        if len(row_a) != len(row_b) or not all(map(_values_equal, row_a, row_b)):
+            return False
+    return True
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    """プロセス内で共有する QueryRouter を返す。"""
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = QueryRouter()
+        return _router
+
+
+# ==========================================
+# コマンドライン
+# ==========================================
+
+def verify(db_path, workload):
+    """ワークロードの各SQLについて、振り分け結果の一致と速度を確認する。"""
+    router = QueryRouter()
+    report = []
+    with sqlite3.connect(db_path) as conn:
+        for sql, _ in workload:
+            routed = router.rewrite(conn, sql)
+            if routed is None:
+                report.append({"sql": sql, "routed": None})
+                continue
+            equal = results_equal(conn.execute(sql).fetchall(), conn.execute(routed).fetchall())
+            report.append({
+                "sql": sql,
+                "routed": routed,
+                "equal": equal,
+                "base_ms": round(time_query(conn, sql), 3),
+                "rollup_ms": round(time_query(conn, routed), 3),
+            })
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="集計済みテーブルの作成と振り分けの確認")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("write-migration")
+    p.add_argument("db_path")
+    p = sub.add_parser("verify")
+    p.add_argument("db_path")
+    p.add_argument("--workload-file", help="SQLファイル（既定は migrations/<db>/workload_sample.sql）")
+    args = parser.parse_args(argv)
+
+    if args.command == "write-migration":
+        statements = [s for rollup in ROLLUPS for s in rollup.ddl()]
+        print("保存しました: " + write_migration(args.db_path, statements, "rollups", "rollups.py"))
+        return 0
+
+    workload_file = args.workload_file or os.path.join(migrations_dir(args.db_path), "workload_sample.sql")
+    ok = True
+    for item in verify(args.db_path, load_workload(args.db_path, workload_file)):
+        if item["routed"] is None:
+            print(f"[対象外] {item['sql']}")
+            continue
+        ok = ok and item["equal"]
+        status = "一致" if item["equal"] else "不一致"
+        print(f"[{status}] {item['base_ms']}ms → {item['rollup_ms']}ms  {item['routed']}")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
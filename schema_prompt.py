@@ -0,0 +1,412 @@
+# スキーマプロンプトの自動生成と絞り込み
+# これまで各ページは全テーブルの CREATE TABLE をプロンプトに直書きしていたため、
+# 「AC/DCのアルバム」のように Artist と Album しか使わない質問でも全テーブル分の入力トークンを払っていた。
+# sqlite_master / PRAGMA table_info / PRAGMA foreign_key_list からテーブル定義を生成し（DBの版ごとにキャッシュ）、
+# 質問ごとに関連するテーブルと、それらを結合するのに必要なテーブルだけをプロンプトに入れる。
+#
+# 使い方:
+#   python schema_prompt.py report Chinook.db          # 質問例ごとのトークン数（全体 / 絞り込み後）
+#   python schema_prompt.py report Chinook.db --live   # OpenAI API で SQL 生成（Phase 1）の時間も比較
+import argparse
+import os
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+import unicodedata
+from collections import deque
+
+from result_cache import get_result_cache
+from result_compact import approx_tokens
+
+# 1つの質問でプロンプトに入れるテーブル数の上限（結合に必要なテーブルは別に追加される）
+MAX_TABLES = int(os.environ.get("SCHEMA_MAX_TABLES", "6"))
+
+# 絞り込みを無効にする（SCHEMA_PRUNING=0 で常に全テーブルを入れる）
+PRUNING_ENABLED = os.environ.get("SCHEMA_PRUNING", "1") != "0"
+
+# プロンプトに入れない管理用のテーブル
+INTERNAL_TABLES = {"schema_migrations", "ingest_state"}
+
+# ==========================================
+# DBごとの設定（日本語の質問とテーブルを結びつけるキーワード・列の説明・質問例）
+# ==========================================
+
+CHINOOK_KEYWORDS = {
+    "Album": ["アルバム"],
+    "Artist": ["アーティスト", "歌手", "バンド"],
+    "Customer": ["顧客", "お客", "購入者"],
+    "Employee": ["従業員", "社員", "担当", "スタッフ", "上司"],
+    "Genre": ["ジャンル"],
+    "Invoice": ["請求", "売上", "注文", "購入"],
+    "InvoiceLine": ["売上", "売れ", "販売", "購入された"],
+    "MediaType": ["メディア", "形式", "フォーマット"],
+    "Playlist": ["プレイリスト"],
+    "PlaylistTrack": ["プレイリスト"],
+    "Track": ["曲", "楽曲", "トラック", "再生時間", "作曲"],
+}
+
+MARKETING_KEYWORDS = {
+    "AdPerformance": [
+        "広告", "媒体", "表示", "インプレッション", "クリック", "コンバージョン", "cv",
+        "費用", "コスト", "cpa", "cpc", "ctr", "google", "yahoo", "アカウント",
+    ],
+    "CustomerAcquisition": [
+        "顧客", "獲得", "新規", "リード", "予約", "受任", "成約", "utm", "流入", "キャンペーン", "ソース",
+    ],
+}
+
+MARKETING_NOTES = {
+    "AdPerformance": {
+        "date": "日付 (YYYY-MM-DD)",
+        "media_type": "媒体 (Google, Yahooなど)",
+        "account_type": "アカウント/ブランド名",
+        "impressions": "表示回数",
+        "clicks": "クリック数",
+        "conversions": "コンバージョン(獲得)数",
+        "cost": "費用(コスト)",
+        "month": "月",
+        "year": "年",
+    },
+    "CustomerAcquisition": {
+        "date": "日付 (YYYY-MM-DD)",
+        "utm_medium": "媒体 (cpc, organic, snsなど)",
+        "utm_source": "ソース (google, yahoo, instagramなど)",
+        "utm_campaign": "キャンペーン名（campaignA, campaignBなど）",
+        "y_new": "新規リード数",
+        "y_yoyaku": "予約数",
+        "y_junin": "受任(成約)数",
+    },
+}
+
+PROFILES = {
+    "Chinook.db": {
+        "keywords": CHINOOK_KEYWORDS,
+        "notes": {},
+        "examples": [
+            "AC/DCのアルバムを全て教えて",
+            "一番売上が高いジャンルは何ですか？",
+            "ブラジルの顧客リストを表示して",
+            "プレイリストごとの曲数を教えて",
+            "担当者別の顧客数は？",
+        ],
+    },
+    "marketing.db": {
+        "keywords": MARKETING_KEYWORDS,
+        "notes": MARKETING_NOTES,
+        "examples": [
+            "先月の媒体別CPAを教えて",
+            "今月の新規リード数を流入元別に教えて",
+            "Googleのクリック数の推移",
+            "キャンペーン別の予約数と受任数",
+        ],
+    },
+}
+
+
+def _normalize(text):
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+# ==========================================
+# スキーマの取得と CREATE TABLE 文の生成
+# ==========================================
+
+def introspect(conn, exclude=()):
+    """DB内のテーブルの列・主キー・外部キーを返す（テーブル名 → 情報）。"""
+    tables = {}
+    names = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    ).fetchall()
+    for (name,) in names:
+        if name in INTERNAL_TABLES or name in exclude:
+            continue
+        columns = conn.execute(f"PRAGMA table_info({_quote(name)})").fetchall()
+        foreign_keys = conn.execute(f"PRAGMA foreign_key_list({_quote(name)})").fetchall()
+        tables[name] = {
+            # (列名, 型, NOT NULL)
+            "columns": [(col[1], col[2], bool(col[3])) for col in columns],
+            "primary_key": [col[1] for col in sorted(columns, key=lambda c: c[5]) if col[5]],
+            # (列名, 参照先テーブル, 参照先の列名)
+            "foreign_keys": [(fk[3], fk[2], fk[4]) for fk in foreign_keys],
+        }
+    return tables
+
+
+def render_table(name, info, notes=None):
+    """テーブル1つ分の CREATE TABLE 文を作る。notes があれば列の説明をコメントで付ける。"""
+    notes = notes or {}
+    lines = []
+    for column, col_type, not_null in info["columns"]:
+        line = f"    {_quote(column)} {col_type or ''}".rstrip() + (" NOT NULL" if not_null else "")
+        lines.append([line, notes.get(column)])
+    if info["primary_key"]:
+        lines.append([f"    PRIMARY KEY ({', '.join(_quote(c) for c in info['primary_key'])})", None])
+    for column, ref_table, ref_column in info["foreign_keys"]:
+        lines.append([f"    FOREIGN KEY({_quote(column)}) REFERENCES {_quote(ref_table)} ({_quote(ref_column or column)})", None])
+    body = []
+    for i, (line, note) in enumerate(lines):
+        line += "," if i < len(lines) - 1 else ""
+        body.append(f"{line}  -- {note}" if note else line)
+    return f"CREATE TABLE {_quote(name)} (\n" + "\n".join(body) + "\n);"
+
+
+# ==========================================
+# 関連テーブルの選択
+# ==========================================
+
+def rank_tables(question, tables, keywords=None, notes=None):
+    """
+    質問との関連度でテーブルを並べる（外部APIは使わないキーワード一致のスコア）。
+    - キーワード（日本語の言い換え）またはテーブル名が含まれる: +3
+    - 列名・列の説明が含まれる: +1
+    戻り値: [(スコア, テーブル名)]（スコア 0 のテーブルは含まない）
+    """
+    keywords = keywords or {}
+    notes = notes or {}
+    text = _normalize(question)
+    ranked = []
+    for name, info in tables.items():
+        score = 0
+        if _normalize(name) in text or any(_normalize(kw) in text for kw in keywords.get(name, ())):
+            score += 3
+        table_notes = notes.get(name, {})
+        for column, _, _ in info["columns"]:
+            if len(column) >= 3 and _normalize(column) in text:
+                score += 1
+            note = table_notes.get(column)
+            if note and _normalize(note).split(" ")[0].split("(")[0] in text:
+                score += 1
+        if score:
+            ranked.append((score, name))
+    ranked.sort(key=lambda item: (-item[0], item[1]))
+    return ranked
+
+
+def _fk_graph(tables):
+    graph = {name: set() for name in tables}
+    for name, info in tables.items():
+        for _, ref_table, _ in info["foreign_keys"]:
+            if ref_table in graph and ref_table != name:
+                graph[name].add(ref_table)
+                graph[ref_table].add(name)
+    return graph
+
+
+def _shortest_path(graph, start, goal):
+    previous = {start: None}
+    queue = deque([start])
+    while queue:
+        node = queue.popleft()
+        if node == goal:
+            path = []
+            while node is not None:
+                path.append(node)
+                node = previous[node]
+            return path
+        for neighbor in sorted(graph[node]):
+            if neighbor not in previous:
+                previous[neighbor] = node
+                queue.append(neighbor)
+    return []
+
+
+def join_closure(selected, tables):
+    """
+    外部キーでたどれるテーブルを追加する。
+    - 選ばれたテーブルが参照する親テーブルと、さらにその親（「AC/DCの曲」の Track → Album → Artist のように、
+      親の親の名前で絞り込むことが多い）。追加するものが無くなるまでたどる
+    - 選ばれたテーブル同士をつなぐ最短経路上のテーブル
+    """
+    graph = _fk_graph(tables)
+    result = list(selected)
+    pending = list(selected)
+    while pending:
+        name = pending.pop(0)
+        for _, ref_table, _ in tables[name]["foreign_keys"]:
+            if ref_table in tables and ref_table not in result:
+                result.append(ref_table)
+                pending.append(ref_table)
+    for i, start in enumerate(selected):
+        for goal in selected[i + 1:]:
+            for name in _shortest_path(graph, start, goal):
+                if name not in result:
+                    result.append(name)
+    return result
+
+
+# ==========================================
+# プロンプトの生成
+# ==========================================
+
+class SchemaSelection:
+    """1つの質問に対して作ったスキーマプロンプトと、その内訳。"""
+
+    def __init__(self, prompt, tables, all_tables, tokens, full_tokens, elapsed):
+        self.prompt = prompt
+        self.tables = tables
+        self.all_tables = all_tables
+        self.tokens = tokens
+        self.full_tokens = full_tokens
+        self.elapsed = elapsed
+
+    @property
+    def pruned(self):
+        return len(self.tables) < len(self.all_tables)
+
+
+class SchemaPrompter:
+    """
+    DBのスキーマからプロンプトを作る。
+    header / footer はテーブル定義の前後に入れる指示文。
+    テーブル定義はDBの版（result_cache.db_version）ごとにキャッシュし、DBが変更されたら作り直す。
+    """
+
+    def __init__(self, db_path, header, footer, keywords=None, notes=None, exclude=(),
+                 max_tables=MAX_TABLES, pruning=PRUNING_ENABLED):
+        self.db_path = db_path
+        self.header = header.strip()
+        self.footer = footer.strip()
+        self.keywords = keywords or {}
+        self.notes = notes or {}
+        self.exclude = set(exclude)
+        self.max_tables = max_tables
+        self.pruning = pruning
+        self._lock = threading.Lock()
+        self._version = None
+        self._tables = {}
+        self._rendered = {}
+        self._full_prompt = ""
+        self._full_tokens = 0
+
+    def _load(self):
+        version = get_result_cache().db_version(self.db_path)
+        with self._lock:
+            if version != self._version:
+                # 読み取り専用で開く（ファイルが無い場合に空のDBを作らない）
+                conn = sqlite3.connect(f"file:{os.path.abspath(self.db_path)}?mode=ro", uri=True)
+                try:
+                    tables = introspect(conn, self.exclude)
+                finally:
+                    conn.close()
+                self._tables = tables
+                self._rendered = {name: render_table(name, info, self.notes.get(name)) for name, info in tables.items()}
+                self._full_prompt = self._compose(list(tables))
+                self._full_tokens = approx_tokens(self._full_prompt)
+                self._version = version
+            return self._tables, self._full_prompt, self._full_tokens
+
+    def _compose(self, names):
+        rendered = "\n\n".join(self._rendered[name] for name in names)
+        return f"{self.header}\n\n{rendered}\n\n{self.footer}"
+
+    def full_prompt(self):
+        return self._load()[1]
+
+    def select(self, question):
+        """質問に関連するテーブルだけを入れたプロンプトを返す（関連テーブルが見つからなければ全テーブル）。"""
+        started = time.perf_counter()
+        tables, full_prompt, full_tokens = self._load()
+        names = list(tables)
+        if self.pruning:
+            ranked = rank_tables(question, tables, self.keywords, self.notes)
+            if ranked:
+                selected = join_closure([name for _, name in ranked[:self.max_tables]], tables)
+                # 元の順序（テーブル名順）で並べ、質問が違っても同じテーブルなら同じプロンプトになるようにする
+                names = [name for name in tables if name in selected]
+        if len(names) == len(tables):
+            prompt, tokens = full_prompt, full_tokens
+        else:
+            prompt = self._compose(names)
+            tokens = approx_tokens(prompt)
+        return SchemaSelection(prompt, names, list(tables), tokens, full_tokens, time.perf_counter() - started)
+
+
+_prompters = {}
+_prompters_lock = threading.Lock()
+
+
+def get_prompter(db_path, header, footer, **kwargs):
+    """DBごとに共有する SchemaPrompter を返す（設定は DB の PROFILES を既定値にする）。"""
+    key = os.path.abspath(db_path)
+    with _prompters_lock:
+        if key not in _prompters:
+            profile = PROFILES.get(os.path.basename(db_path), {})
+            kwargs.setdefault("keywords", profile.get("keywords"))
+            kwargs.setdefault("notes", profile.get("notes"))
+            _prompters[key] = SchemaPrompter(db_path, header, footer, **kwargs)
+        return _prompters[key]
+
+
+# ==========================================
+# 計測
+# ==========================================
+
+def _time_generation(client, system_prompt, question, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        client.chat.completions.create(
+            model="gpt-4o",
+            messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": question}],
+        )
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def report(db_path, questions=None, client=None, repeat=3):
+    """
+    質問ごとに、全テーブル / 絞り込み後 のスキーマのトークン数を返す。
+    client を渡すと SQL 生成（Phase 1）の時間（秒の中央値）も両方で計測する。
+    """
+    profile = PROFILES.get(os.path.basename(db_path), {})
+    prompter = SchemaPrompter(db_path, "", "", profile.get("keywords"), profile.get("notes"))
+    rows = []
+    for question in questions or profile.get("examples", []):
+        selection = prompter.select(question)
+        row = {
+            "question": question,
+            "tables": selection.tables,
+            "full_tokens": selection.full_tokens,
+            "pruned_tokens": selection.tokens,
+            "select_ms": round(selection.elapsed * 1000, 3),
+        }
+        if client is not None:
+            row["full_sec"] = round(_time_generation(client, prompter.full_prompt(), question, repeat), 3)
+            row["pruned_sec"] = round(_time_generation(client, selection.prompt, question, repeat), 3)
+        rows.append(row)
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="スキーマプロンプトの絞り込みの効果を確認する")
+    parser.add_argument("command", choices=["report"])
+    parser.add_argument("db")
+    parser.add_argument("--question", action="append", help="質問（省略時は質問例）")
+    parser.add_argument("--live", action="store_true", help="OpenAI API で SQL 生成の時間も計測する")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    client = None
+    if args.live:
+        from openai import OpenAI
+        client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+
+    for row in report(args.db, args.question, client, args.repeat):
+        line = (
+            f"{row['question']}: {row['full_tokens']} → {row['pruned_tokens']} トークン"
+            f" [{', '.join(row['tables'])}] (選択 {row['select_ms']}ms)"
+        )
+        if "full_sec" in row:
+            line += f" / SQL生成 {row['full_sec']}秒 → {row['pruned_sec']}秒"
+        print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
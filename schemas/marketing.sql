@@ -0,0 +1,21 @@
+-- generated by bulk_load.py from marketing.db (2026-10-18)
+CREATE TABLE "AdPerformance" (
+"date" TEXT,
+  "media_type" TEXT,
+  "account_type" TEXT,
+  "impressions" INTEGER,
+  "clicks" INTEGER,
+  "conversions" INTEGER,
+  "cost" REAL,
+  "month" INTEGER,
+  "year" INTEGER
+);
+CREATE TABLE "CustomerAcquisition" (
+"date" TEXT,
+  "utm_medium" TEXT,
+  "utm_source" TEXT,
+  "utm_campaign" TEXT,
+  "y_new" INTEGER,
+  "y_yoyaku" INTEGER,
+  "y_junin" INTEGER
+);
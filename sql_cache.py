@@ -0,0 +1,147 @@
+# 質問→SQL キャッシュ
+# 同じ（または表記ゆれ程度の）質問に対して gpt-4o へSQL生成を依頼し直さないよう、
+# 生成済みSQLをローカルのSQLiteファイルに保存する。
+import hashlib
+import os
+import sqlite3
+import re
+import threading
+import time
+import unicodedata
+
+from db_pool import get_pool
+
+CACHE_DB_PATH = os.environ.get("SQL_CACHE_PATH", os.path.join(".cache", "llm_cache.db"))
+MAX_ENTRIES = int(os.environ.get("SQL_CACHE_MAX_ENTRIES", "2000"))
+TTL_SECONDS = int(os.environ.get("SQL_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# 末尾の句読点・記号は意味を変えないため正規化時に除去する
+_TRAILING_PUNCT = re.compile(r"[\s。．.、,！!？?]+$")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_question(question):
+    """全角/半角・大文字/小文字・空白・末尾の句読点の違いを吸収した文字列を返す。"""
+    text = unicodedata.normalize("NFKC", question).lower().strip()
+    text = _SPACES.sub(" ", text)
+    return _TRAILING_PUNCT.sub("", text)
+
+
+def schema_hash(schema_prompt):
+    return hashlib.sha256(schema_prompt.encode("utf-8")).hexdigest()[:16]
+
+
+class SqlCache:
+    """
+    正規化した質問をキーに生成済みSQLを保存するキャッシュ。
+    - TTLを過ぎたエントリはミス扱いにして削除する
+    - 件数が max_entries を超えたら最終利用日時の古いものから削除する（LRU）
+    """
+
+    def __init__(self, path=CACHE_DB_PATH, max_entries=MAX_ENTRIES, ttl=TTL_SECONDS):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._pool = get_pool(path, pragmas={"journal_mode": "WAL", "synchronous": "NORMAL"})
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self._pool.connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sql_cache (
+                    key TEXT PRIMARY KEY,
+                    question TEXT NOT NULL,
+                    sql TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    hit_count INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sql_cache_last_used ON sql_cache (last_used)")
+
+    def make_key(self, question, schema_prompt, *extra):
+        """
+        キャッシュキーを作る。スキーマプロンプトのハッシュを含めるため、
+        スキーマを変更すると古いエントリは参照されなくなる。
+        extra にはDB名や基準日など、同じ質問でもSQLが変わる要素を渡す。
+        """
+        parts = [schema_hash(schema_prompt), *map(str, extra), normalize_question(question)]
+        return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        キャッシュ済みのSQLを返す（無ければ None）。
+        キャッシュのDBが使えない場合（他のセッションの書き込みで "database is locked" など）もミスとして扱う。
+        """
+        now = time.time()
+        row = None
+        try:
+            with self._pool.connection() as conn:
+                row = conn.execute(
+                    "SELECT sql, created_at FROM sql_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[1] > self.ttl:
+                    conn.execute("DELETE FROM sql_cache WHERE key = ?", (key,))
+                    row = None
+                if row is not None:
+                    conn.execute(
+                        "UPDATE sql_cache SET last_used = ?, hit_count = hit_count + 1 WHERE key = ?",
+                        (now, key),
+                    )
+        except sqlite3.Error:
+            row = None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if row is None else row[0]
+
+    def put(self, key, question, sql):
+        """SQLを保存する（保存に失敗しても呼び出し元のターンは止めない）。"""
+        now = time.time()
+        try:
+            with self._pool.connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO sql_cache (key, question, sql, created_at, last_used) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, question, sql, now, now),
+                )
+                count = conn.execute("SELECT COUNT(*) FROM sql_cache").fetchone()[0]
+                if count > self.max_entries:
+                    conn.execute(
+                        "DELETE FROM sql_cache WHERE key IN "
+                        "(SELECT key FROM sql_cache ORDER BY last_used LIMIT ?)",
+                        (count - self.max_entries,),
+                    )
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        with self._pool.connection() as conn:
+            conn.execute("DELETE FROM sql_cache")
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_sql_cache():
+    """プロセス内で共有する SqlCache を返す（初回呼び出し時に作成）。"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = SqlCache()
+        return _cache
@@ -0,0 +1,275 @@
+# SQL候補の並列生成と自己修復
+# Phase 1 で生成したSQLが実行できないと、これまではユーザーに「SQL実行エラー」を見せて終わっていた。
+# 複数の候補SQLを並列に生成し、読み取り専用の接続で並列に実行して最初に成功した結果を採用する。
+# 失敗した候補は SQLite のエラーメッセージを LLM に渡して修正させる（回数に上限あり）。
+#
+# 使い方:
+#   python sql_candidates.py bench                     # 擬似LLM（一定の確率で誤ったSQLを返す）で従来方式と比較
+#   python sql_candidates.py bench --live              # OpenAI API で比較（OPENAI_API_KEY が必要）
+import argparse
+import os
+import random
+import re
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from db_pool import get_readonly_pool
+from query_guard import QueryBudget, QueryBudgetExceeded, guarded
+
+# 候補数・同時実行数・修正回数・全体の制限時間（秒）
+CANDIDATES = int(os.environ.get("SQL_CANDIDATES", "3"))
+CONCURRENCY = int(os.environ.get("SQL_CANDIDATE_CONCURRENCY", "3"))
+REPAIR_ROUNDS = int(os.environ.get("SQL_REPAIR_ROUNDS", "2"))
+BUDGET_SECONDS = float(os.environ.get("SQL_GENERATION_BUDGET", "30"))
+
+# ページで並列生成を既定で有効にする（SQL_PARALLEL_GENERATION=1）
+PARALLEL_ENABLED = os.environ.get("SQL_PARALLEL_GENERATION", "0") == "1"
+
+# 1つ目の候補は決定的に、2つ目以降は多様な候補が出るように温度を上げる
+CANDIDATE_TEMPERATURES = [0.0, 0.7, 1.0]
+
+REPAIR_PROMPT = (
+    "上のSQLを実行したところ、次のエラーになりました。\n{error}\n"
+    "エラーを修正したSQLiteのSQL（SELECT文）のみを返してください。説明やコードブロックは不要です。"
+)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+
+def clean_sql(text):
+    """LLMの応答から Markdown の装飾を除去する。"""
+    return (text or "").replace("```sql", "").replace("```", "").strip()
+
+
+def validate_sql(sql):
+    """1文の SELECT（WITH を含む）であることを確認する。問題があれば ValueError。"""
+    body = _STRING_LITERAL.sub("''", sql).strip().rstrip(";").strip()
+    if not body:
+        raise ValueError("SQLが空です。")
+    if ";" in body:
+        raise ValueError("複数のSQL文が含まれています。1つのSELECT文にしてください。")
+    if not re.match(r"(?is)^(select|with)\b", body):
+        raise ValueError("SELECT文ではありません。")
+
+
+class CandidateResult:
+    """採用した候補SQLと、その実行結果・全候補の試行記録。"""
+
+    def __init__(self, sql, value, attempts, elapsed):
+        self.sql = sql
+        self.value = value
+        self.attempts = attempts
+        self.elapsed = elapsed
+
+    @property
+    def winner(self):
+        return next(attempt for attempt in self.attempts if attempt["ok"])
+
+
+class CandidateGenerationFailed(Exception):
+    """すべての候補が失敗した（または制限時間を超えた）ことを表す。"""
+
+    def __init__(self, attempts, reason="すべての候補SQLの実行に失敗しました。"):
+        self.attempts = attempts
+        self.reason = reason
+        last_error = next((a["error"] for a in reversed(attempts) if a.get("error")), None)
+        super().__init__(reason + (f"（最後のエラー: {last_error}）" if last_error else ""))
+
+
+def generate_and_execute(client, messages, execute, model="gpt-4o", candidates=CANDIDATES,
+                         concurrency=CONCURRENCY, repair_rounds=REPAIR_ROUNDS,
+                         budget=BUDGET_SECONDS, cancel_event=None):
+    """
+    messages（SQL生成用のプロンプト）から candidates 個の候補を並列に生成・実行し、最初に成功した結果を返す。
+    execute(sql, stop_event) はSQLを実行して結果を返す関数。stop_event がセットされたら中断すること
+    （query_guard.guarded に渡せばよい）。sqlite3.Error / ValueError / QueryBudgetExceeded は修正対象の失敗として扱う。
+    """
+    started = time.perf_counter()
+    deadline = started + budget
+    stop = threading.Event()
+    attempts = []
+    attempts_lock = threading.Lock()
+
+    def record(**attempt):
+        with attempts_lock:
+            attempts.append(attempt)
+
+    def chain(index):
+        history = list(messages)
+        temperature = CANDIDATE_TEMPERATURES[min(index, len(CANDIDATE_TEMPERATURES) - 1)]
+        for round_ in range(repair_rounds + 1):
+            if stop.is_set() or time.perf_counter() > deadline:
+                return None
+            generation_started = time.perf_counter()
+            response = client.chat.completions.create(model=model, messages=history, temperature=temperature)
+            sql = clean_sql(response.choices[0].message.content)
+            usage = getattr(response, "usage", None)
+            tokens = {
+                "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+                "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+            }
+            execution_started = time.perf_counter()
+            try:
+                validate_sql(sql)
+                value = execute(sql, stop)
+            except (sqlite3.Error, ValueError, QueryBudgetExceeded) as e:
+                if stop.is_set():
+                    return None
+                record(candidate=index, round=round_, sql=sql, ok=False, error=str(e),
+                       generate_ms=(execution_started - generation_started) * 1000,
+                       execute_ms=(time.perf_counter() - execution_started) * 1000, **tokens)
+                history = history + [
+                    {"role": "assistant", "content": sql},
+                    {"role": "user", "content": REPAIR_PROMPT.format(error=e)},
+                ]
+                continue
+            record(candidate=index, round=round_, sql=sql, ok=True, error=None,
+                   generate_ms=(execution_started - generation_started) * 1000,
+                   execute_ms=(time.perf_counter() - execution_started) * 1000, **tokens)
+            return sql, value
+        return None
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(concurrency, candidates)), thread_name_prefix="sql-candidate")
+    pending = {executor.submit(chain, i) for i in range(candidates)}
+    try:
+        while pending:
+            if cancel_event is not None and cancel_event.is_set():
+                raise CandidateGenerationFailed(attempts, "キャンセルされました。")
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise CandidateGenerationFailed(attempts, "制限時間内に実行できるSQLを生成できませんでした。")
+            done, pending = wait(pending, timeout=min(0.1, remaining), return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    # LLM呼び出しの失敗などは、その候補だけの失敗とする
+                    record(candidate=None, round=None, sql=None, ok=False, error=str(e), generate_ms=0, execute_ms=0)
+                    continue
+                if outcome is not None:
+                    sql, value = outcome
+                    return CandidateResult(sql, value, list(attempts), time.perf_counter() - started)
+        raise CandidateGenerationFailed(attempts)
+    finally:
+        # 残りの候補は stop で中断させ、完了を待たずに戻る
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# ==========================================
+# 従来方式（1回生成・修正なし）との比較
+# ==========================================
+
+BENCH_HEADER = """
+あなたは経験豊富なデータアナリストです。
+以下のテーブル定義を参考にして、ユーザーの質問に対するSQLを生成してください。
+"""
+
+BENCH_RULES = """
+SQLiteのSQLクエリ（SELECT文）のみを返してください。説明やコードブロックは不要です。
+"""
+
+
+def _fake_client(corpus, error_rate, latency, seed):
+    """一定の確率で存在しない列を含むSQLを返し、エラーを伝えられると正しいSQLを返す擬似LLM。"""
+    from fake_llm import FakeLLM
+
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    def respond(messages):
+        question = next(m["content"] for m in messages if m["role"] == "user")
+        correct = corpus.get(question, "SELECT 1")
+        if len(messages) > 2 and messages[-1]["role"] == "user":
+            return correct
+        with lock:
+            broken = rng.random() < error_rate
+        return correct.replace("SELECT", "SELECT missing_column,", 1) if broken else correct
+
+    return FakeLLM(default=respond, latency=latency)
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def bench(db_path="Chinook.db", client=None, error_rate=0.3, latency=0.3, rounds=3, seed=0):
+    """
+    質問例（parquet_backend.PARITY_QUERIES）ごとに、従来方式と並列生成＋修正の成功率と所要時間を比較する。
+    client を省略すると擬似LLMを使う。
+    """
+    from parquet_backend import PARITY_QUERIES
+    from schema_prompt import get_prompter
+
+    prompter = get_prompter(db_path, BENCH_HEADER, BENCH_RULES)
+    client = client or _fake_client(PARITY_QUERIES, error_rate, latency, seed)
+    budget = QueryBudget(timeout=10.0)
+
+    def execute(sql, stop):
+        with get_readonly_pool(db_path).connection() as conn:
+            with guarded(conn, budget, stop):
+                return conn.execute(sql).fetchall()
+
+    modes = {
+        "single": {"candidates": 1, "repair_rounds": 0},
+        "parallel": {"candidates": CANDIDATES, "repair_rounds": REPAIR_ROUNDS},
+    }
+    report = {}
+    for mode, options in modes.items():
+        timings, successes, calls = [], 0, 0
+        for _ in range(rounds):
+            for question in PARITY_QUERIES:
+                messages = [
+                    {"role": "system", "content": prompter.select(question).prompt},
+                    {"role": "user", "content": question},
+                ]
+                started = time.perf_counter()
+                try:
+                    result = generate_and_execute(client, messages, execute, **options)
+                    successes += 1
+                    calls += len(result.attempts)
+                except CandidateGenerationFailed as e:
+                    calls += len(e.attempts)
+                timings.append(time.perf_counter() - started)
+        report[mode] = {
+            "success_rate": successes / len(timings),
+            "p50_sec": round(_percentile(timings, 0.5), 3),
+            "p95_sec": round(_percentile(timings, 0.95), 3),
+            "mean_sec": round(statistics.mean(timings), 3),
+            "recorded_attempts": calls,
+        }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SQL候補の並列生成と従来方式の比較")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--db", default="Chinook.db")
+    parser.add_argument("--live", action="store_true", help="OpenAI API を使う")
+    parser.add_argument("--error-rate", type=float, default=0.3, help="擬似LLMが誤ったSQLを返す確率")
+    parser.add_argument("--latency", type=float, default=0.3, help="擬似LLMの1回あたりの遅延（秒）")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    client = None
+    if args.live:
+        from openai import OpenAI
+        client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+
+    report = bench(args.db, client, args.error_rate, args.latency, args.rounds)
+    for mode, label in (("single", "従来（1回生成）"), ("parallel", f"並列{CANDIDATES}候補＋修正{REPAIR_ROUNDS}回")):
+        item = report[mode]
+        print(
+            f"{label}: 成功率 {item['success_rate']:.0%} / p50 {item['p50_sec']}秒 / p95 {item['p95_sec']}秒"
+            f" / 平均 {item['mean_sec']}秒 / 記録した試行 {item['recorded_attempts']}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+# 画面の初回表示（コールドスタート）と再実行（rerun）の時間の計測
+# Streamlit は操作のたびにページのスクリプトを最初から実行し直す。ページごとに、新しいプロセスで
+#   - ページが import するモジュールの import 時間（python -X importtime の累積時間）
+#   - 1回目の実行時間（import を含む）と、2回目以降の再実行時間（streamlit.testing の AppTest で実行）
+#   - 1回目の実行後に読み込まれていた重いパッケージ（openai / pandas / azure など）
+# を計測する。--baseline で指定した git のリビジョン（例: HEAD~1）でも同じ計測を行い、差を表示する。
+#
+# 使い方:
+#   python startup_profile.py                          # 全ページを計測して .cache/startup_profile.json に保存
+#   python startup_profile.py --baseline HEAD~1        # 1つ前のコミットと比較する
+#   python startup_profile.py --pages main.py pages/txt2sql.py --reruns 20
+import argparse
+import ast
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+PAGES = ["main.py", "pages/txt2sql.py", "pages/mark_db.py", "pages/sql_runner.py"]
+
+# 1回目の実行後に読み込まれているかを確認するパッケージ
+HEAVY_MODULES = ["openai", "httpx", "pandas", "numpy", "azure.search.documents", "azure.core", "duckdb", "pyarrow"]
+
+REPORT_PATH = os.path.join(".cache", "startup_profile.json")
+
+# AppTest でページを実行する子プロセス（引数: ページのパス, 再実行の回数, 重いパッケージの JSON）
+_RUN_PAGE = r"""
+import json, sys, time
+page, reruns, heavy = sys.argv[1], int(sys.argv[2]), json.loads(sys.argv[3])
+from streamlit.testing.v1 import AppTest
+
+app = AppTest.from_file(page, default_timeout=60)
+# APIキーが無いと st.stop() で止まるため、ダミーのキーを入れる（API は呼ばない）
+app.secrets["OPENAI_API_KEY"] = "startup-profile"
+started = time.perf_counter()
+app.run()
+first = time.perf_counter() - started
+loaded = [name for name in heavy if name in sys.modules]
+reruns_ms = []
+for _ in range(reruns):
+    started = time.perf_counter()
+    app.run()
+    reruns_ms.append((time.perf_counter() - started) * 1000)
+print(json.dumps({
+    "first_run_ms": first * 1000,
+    "rerun_ms": reruns_ms,
+    "heavy_loaded": loaded,
+    "exceptions": [str(e.value) for e in app.exception],
+}))
+"""
+
+# ページが import するモジュールを1つずつ import する子プロセス（-X importtime で計測する）
+_IMPORT_MODULES = r"""
+import importlib, sys
+for name in sys.argv[1].split(","):
+    try:
+        importlib.import_module(name)
+    except Exception:
+        pass
+"""
+
+
+def page_imports(path):
+    """ページの先頭（モジュールのトップレベル）で import しているモジュール名。"""
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    names = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.append(node.module)
+    return list(dict.fromkeys(names))
+
+
+def parse_importtime(stderr):
+    """-X importtime の出力から、トップレベルで import したモジュールの累積時間（ミリ秒）を返す。"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        # 入れ子の import は名前の前に空白が入る
+        if name.startswith("  "):
+            continue
+        modules[name.strip()] = int(parts[1]) / 1000
+    return modules
+
+
+def profile_page(root, page, reruns):
+    path = os.path.join(root, page)
+    result = {"page": page}
+    if not os.path.exists(path):
+        result["error"] = "ページが存在しません"
+        return result
+
+    imports = page_imports(path)
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _IMPORT_MODULES, ",".join(imports)],
+        cwd=root, capture_output=True, text=True,
+    )
+    # インタープリターの起動時に読み込まれるモジュール（site など）は除く
+    roots = {name.split(".")[0] for name in imports}
+    modules = {name: ms for name, ms in parse_importtime(completed.stderr).items() if name.split(".")[0] in roots}
+    result["import_ms"] = round(sum(modules.values()), 1)
+    result["slowest_imports"] = {
+        name: round(ms, 1) for name, ms in sorted(modules.items(), key=lambda item: -item[1])[:8]
+    }
+
+    completed = subprocess.run(
+        [sys.executable, "-c", _RUN_PAGE, os.path.abspath(path), str(reruns), json.dumps(HEAVY_MODULES)],
+        cwd=root, capture_output=True, text=True,
+    )
+    if completed.returncode != 0:
+        result["error"] = (completed.stderr.strip().splitlines() or ["実行に失敗しました"])[-1]
+        return result
+    run = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["first_run_ms"] = round(run["first_run_ms"], 1)
+    if run["rerun_ms"]:
+        result["rerun_p50_ms"] = round(statistics.median(run["rerun_ms"]), 2)
+        result["rerun_max_ms"] = round(max(run["rerun_ms"]), 2)
+    result["heavy_loaded"] = run["heavy_loaded"]
+    if run["exceptions"]:
+        result["exceptions"] = run["exceptions"]
+    return result
+
+
+def profile(root=".", pages=PAGES, reruns=10):
+    return {page: profile_page(root, page, reruns) for page in pages}
+
+
+def profile_revision(revision, pages=PAGES, reruns=10):
+    """git のリビジョンを一時的な worktree に取り出して計測する。"""
+    with tempfile.TemporaryDirectory(prefix="startup-profile-") as directory:
+        worktree = os.path.join(directory, "tree")
+        subprocess.run(["git", "worktree", "add", "--detach", worktree, revision], check=True, capture_output=True)
+        try:
+            return profile(worktree, pages, reruns)
+        finally:
+            subprocess.run(["git", "worktree", "remove", "--force", worktree], capture_output=True)
+
+
+def _format(value, unit="ms"):
+    return "-" if value is None else f"{value:.1f}{unit}"
+
+
+def print_report(report, baseline=None):
+    for page, item in report.items():
+        print(f"== {page}")
+        if "error" in item:
+            print(f"  計測できませんでした: {item['error']}")
+        before = (baseline or {}).get(page, {})
+        for key, label in (("import_ms", "import"), ("first_run_ms", "1回目の実行"), ("rerun_p50_ms", "再実行 p50")):
+            if key not in item and key not in before:
+                continue
+            line = f"  {label:<10} {_format(item.get(key))}"
+            if baseline is not None and item.get(key) is not None and before.get(key):
+                line += f"（変更前 {_format(before[key])}, {item[key] / before[key] - 1:+.0%}）"
+            print(line)
+        if "heavy_loaded" in item:
+            loaded = ", ".join(item["heavy_loaded"]) or "なし"
+            print(f"  1回目の実行後に読み込み済みの重いパッケージ: {loaded}")
+            if baseline is not None and "heavy_loaded" in before:
+                print(f"    （変更前: {', '.join(before['heavy_loaded']) or 'なし'}）")
+        if item.get("slowest_imports"):
+            print("  import に時間がかかるモジュール: " + ", ".join(
+                f"{name} {ms}ms" for name, ms in list(item["slowest_imports"].items())[:5]
+            ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ページのコールドスタートと再実行の時間を計測する")
+    parser.add_argument("--pages", nargs="+", default=PAGES)
+    parser.add_argument("--reruns", type=int, default=10)
+    parser.add_argument("--baseline", help="比較する git のリビジョン（例: HEAD~1）")
+    parser.add_argument("--out", default=REPORT_PATH)
+    args = parser.parse_args(argv)
+
+    report = {"pages": profile(".", args.pages, args.reruns)}
+    if args.baseline:
+        report["baseline_revision"] = args.baseline
+        report["baseline"] = profile_revision(args.baseline, args.pages, args.reruns)
+    print_report(report["pages"], report.get("baseline"))
+
+    if os.path.dirname(args.out):
+        os.makedirs(os.path.dirname(args.out), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果を {args.out} に保存しました")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
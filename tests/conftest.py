@@ -0,0 +1,16 @@
+# テストからリポジトリ直下のモジュール（schema_prompt.py など）を import できるようにする
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# キャッシュ・ワークロード・トレースはテスト専用の一時ディレクトリに書く（画面で使うキャッシュを汚さない）
+TEST_DIR = tempfile.mkdtemp(prefix="txt2sql-tests-")
+os.environ.setdefault("SQL_CACHE_PATH", os.path.join(TEST_DIR, "llm_cache.db"))
+os.environ.setdefault("EMBEDDING_CACHE_PATH", os.path.join(TEST_DIR, "embedding_cache.db"))
+os.environ.setdefault("WORKLOAD_LOG_PATH", os.path.join(TEST_DIR, "workload.db"))
+os.environ.setdefault("TRACE_LOG_PATH", os.path.join(TEST_DIR, "traces.jsonl"))
+os.environ.setdefault("METRICS_PATH", os.path.join(TEST_DIR, "metrics.prom"))
@@ -0,0 +1,48 @@
+# followup.py / pipeline.py: 追加質問を元のテーブルで処理する場合のSQLキャッシュ
+import uuid
+
+from fake_llm import FakeLLM
+from followup import NEED_BASE, TABLE
+from pipeline import PIPELINES
+
+GERMANY_SALES = "SELECT SUM(Total) FROM Invoice WHERE BillingCountry = 'Germany'"
+GERMANY_CUSTOMERS = "SELECT COUNT(*) FROM Customer WHERE Country = 'Germany'"
+
+
+def _client(calls):
+    """直前の結果では答えられない（NEED_BASE）と返し、元のテーブルでは直前の質問に合わせたSQLを返す擬似LLM。"""
+
+    def respond(messages):
+        question = messages[-1]["content"]
+        system = "\n".join(m["content"] for m in messages if m["role"] == "system")
+        if f"テーブル {TABLE}" in messages[0]["content"]:
+            calls.append("probe")
+            return NEED_BASE
+        calls.append("base")
+        if question.startswith("じゃあ"):
+            return GERMANY_SALES if "【直前の質問】\n国別の売上" in system else GERMANY_CUSTOMERS
+        if "顧客" in question:
+            return "SELECT Country, COUNT(*) FROM Customer GROUP BY Country"
+        return "SELECT BillingCountry, SUM(Total) FROM Invoice GROUP BY BillingCountry"
+
+    return FakeLLM(default=respond)
+
+
+def test_fallback_sql_is_not_shared_between_sessions():
+    calls = []
+    client = _client(calls)
+    pipeline = PIPELINES["txt2sql"]
+    session_a, session_b = uuid.uuid4().hex, uuid.uuid4().hex
+    pipeline.run(client, "国別の売上", session_id=session_a)
+    pipeline.run(client, "国別の顧客数", session_id=session_b)
+
+    turn_a = pipeline.run(client, "じゃあドイツだけだと？", session_id=session_a)
+    assert turn_a.sql == GERMANY_SALES
+
+    calls.clear()
+    turn_b = pipeline.run(client, "じゃあドイツだけだと？", session_id=session_b)
+    # セッションAのSQLをキャッシュから使わず、直前の結果の確認と、直前の質問を伝えた生成を行う
+    assert calls == ["probe", "base"]
+    assert not turn_b.sql_from_cache
+    assert turn_b.sql == GERMANY_CUSTOMERS
+    assert turn_b.full_question == "国別の顧客数 → じゃあドイツだけだと？"
@@ -0,0 +1,30 @@
+# schema_prompt.py: 質問に関連するテーブルの選択（Chinook.db）
+import os
+
+import pytest
+
+from schema_prompt import CHINOOK_KEYWORDS, SchemaPrompter, join_closure
+
+CHINOOK_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Chinook.db")
+
+
+@pytest.fixture(scope="module")
+def prompter():
+    return SchemaPrompter(CHINOOK_DB, "header", "footer", keywords=CHINOOK_KEYWORDS, pruning=True)
+
+
+@pytest.mark.parametrize("question", ["AC/DCの曲を全て教えて", "Queenの曲は何曲？"])
+def test_track_question_includes_artist(prompter, question):
+    # Track → Album → Artist と親の親までたどり、アーティスト名で絞り込めるようにする
+    selection = prompter.select(question)
+    assert {"Track", "Album", "Artist"} <= set(selection.tables)
+    assert prompter._rendered["Artist"] in selection.prompt
+
+
+def test_join_closure_adds_grandparents():
+    tables = {
+        "Track": {"foreign_keys": [("AlbumId", "Album", "AlbumId")]},
+        "Album": {"foreign_keys": [("ArtistId", "Artist", "ArtistId")]},
+        "Artist": {"foreign_keys": []},
+    }
+    assert join_closure(["Track"], tables) == ["Track", "Album", "Artist"]
@@ -0,0 +1,462 @@
+# チャット1ターンのフェーズごとの計測（トレース）と集計値の出力
+# SQL生成 → SQL実行 → 回答生成（main.py は ベクトル化 → 検索 → 回答生成）のそれぞれについて、
+# 所要時間・トークン数（completion の usage）・SQL・行数・キャッシュのヒットを1ターン分ずつ記録する。
+# ターンが終わるたびに、プロセス内の集計（ヒストグラム・カウンター）に加え、
+#   - .cache/traces.jsonl   : ターンごとの記録（と一定間隔で集計値のスナップショット）を1行1件で追記
+#                             （TRACE_LOG_MAX_BYTES を超えたら traces.jsonl.1, .2, ... に回して古いものから削除）
+#   - .cache/metrics.prom   : Prometheus のテキスト形式の集計値（node_exporter の textfile collector などで読む）
+# に書き出す。
+# traces.jsonl には既定でユーザーの質問文とSQLがそのまま残る。質問文を残さない場合は TRACE_LOG_QUESTIONS=0
+# （SQLの文字列リテラルには質問中の値が入りうるため、ファイルの置き場所と権限にも注意する）。
+# 書き出しに失敗した場合（ディスクがいっぱい・.cache が書き込めないなど）は標準エラーに警告を出して
+# ファイルへの書き出しを止め、ターンの処理は続ける。
+#
+# 使い方:
+#   python tracing.py summary            # traces.jsonl からページ・フェーズごとの p50/p95/p99 を表示
+#   python tracing.py prom               # traces.jsonl を集計し直して Prometheus 形式で表示
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# TRACING=0 でファイルへの書き出しを止める（画面の内訳表示は行う）
+TRACING_ENABLED = os.environ.get("TRACING", "1") != "0"
+# TRACE_LOG_QUESTIONS=0 で traces.jsonl に質問文を書かない
+LOG_QUESTIONS = os.environ.get("TRACE_LOG_QUESTIONS", "1") != "0"
+TRACE_LOG_PATH = os.environ.get("TRACE_LOG_PATH", os.path.join(".cache", "traces.jsonl"))
+METRICS_PATH = os.environ.get("METRICS_PATH", os.path.join(".cache", "metrics.prom"))
+# traces.jsonl の最大サイズと、ローテーションで残す世代数（0 でローテーションしない）
+TRACE_LOG_MAX_BYTES = int(os.environ.get("TRACE_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+TRACE_LOG_BACKUPS = int(os.environ.get("TRACE_LOG_BACKUPS", "3"))
+# 集計値のスナップショットを traces.jsonl に書く間隔（秒）
+SNAPSHOT_INTERVAL = float(os.environ.get("METRICS_SNAPSHOT_INTERVAL", "60"))
+
+# ヒストグラムのバケット（秒・行数）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000)
+
+# 画面に表示するフェーズ名
+PHASE_LABELS = {
+    "schema": "スキーマ選択",
+    "generate_sql": "SQL生成",
+    "followup_sql": "SQL生成（直前の結果）",
+    "execute_sql": "SQL実行",
+    "answer": "回答生成",
+    "embed": "ベクトル化",
+    "retrieve": "ベクトル検索",
+}
+
+
+class Span:
+    """1つのフェーズの所要時間と属性（トークン数・行数など）。"""
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.duration = None
+        self.attributes = dict(attributes)
+
+    def set(self, **attributes):
+        self.attributes.update((k, v) for k, v in attributes.items() if v is not None)
+
+    def add_usage(self, usage):
+        """completion / embeddings の usage からトークン数を加算する（usage が無ければ何もしない）。"""
+        if usage is None:
+            return
+        for field in ("prompt_tokens", "completion_tokens"):
+            value = getattr(usage, field, None)
+            if value is not None:
+                self.attributes[field] = self.attributes.get(field, 0) + value
+
+    def to_dict(self):
+        return {"name": self.name, "seconds": self.duration, **self.attributes}
+
+
+class Trace:
+    """
+    チャット1ターン分のトレース。
+    span() で計測するか、record() で計測済みの時間を登録する。finish() で集計に加えてファイルに書き出す。
+    """
+
+    def __init__(self, page, question=None):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.page = page
+        self.question = question
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.spans = {}
+        self.cache = {}       # キャッシュ名 → "hit" / "miss"
+        self.attributes = {}  # sql / executed_sql / rows など
+        self.status = None
+        self.total = None
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """with 内の処理時間を name のフェーズとして記録する（例外が出ても記録する）。"""
+        span = self.spans[name] = Span(name, **attributes)
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+
+    def record(self, name, duration, usage=None, **attributes):
+        span = self.spans[name] = Span(name)
+        span.duration = duration
+        span.set(**attributes)
+        span.add_usage(usage)
+        return span
+
+    def set(self, **attributes):
+        self.attributes.update((k, v) for k, v in attributes.items() if v is not None)
+
+    def cache_result(self, name, hit):
+        self.cache[name] = "hit" if hit else "miss"
+
+    @property
+    def timings(self):
+        """フェーズ名 → 所要時間（秒）。finish() 後は "total" も含む。"""
+        timings = {name: span.duration for name, span in self.spans.items() if span.duration is not None}
+        if self.total is not None:
+            timings["total"] = self.total
+        return timings
+
+    @property
+    def tokens(self):
+        prompt = sum(span.attributes.get("prompt_tokens", 0) for span in self.spans.values())
+        completion = sum(span.attributes.get("completion_tokens", 0) for span in self.spans.values())
+        return prompt, completion
+
+    def finish(self, status=None):
+        """
+        ターンを終了して集計に加える（2回目以降の呼び出しは何もしない）。
+        status を省略すると、エラーになったフェーズがあれば "error"、無ければ "ok" とする。
+        """
+        if self.total is not None:
+            return
+        self.total = time.perf_counter() - self._started
+        if status is None:
+            status = "error" if any("error" in span.attributes for span in self.spans.values()) else "ok"
+        self.status = status
+        get_metrics().observe(self)
+
+    def to_dict(self):
+        prompt_tokens, completion_tokens = self.tokens
+        return {
+            "type": "turn",
+            "trace_id": self.trace_id,
+            "page": self.page,
+            "started_at": self.started_at,
+            "question": self.question,
+            "status": self.status,
+            "total_seconds": self.total,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cache": dict(self.cache),
+            **self.attributes,
+            "spans": [span.to_dict() for span in self.spans.values()],
+        }
+
+    def breakdown(self):
+        """画面に表示するフェーズごとの内訳（表の行のリスト）。"""
+        rows = []
+        for span in self.spans.values():
+            attributes = span.attributes
+            note = [f"{k}={v}" for k, v in attributes.items()
+                    if k not in ("prompt_tokens", "completion_tokens", "cache")]
+            rows.append({
+                "フェーズ": PHASE_LABELS.get(span.name, span.name),
+                "秒": round(span.duration or 0.0, 3),
+                "入力トークン": attributes.get("prompt_tokens"),
+                "出力トークン": attributes.get("completion_tokens"),
+                "キャッシュ": attributes.get("cache"),
+                "備考": ", ".join(note),
+            })
+        return rows
+
+
+def show_trace(trace):
+    """トレースの内訳を表示する（Streamlit の 詳細データ エキスパンダー内で呼ぶ）。"""
+    import streamlit as st
+
+    st.caption("処理の内訳:")
+    st.table(trace.breakdown())
+    prompt_tokens, completion_tokens = trace.tokens
+    total = trace.total if trace.total is not None else time.perf_counter() - trace._started
+    caches = " / ".join(f"{name}: {'ヒット' if result == 'hit' else 'ミス'}" for name, result in trace.cache.items())
+    st.caption(
+        f"合計 {total:.2f}秒 / トークン 入力 {prompt_tokens}・出力 {completion_tokens}"
+        + (f" / キャッシュ {caches}" if caches else "")
+        + f" / trace_id {trace.trace_id}"
+    )
+
+
+# ==========================================
+# 集計と書き出し
+# ==========================================
+
+class Histogram:
+    """Prometheus と同じ累積バケットのヒストグラム。"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def to_dict(self):
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _bound(value):
+    return "+Inf" if value == math.inf else repr(float(value))
+
+
+class Metrics:
+    """ターンのトレースをページ・フェーズごとに集計し、JSONL と Prometheus 形式で書き出す。"""
+
+    HELP = {
+        "chat_phase_seconds": ("histogram", "チャット1ターンのフェーズごとの所要時間（秒）"),
+        "chat_turn_seconds": ("histogram", "チャット1ターン全体の所要時間（秒）"),
+        "chat_result_rows": ("histogram", "SQLの実行結果の行数"),
+        "chat_tokens_total": ("counter", "LLMの入力・出力トークン数"),
+        "chat_cache_requests_total": ("counter", "キャッシュの参照回数（ヒット・ミス別）"),
+        "chat_turns_total": ("counter", "処理したターン数（結果別）"),
+    }
+
+    def __init__(self, log_path=TRACE_LOG_PATH, metrics_path=METRICS_PATH, enabled=TRACING_ENABLED,
+                 snapshot_interval=SNAPSHOT_INTERVAL, max_bytes=TRACE_LOG_MAX_BYTES, backups=TRACE_LOG_BACKUPS):
+        self.log_path = log_path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.metrics_path = metrics_path
+        self.enabled = enabled
+        self.snapshot_interval = snapshot_interval
+        self.histograms = {}  # (名前, ラベル) → Histogram
+        self.counters = {}    # (名前, ラベル) → 値
+        self._last_snapshot = 0.0
+        self._lock = threading.Lock()
+
+    def _histogram(self, name, labels, buckets=LATENCY_BUCKETS):
+        key = (name, tuple(labels))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(buckets)
+        return self.histograms[key]
+
+    def _count(self, name, labels, value=1):
+        key = (name, tuple(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, record):
+        """ターンの記録（Trace.to_dict() の形式）を集計に加える。"""
+        page = record["page"]
+        for span in record["spans"]:
+            if span.get("seconds") is not None:
+                self._histogram("chat_phase_seconds", [("page", page), ("phase", span["name"])]).observe(span["seconds"])
+            for kind in ("prompt", "completion"):
+                tokens = span.get(f"{kind}_tokens")
+                if tokens:
+                    self._count("chat_tokens_total", [("page", page), ("phase", span["name"]), ("kind", kind)], tokens)
+        if record.get("total_seconds") is not None:
+            self._histogram("chat_turn_seconds", [("page", page)]).observe(record["total_seconds"])
+        if record.get("rows") is not None:
+            self._histogram("chat_result_rows", [("page", page)], ROW_BUCKETS).observe(record["rows"])
+        for cache, result in record.get("cache", {}).items():
+            self._count("chat_cache_requests_total", [("page", page), ("cache", cache), ("result", result)])
+        self._count("chat_turns_total", [("page", page), ("status", record.get("status") or "ok")])
+
+    def observe(self, trace):
+        record = trace.to_dict()
+        with self._lock:
+            self.add(record)
+            if not self.enabled:
+                return
+            if not LOG_QUESTIONS:
+                record["question"] = None
+            try:
+                self._append(record)
+                now = time.time()
+                if now - self._last_snapshot >= self.snapshot_interval:
+                    self._last_snapshot = now
+                    self._append({"type": "histograms", "at": now, "metrics": self.snapshot()})
+                self._write_prometheus()
+            except OSError as e:
+                # 計測のためにターンを失敗させない。以降はプロセス内の集計だけを行う
+                self.enabled = False
+                print(f"トレースの書き出しに失敗したため、ファイルへの書き出しを止めます: {e}", file=sys.stderr)
+
+    def snapshot(self):
+        return {
+            "histograms": [
+                {"name": name, "labels": dict(labels), **histogram.to_dict()}
+                for (name, labels), histogram in sorted(self.histograms.items())
+            ],
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ],
+        }
+
+    def to_prometheus(self):
+        lines = []
+        for name, (kind, help_text) in self.HELP.items():
+            histograms = sorted((labels, h) for (n, labels), h in self.histograms.items() if n == name)
+            counters = sorted((labels, v) for (n, labels), v in self.counters.items() if n == name)
+            if not histograms and not counters:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, histogram in histograms:
+                for bound, count in zip(histogram.buckets + (math.inf,), histogram.counts + [histogram.count]):
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', _bound(bound)),))} {count}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+            for labels, value in counters:
+                lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _rotate(self):
+        """traces.jsonl が max_bytes を超えていれば .1 に回し、backups 世代より古いものを削除する。"""
+        try:
+            if self.max_bytes <= 0 or os.path.getsize(self.log_path) < self.max_bytes:
+                return
+        except OSError:
+            return
+        for i in range(self.backups - 1, 0, -1):
+            older = f"{self.log_path}.{i}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.log_path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.log_path, f"{self.log_path}.1")
+        else:
+            os.remove(self.log_path)
+
+    def _append(self, record):
+        directory = os.path.dirname(self.log_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._rotate()
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def _write_prometheus(self):
+        # 読み取り側が書きかけのファイルを読まないよう、一時ファイルに書いてから置き換える
+        directory = os.path.dirname(self.metrics_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self.metrics_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(temp_path, self.metrics_path)
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """プロセス内で共有する Metrics を返す（初回呼び出し時に作成）。"""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+        return _metrics
+
+
+# ==========================================
+# ログの集計
+# ==========================================
+
+def log_files(log_path=TRACE_LOG_PATH):
+    """ローテーションした世代（古い順）と現在の traces.jsonl のうち、存在するもの。"""
+    backups = []
+    i = 1
+    while os.path.exists(f"{log_path}.{i}"):
+        backups.append(f"{log_path}.{i}")
+        i += 1
+    return backups[::-1] + ([log_path] if os.path.exists(log_path) else [])
+
+
+def read_turns(log_path=TRACE_LOG_PATH):
+    for path in log_files(log_path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    if record.get("type") == "turn":
+                        yield record
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def summary(log_path=TRACE_LOG_PATH):
+    """ページ・フェーズごとの件数と p50/p95/p99（ミリ秒）、トークン数の合計を返す。"""
+    seconds, tokens = {}, {}
+    for record in read_turns(log_path):
+        page = record["page"]
+        for span in record["spans"]:
+            if span.get("seconds") is not None:
+                seconds.setdefault((page, span["name"]), []).append(span["seconds"])
+            tokens[page] = tokens.get(page, 0) + (span.get("prompt_tokens") or 0) + (span.get("completion_tokens") or 0)
+        if record.get("total_seconds") is not None:
+            seconds.setdefault((page, "total"), []).append(record["total_seconds"])
+    return {
+        "phases": {
+            f"{page}/{phase}": {
+                "count": len(values),
+                **{f"p{int(q * 100)}_ms": round(_percentile(values, q) * 1000, 2) for q in (0.5, 0.95, 0.99)},
+            }
+            for (page, phase), values in sorted(seconds.items())
+        },
+        "tokens": tokens,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="チャットのトレースログの集計")
+    parser.add_argument("command", choices=["summary", "prom"])
+    parser.add_argument("--log", default=TRACE_LOG_PATH)
+    args = parser.parse_args(argv)
+
+    if args.command == "prom":
+        metrics = Metrics(enabled=False)
+        for record in read_turns(args.log):
+            metrics.add(record)
+        sys.stdout.write(metrics.to_prometheus())
+        return 0
+
+    report = summary(args.log)
+    for key, item in report["phases"].items():
+        print(f"{key:<28} {item['count']:>6}件  p50 {item['p50_ms']:>9.2f}ms  p95 {item['p95_ms']:>9.2f}ms  p99 {item['p99_ms']:>9.2f}ms")
+    for page, count in report["tokens"].items():
+        print(f"{page}: トークン合計 {count}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,269 @@
+# Azure AI Search の代わりに使えるプロセス内のベクトル検索
+# main.py が検索する文書（スキーマ情報など）は少数で変化しないため、毎ターン Azure AI Search へ
+# 問い合わせるとネットワーク往復の分だけ遅くなる。文書とベクトルを1つの NumPy 行列として読み込み、
+# コサイン類似度の上位 k 件をまとめて計算する。int8 に量子化した行列で候補を絞ってから
+# float32 で並べ直すこともできる。索引はディレクトリに .npy で保存し、起動時はメモリマップで開く。
+#
+# 使い方:
+#   python vector_index.py build docs.jsonl    # {"id", "content"[, "contentVector"]} の JSONL から索引を作成
+#   python vector_index.py bench               # 合成データで再現率と検索時間を比較（--azure で Azure AI Search とも比較）
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+# main.py の検索先（"azure" または "local"）
+VECTOR_BACKEND = os.environ.get("VECTOR_BACKEND", "azure")
+VECTOR_INDEX_DIR = os.environ.get("VECTOR_INDEX_DIR", os.path.join(".cache", "vector_index"))
+# VECTOR_INDEX_INT8=1 で int8 の行列で候補を絞ってから並べ直す
+USE_INT8 = os.environ.get("VECTOR_INDEX_INT8", "0") == "1"
+
+# int8 で絞り込む候補数（k の何倍か）
+RERANK_FACTOR = 4
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError as e:
+        raise RuntimeError("ローカルのベクトル検索には numpy パッケージが必要です。") from e
+    return numpy
+
+
+class LocalVectorIndex:
+    """
+    文書ベクトルの行列（1行1文書、L2正規化済みの float32）とコサイン類似度の上位 k 件検索。
+    search() の戻り値は Azure AI Search の結果と同じく result["id"] / result["content"] で参照できる。
+    """
+
+    def __init__(self, ids, contents, vectors, quantized=None, scales=None, use_int8=USE_INT8):
+        np = _numpy()
+        self.np = np
+        self.ids = list(ids)
+        self.contents = list(contents)
+        self.vectors = vectors
+        self.quantized = quantized
+        self.scales = scales
+        self.use_int8 = use_int8 and quantized is not None
+
+    @classmethod
+    def from_vectors(cls, ids, contents, vectors, use_int8=USE_INT8):
+        np = _numpy()
+        matrix = np.array(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1, norms)
+        quantized, scales = cls.quantize(matrix)
+        return cls(ids, contents, matrix, quantized, scales, use_int8)
+
+    @staticmethod
+    def quantize(matrix):
+        """行ごとに最大絶対値で割って int8 にする（スコアは scale を掛けて戻す）。"""
+        np = _numpy()
+        scales = np.abs(matrix).max(axis=1) / 127
+        scales[scales == 0] = 1
+        quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _query(self, vector):
+        np = self.np
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        return query / norm if norm else query
+
+    def _top(self, scores, k):
+        np = self.np
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.array([], dtype=np.int64)
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        return candidates[np.argsort(-scores[candidates])]
+
+    def search_indices(self, vector, k=3):
+        """類似度の高い順に (行番号, スコア) のリストを返す。"""
+        query = self._query(vector)
+        if self.use_int8:
+            # int8 の行列で候補を絞り、候補だけ float32 で計算し直す
+            approx = (self.quantized @ query) * self.scales
+            candidates = self._top(approx, k * RERANK_FACTOR)
+            exact = self.vectors[candidates] @ query
+            order = self._top(exact, k)
+            return [(int(candidates[i]), float(exact[i])) for i in order]
+        scores = self.vectors @ query
+        return [(int(i), float(scores[i])) for i in self._top(scores, k)]
+
+    def search(self, vector, k=3):
+        return [
+            {"id": self.ids[i], "content": self.contents[i], "@search.score": score}
+            for i, score in self.search_indices(vector, k)
+        ]
+
+    # --- 保存と読み込み ---
+
+    def save(self, directory=VECTOR_INDEX_DIR):
+        np = self.np
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "vectors.npy"), self.vectors)
+        np.save(os.path.join(directory, "vectors_int8.npy"), self.quantized)
+        np.save(os.path.join(directory, "scales.npy"), self.scales)
+        with open(os.path.join(directory, "docs.json"), "w", encoding="utf-8") as f:
+            json.dump({"ids": self.ids, "contents": self.contents}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory=VECTOR_INDEX_DIR, use_int8=USE_INT8):
+        """保存した索引を開く。行列はメモリマップで開くため、読み込み時にファイル全体を読まない。"""
+        np = _numpy()
+        with open(os.path.join(directory, "docs.json"), encoding="utf-8") as f:
+            docs = json.load(f)
+        return cls(
+            docs["ids"],
+            docs["contents"],
+            np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r"),
+            np.load(os.path.join(directory, "vectors_int8.npy"), mmap_mode="r"),
+            np.load(os.path.join(directory, "scales.npy"), mmap_mode="r"),
+            use_int8,
+        )
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_local_index():
+    """プロセス内で共有する LocalVectorIndex を返す（VECTOR_INDEX_DIR から読み込む）。"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = LocalVectorIndex.load()
+        return _index
+
+
+def build(docs_path, client=None, model=None, directory=VECTOR_INDEX_DIR):
+    """
+    JSONL の文書から索引を作って保存する。
+    contentVector が無い文書は client（AzureOpenAI など）で content をベクトル化する（embedding_cache 経由）。
+    """
+    with open(docs_path, encoding="utf-8") as f:
+        docs = [json.loads(line) for line in f if line.strip()]
+    missing = [doc["content"] for doc in docs if not doc.get("contentVector")]
+    if missing:
+        if client is None:
+            raise ValueError("contentVector の無い文書があります。ベクトル化するクライアントを指定してください。")
+        from embedding_cache import get_embedding_cache
+
+        embedded = iter(get_embedding_cache().embed(client, model, missing))
+        for doc in docs:
+            if not doc.get("contentVector"):
+                doc["contentVector"] = next(embedded)
+    index = LocalVectorIndex.from_vectors(
+        [str(doc["id"]) for doc in docs], [doc["content"] for doc in docs], [doc["contentVector"] for doc in docs]
+    )
+    index.save(directory)
+    return index
+
+
+# ==========================================
+# ベンチマーク
+# ==========================================
+
+def _time_ms(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def bench(docs=2000, dimensions=1536, queries=100, k=3, azure_search=None, seed=0):
+    """
+    合成データ（文書ベクトルにノイズを加えた質問）で検索を比較する。
+    - float32 の総当たりを正解として、int8 で絞り込んだ場合の recall@k を計算する
+    - azure_search（Azure の文書ベクトルを使う場合の検索関数 vector -> [id]）を渡すと、その結果とも比較する
+    """
+    np = _numpy()
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((docs, dimensions)).astype(np.float32)
+    targets = rng.integers(0, docs, queries)
+    query_vectors = vectors[targets] + rng.standard_normal((queries, dimensions)).astype(np.float32) * 0.8
+    exact = LocalVectorIndex.from_vectors(range(docs), [""] * docs, vectors, use_int8=False)
+    approx = LocalVectorIndex(exact.ids, exact.contents, exact.vectors, exact.quantized, exact.scales, use_int8=True)
+
+    truth = [[i for i, _ in exact.search_indices(q, k)] for q in query_vectors]
+    report = {"docs": docs, "dimensions": dimensions, "k": k}
+    for name, index in (("float32", exact), ("int8", approx)):
+        found = [[i for i, _ in index.search_indices(q, k)] for q in query_vectors]
+        hits = sum(len(set(a) & set(b)) for a, b in zip(found, truth))
+        report[name] = {
+            "recall": hits / (k * queries),
+            "median_ms": round(_time_ms(lambda: index.search_indices(query_vectors[0], k), 50), 4),
+        }
+    if azure_search is not None:
+        found = [azure_search(q) for q in query_vectors]
+        hits = sum(len(set(map(str, a)) & set(map(str, b))) for a, b in zip(found, truth))
+        report["azure"] = {
+            "recall": hits / (k * queries),
+            "median_ms": round(_time_ms(lambda: azure_search(query_vectors[0]), 10), 4),
+        }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ローカルのベクトル検索索引")
+    parser.add_argument("command", choices=["build", "bench"])
+    parser.add_argument("docs", nargs="?", help="build: 文書の JSONL")
+    parser.add_argument("--out", default=VECTOR_INDEX_DIR)
+    parser.add_argument("--model", default=os.environ.get("AOAI_EMBEDDING_MODEL_NAME"))
+    parser.add_argument("--size", type=int, default=2000, help="bench: 合成文書の件数")
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--azure", action="store_true", help="bench: 索引を作成済みの Azure AI Search とも比較する")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        if not args.docs:
+            parser.error("build には文書の JSONL が必要です")
+        client = None
+        if args.model:
+            from openai import AzureOpenAI
+
+            client = AzureOpenAI(
+                azure_endpoint=os.environ["AOAI_ENDPOINT"],
+                api_key=os.environ["AOAI_API_KEY"],
+                api_version=os.environ["AOAI_API_VERSION"],
+            )
+        index = build(args.docs, client, args.model, args.out)
+        print(f"{len(index)}件の文書を {args.out} に保存しました")
+        return 0
+
+    azure_search = None
+    if args.azure:
+        # Azure AI Search に合成データと同じ文書（id = 行番号）を登録済みであることが前提
+        from azure.core.credentials import AzureKeyCredential
+        from azure.search.documents import SearchClient
+        from azure.search.documents.models import VectorizedQuery
+
+        search_client = SearchClient(
+            endpoint=os.environ["SEARCH_SERVICE_ENDPOINT"],
+            index_name=os.environ["SEARCH_SERVICE_INDEX_NAME"],
+            credential=AzureKeyCredential(os.environ["SEARCH_SERVICE_API_KEY"]),
+        )
+
+        def azure_search(vector):
+            query = VectorizedQuery(vector=vector.tolist(), k_nearest_neighbor=3, fields="contentVector")
+            return [r["id"] for r in search_client.search(vector_queries=[query], select=["id"])]
+
+    report = bench(args.size, args.dimensions, azure_search=azure_search)
+    print(f"文書 {report['docs']}件 / {report['dimensions']}次元 / 上位{report['k']}件")
+    for name in ("float32", "int8", "azure"):
+        if name in report:
+            print(f"{name}: recall@{report['k']} {report[name]['recall']:.3f} / 中央値 {report[name]['median_ms']}ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())